@@ -0,0 +1,303 @@
+"""
+Throughput and latency benchmarks of the filter engines.
+
+Microbenchmarks time insert_entry, lookup_entry, modify_entry and delete_entry on their
+own, macrobenchmarks replay a packet trace the way the simulators do (insert or modify
+on a transition, a lookup on every packet). Every call is timed separately so the tail
+percentiles show the stalls of a full aging sweep, and every case runs in a fresh
+process so its peak RSS is its own; the table also shows what a case added to the
+RSS of a worker that had just imported the modules.
+
+    python benchmarks.py --save baseline.json      # record a baseline
+    python benchmarks.py --baseline baseline.json  # flag throughput regressions
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from direct_bloom_filter import DirectBloomFilter, PackedDirectBloomFilter
+from fingerprint_compressed_filter import FCF, ArrayFCF
+from packet_generator import stream_packets
+from packet_trace import open_trace
+from stateful_bloom_filter import ArrayStatefulBloomFilter, StatefulBloomFilter
+
+
+OPERATIONS = ("insert_entry", "lookup_entry", "modify_entry", "delete_entry")
+PERCENTILES = (50, 99, 99.9)
+# (num cells, hash count), the range of configurations of the paper
+PAPER_CONFIGS = [(131072, 3), (262144, 3), (524288, 4), (1048576, 5)]
+QUICK_CONFIGS = [(16384, 3)]
+CELLS_PER_BUCKET = 6
+FINGERPRINT_SIZE = 10
+
+
+def load_otter():
+    # otter-fcf.py is a script rather than an importable module name
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "otter-fcf.py")
+    spec = importlib.util.spec_from_file_location("otter_fcf", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def fcf_table_size(num_cells, hash_count):
+    # FCF configurations are given in cells too, CELLS_PER_BUCKET of them per bucket
+    return max(hash_count, num_cells // CELLS_PER_BUCKET // hash_count * hash_count)
+
+
+# Every engine as (factory(num_cells, hash_count), ops), where ops maps each operation
+# onto a call of the engine's own method as op(filter, flow, state, new_state), or None
+# when the engine has no such operation.
+def state_free_ops():
+    return {
+        "insert_entry": lambda f, flow, state, new: f.insert_entry(flow, state),
+        "lookup_entry": lambda f, flow, state, new: f.lookup_entry(flow),
+        "modify_entry": lambda f, flow, state, new: f.modify_entry(flow, new),
+        "delete_entry": lambda f, flow, state, new: f.delete_entry(flow),
+    }
+
+
+def keyed_ops():
+    # engines that hash (flow, state) pairs, deletes and modifies need the old state
+    return {
+        "insert_entry": lambda f, flow, state, new: f.insert_entry(flow, state),
+        "lookup_entry": lambda f, flow, state, new: f.lookup_entry(flow, state),
+        "modify_entry": lambda f, flow, state, new: f.modify_entry(flow, state, new),
+        "delete_entry": lambda f, flow, state, new: f.delete_entry(flow, state),
+    }
+
+
+def engines():
+    return {
+        "sbf": (lambda cells, k: StatefulBloomFilter(hash_count=k, num_cells=cells), state_free_ops()),
+        "array-sbf": (lambda cells, k: ArrayStatefulBloomFilter(hash_count=k, num_cells=cells), state_free_ops()),
+        "dbf": (lambda cells, k: DirectBloomFilter(cells, k), keyed_ops()),
+        "packed-dbf": (lambda cells, k: PackedDirectBloomFilter(cells, k), keyed_ops()),
+        "packed-dbf-incremental": (
+            lambda cells, k: PackedDirectBloomFilter(cells, k, incremental_aging=True), keyed_ops()),
+        "fcf": (lambda cells, k: FCF(k, fcf_table_size(cells, k), CELLS_PER_BUCKET, FINGERPRINT_SIZE),
+                state_free_ops()),
+        "array-fcf": (lambda cells, k: ArrayFCF(k, fcf_table_size(cells, k), CELLS_PER_BUCKET, FINGERPRINT_SIZE),
+                      state_free_ops()),
+        "otter-dbf": (lambda cells, k: load_otter().DBF(k, cells), keyed_ops()),
+        "otter-sbf": (lambda cells, k: load_otter().SBF(k, cells),
+                      dict(keyed_ops(), delete_entry=None,
+                           modify_entry=lambda f, flow, state, new: f.modify_entry(flow, new))),
+        "otter-fcf": (lambda cells, k: load_otter().FCF(k, fcf_table_size(cells, k), CELLS_PER_BUCKET,
+                                                        FINGERPRINT_SIZE), keyed_ops()),
+    }
+
+
+def latency_stats(latencies_ns):
+    latencies_ns = np.asarray(latencies_ns, dtype=np.float64)
+    total = latencies_ns.sum()
+    stats = {
+        "ops": len(latencies_ns),
+        "ops_per_sec": len(latencies_ns) / (total / 1e9) if total else float("inf"),
+        "ns_per_op": float(latencies_ns.mean()) if len(latencies_ns) else 0.0,
+        "max_ns": float(latencies_ns.max()) if len(latencies_ns) else 0.0,
+    }
+    for percentile, value in zip(PERCENTILES, np.percentile(latencies_ns, PERCENTILES) if len(latencies_ns) else
+                                 [0.0] * len(PERCENTILES)):
+        stats[f"p{percentile}_ns"] = float(value)
+    return stats
+
+
+def time_calls(call, args):
+    clock = time.perf_counter_ns
+    latencies = np.empty(len(args), dtype=np.int64)
+    for i, arg in enumerate(args):
+        start = clock()
+        call(*arg)
+        latencies[i] = clock() - start
+    return latencies
+
+
+def micro(engine, num_cells, hash_count, ops=20000, prefill=None):
+    # Each operation on its own against a filter holding prefill flows. Lookups, modifies
+    # and deletes hit flows that are in the filter, inserts add new ones.
+    factory, calls = engines()[engine]
+    filter = factory(num_cells, hash_count)
+    prefill = num_cells // (8 * hash_count) if prefill is None else prefill
+    insert = calls["insert_entry"]
+    for flow in range(prefill):
+        insert(filter, flow, 1, None)
+    existing = range(min(ops, prefill)) if prefill else range(prefill, prefill + ops)
+    arguments = {
+        "insert_entry": [(filter, flow, 1, None) for flow in range(prefill, prefill + ops)],
+        "lookup_entry": [(filter, flow, 1, None) for flow in existing],
+        "modify_entry": [(filter, flow, 1, 2) for flow in existing],
+        "delete_entry": [(filter, flow, 2, None) for flow in existing],
+    }
+    results = {}
+    for operation in OPERATIONS:
+        if calls[operation] is not None:
+            results[operation] = latency_stats(time_calls(calls[operation], arguments[operation]))
+    return results
+
+
+def trace_columns(trace=None, packets=200000, seed=0):
+    # The first packets of a trace file, or of a seeded stream_packets workload
+    if trace is not None:
+        batches = open_trace(trace).batches()
+    else:
+        batches = stream_packets(seed, num_flows=max(1, packets // 60))
+    columns, count = [], 0
+    for batch in batches:
+        columns.append([np.asarray(column) for column in batch])
+        count += len(batch[0])
+        if count >= packets:
+            break
+    flow_ids, _, froms, tos = (np.concatenate(column)[:packets] for column in zip(*columns))
+    return flow_ids, froms, tos
+
+
+def macro(engine, num_cells, hash_count, trace=None, packets=200000, seed=0):
+    # Per packet latency of a trace replayed as the simulators do: the first transition
+    # inserts the flow, later ones modify it, and every packet looks the flow up
+    factory, calls = engines()[engine]
+    filter = factory(num_cells, hash_count)
+    flow_ids, froms, tos = trace_columns(trace, packets, seed)
+    insert, modify, lookup = calls["insert_entry"], calls["modify_entry"], calls["lookup_entry"]
+    clock = time.perf_counter_ns
+    latencies = np.empty(len(flow_ids), dtype=np.int64)
+    current = {}
+    for i, (flow, state_from, state_to) in enumerate(zip(flow_ids.tolist(), froms.tolist(), tos.tolist())):
+        start = clock()
+        if state_from != -1:
+            if flow in current:
+                modify(filter, flow, current[flow], state_to)
+            else:
+                insert(filter, flow, state_to, None)
+            current[flow] = state_to
+        lookup(filter, flow, current.get(flow, 1), None)
+        latencies[i] = clock() - start
+    return {"replay": latency_stats(latencies)}
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_case(case):
+    # One benchmark case, meant to run in a process of its own. The worker has imported
+    # everything by now, so start_rss_kb is the interpreter and modules and case_rss_kb
+    # what the case itself added on top.
+    kind, engine, num_cells, hash_count, options = case
+    rss_before = peak_rss_kb()
+    results = (micro if kind == "micro" else macro)(engine, num_cells, hash_count, **options)
+    peak = peak_rss_kb()
+    return {
+        f"{kind}/{engine}/{num_cells}x{hash_count}/{operation}": dict(stats, peak_rss_kb=peak, start_rss_kb=rss_before,
+                                                                      case_rss_kb=peak - rss_before)
+        for operation, stats in results.items()
+    }
+
+
+def run_suite(cases, isolate=True):
+    results = {}
+    if not isolate:
+        for case in cases:
+            results.update(run_case(case))
+        return results
+    # spawned rather than forked, so a worker does not start out with our memory
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.update(pool.submit(run_case, case).result())
+    return results
+
+
+def compare(results, baseline, tolerance=0.10):
+    # Cases whose throughput fell more than tolerance below the baseline, as
+    # (case, baseline ops/sec, current ops/sec)
+    regressions = []
+    for case, stats in results.items():
+        if case in baseline and stats["ops_per_sec"] < baseline[case]["ops_per_sec"] * (1 - tolerance):
+            regressions.append((case, baseline[case]["ops_per_sec"], stats["ops_per_sec"]))
+    return regressions
+
+
+def format_results(results):
+    lines = [f"{'case':<58}{'ops/s':>12}{'ns/op':>10}{'p50':>10}{'p99':>10}{'p99.9':>11}{'max':>12}{'rss MB':>8}{'+case':>8}"]
+    for case, stats in results.items():
+        lines.append(
+            f"{case:<58}{stats['ops_per_sec']:>12.0f}{stats['ns_per_op']:>10.0f}{stats['p50_ns']:>10.0f}"
+            f"{stats['p99_ns']:>10.0f}{stats['p99.9_ns']:>11.0f}{stats['max_ns']:>12.0f}"
+            f"{stats['peak_rss_kb'] / 1024:>8.1f}{stats['case_rss_kb'] / 1024:>8.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the filter engines")
+    parser.add_argument("--engines", nargs="+", default=sorted(engines()), choices=sorted(engines()))
+    parser.add_argument("--kinds", nargs="+", default=["micro", "macro"], choices=["micro", "macro"])
+    parser.add_argument("--quick", action="store_true", help="one small configuration and fewer operations")
+    parser.add_argument("--ops", type=int, default=None, help="operations per microbenchmark")
+    parser.add_argument("--packets", type=int, default=None, help="packets per macrobenchmark")
+    parser.add_argument("--trace", default=None, help="packet trace for the macrobenchmarks")
+    parser.add_argument("--save", default=None, help="write the results to this JSON baseline")
+    parser.add_argument("--baseline", default=None, help="JSON baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed throughput drop, as a fraction")
+    args = parser.parse_args(argv)
+
+    configs = QUICK_CONFIGS if args.quick else PAPER_CONFIGS
+    ops = args.ops or (2000 if args.quick else 20000)
+    packets = args.packets or (20000 if args.quick else 200000)
+    cases = []
+    for kind in args.kinds:
+        options = {"ops": ops} if kind == "micro" else {"packets": packets, "trace": args.trace}
+        cases += [(kind, engine, num_cells, hash_count, options)
+                  for engine in args.engines for num_cells, hash_count in configs]
+    results = run_suite(cases)
+    print(format_results(results))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for case, before, after in regressions:
+            print(f"REGRESSION {case}: {before:.0f} -> {after:.0f} ops/s ({after / before - 1:+.1%})")
+        return 1 if regressions else 0
+    return 0
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_micro_covers_every_engine(self):
+        for engine, (_, calls) in engines().items():
+            results = micro(engine, 600, 3, ops=20, prefill=10)
+            self.assertEqual(set(results), {op for op in OPERATIONS if calls[op] is not None})
+            for operation, stats in results.items():
+                self.assertEqual(stats["ops"], 20 if operation == "insert_entry" else 10)
+                self.assertLessEqual(stats["p50_ns"], stats["p99.9_ns"])
+                self.assertLessEqual(stats["p99.9_ns"], stats["max_ns"])
+
+    def test_macro_and_baseline(self):
+        results = run_suite([("macro", "packed-dbf", 3000, 3, {"packets": 2000})], isolate=False)
+        (case, stats), = results.items()
+        self.assertEqual(case, "macro/packed-dbf/3000x3/replay")
+        self.assertEqual(stats["ops"], 2000)
+        self.assertGreater(stats["peak_rss_kb"], 0)
+        self.assertEqual(stats["case_rss_kb"], stats["peak_rss_kb"] - stats["start_rss_kb"])
+        slower = {case: dict(stats, ops_per_sec=stats["ops_per_sec"] * 0.5)}
+        self.assertEqual(compare(slower, results), [(case, stats["ops_per_sec"], stats["ops_per_sec"] * 0.5)])
+        self.assertEqual(compare(results, slower), [])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,31 +4,107 @@ from abc import abstractmethod
 from enum import auto, Enum
 from typing import Optional
 
+import numpy as np
 import xxhash
 
+from hash_index_cache import make_index_cache
+
 
 xxhash.xxh64("xxhash", seed=20141025)
 
 
+MASK_64 = (1 << 64) - 1
+
+
 class State(Enum):
     one = auto()
     two = auto()
     three = auto()
 
 
+def hash_input(val):
+    # xxhash only takes str/bytes; everything else is hashed by its string form,
+    # which is what the filters already do with str(flow)
+    return val if isinstance(val, (str, bytes)) else str(val)
+
+
+def double_hash_vals(val, hash_count):
+    # Kirsch-Mitzenmacher: one 128-bit digest split into two 64-bit halves,
+    # index i is h1 + i * h2 (mod 2 ** 64). h2 is forced odd so the k indices
+    # never collapse onto one another when the table size is a power of two.
+    digest = xxhash.xxh3_128_intdigest(hash_input(val))
+    h1 = digest >> 64
+    h2 = (digest & MASK_64) | 1
+    return [(h1 + i * h2) & MASK_64 for i in range(hash_count)]
+
+
+def double_hash_matrix(vals, hash_count):
+    # Batch form of double_hash_vals: a single xxh3_128 call per key, then the
+    # (n, k) indices are derived with uint64 arithmetic (wraps mod 2 ** 64).
+    digests = b"".join(xxhash.xxh3_128_digest(hash_input(val)) for val in vals)
+    halves = np.frombuffer(digests, dtype=">u8").astype(np.uint64).reshape(-1, 2)
+    h1 = halves[:, 0:1]
+    h2 = halves[:, 1:2] | np.uint64(1)
+    return h1 + np.arange(hash_count, dtype=np.uint64) * h2
+
+
+def seeded_hash_matrix(vals, seeds):
+    # Batch form of the per-seed xxh64 scheme used by compute_hash_vals. This only
+    # collects the matrix: it still makes k xxh64 calls per key, one per seed, since the
+    # indices have to match the scalar path. Only double_hash_matrix gets a batch speedup.
+    vals = [hash_input(val) for val in vals]
+    flat = np.fromiter(
+        (xxhash.xxh64_intdigest(val, seed=seed) for val in vals for seed in seeds),
+        dtype=np.uint64,
+        count=len(vals) * len(seeds),
+    )
+    return flat.reshape(len(vals), len(seeds))
+
+
+def compute_hash_matrix(vals, seeds, num_buckets, double_hashing=False, modulo_to_buckets=True):
+    # Returns an (n, k) matrix of indices, row i holding the k hash values of vals[i].
+    # Only double_hashing=True hashes each key once; the default keeps k hashes per key.
+    if double_hashing:
+        ret = double_hash_matrix(vals, len(seeds))
+    else:
+        ret = seeded_hash_matrix(vals, seeds)
+    if modulo_to_buckets:
+        ret = (ret % np.uint64(num_buckets)).astype(np.intp)
+    return ret
+
+
 class BloomFilter:
 
-    def __init__(self, hash_count=4, num_cells=10):
+    def __init__(self, hash_count=4, num_cells=10, double_hashing=False, cache_size=None):
         self.seeds = []
         self.num_hash_func = hash_count
         self.num_buckets = num_cells
+        # when set, the k indices are derived from one digest instead of k hashes
+        self.double_hashing = double_hashing
+        # optional LRU cache of the indices of the most recently seen flows
+        self.index_cache = make_index_cache(cache_size)
         self.setup_hash_func()
 
     def compute_hash_vals(self, val, modulo_to_buckets=True):
-        ret = [xxhash.xxh64(val, seed=seed).intdigest() for seed in self.seeds]
+        if self.double_hashing:
+            ret = double_hash_vals(val, self.num_hash_func)
+        else:
+            ret = [xxhash.xxh64(val, seed=seed).intdigest() for seed in self.seeds]
         ret = [each % self.num_buckets if modulo_to_buckets else each for each in ret]
         return ret
 
+    # Bucket indices of a flow, compute_hash_vals(str(flow)) through the index cache
+    def flow_indices(self, flow):
+        if self.index_cache is None:
+            return self.compute_hash_vals(str(flow))
+        return self.index_cache.lookup(flow, lambda flow: self.compute_hash_vals(str(flow)))
+
+    def compute_hash_matrix(self, vals, modulo_to_buckets=True):
+        # Batch counterpart of compute_hash_vals, row i == compute_hash_vals(str(vals[i]))
+        return compute_hash_matrix(
+            vals, self.seeds, self.num_buckets, self.double_hashing, modulo_to_buckets
+        )
+
     def setup_hash_func(self):
         for i in range(self.num_hash_func):
             self.seeds.append(i)
@@ -74,6 +150,27 @@ class TestBloomFiltersMethods(unittest.TestCase):
             tuple([True for _ in range(len(hash_vals))]),
         )
 
+    def test_hash_matrix_matches_hash_vals(self):
+        keys = ["hello_world", "val1", 42]
+        for double_hashing in (False, True):
+            filter = BloomFilter(hash_count=5, num_cells=1000, double_hashing=double_hashing)
+            matrix = filter.compute_hash_matrix(keys)
+            self.assertEqual(matrix.shape, (3, 5))
+            for row, key in zip(matrix.tolist(), keys):
+                self.assertEqual(row, filter.compute_hash_vals(str(key)))
+            raw = filter.compute_hash_matrix(keys, modulo_to_buckets=False)
+            self.assertEqual(
+                raw[0].tolist(),
+                filter.compute_hash_vals("hello_world", modulo_to_buckets=False),
+            )
+
+    def test_double_hashing_spreads_indices(self):
+        filter = BloomFilter(hash_count=4, num_cells=1024, double_hashing=True)
+        matrix = filter.compute_hash_matrix([f"flow{i}" for i in range(100)])
+        self.assertTrue(((0 <= matrix) & (matrix < 1024)).all())
+        # odd step size means the k indices of a key are always distinct mod 2 ** n
+        self.assertTrue(all(len(set(row)) == 4 for row in matrix.tolist()))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,73 +1,165 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
 import xxhash
 from bitarray import bitarray
+from bitarray.util import ba2int, int2ba
 import sys 
 
-class DirectBloomFilter(object):
-    def __init__(self, num_cells, hash_count, phase_duration=1000,):
+from bloom_filter import compute_hash_matrix, double_hash_vals
+from filter_snapshot import Snapshottable
+from hash_index_cache import make_index_cache
+from memory_usage import build_memory_report, deep_sizeof
+
+class DirectBloomFilter(Snapshottable):
+    def __init__(self, num_cells, hash_count, phase_duration=1000, double_hashing=False,
+                 incremental_aging=False, sweep_budget=None, cache_size=None, counter_bits=2):
         self.num_cells = num_cells
-        self.size = num_cells * 3  # Each cell has 3 bits
+        # A cell is a timer bit followed by a counter_bits wide saturating counter
+        if counter_bits < 1:
+            raise ValueError(f"counter_bits must be at least 1, got {counter_bits}")
+        self.counter_bits = counter_bits
+        self.cell_bits = counter_bits + 1
+        self.timer_bit = 1 << counter_bits
+        self.counter_max = self.timer_bit - 1
+        self.size = num_cells * self.cell_bits
         self.phase_duration = phase_duration
         self.hash_count = hash_count
-        self.bit_array = bitarray(self.size)
-        self.bit_array.setall(0)
+        self.setup_cells()
         self.operations = phase_duration
+        # With incremental aging every operation sweeps the next sweep_budget cells
+        # instead of sweeping the whole table once the phase ends. The budget has to
+        # cover the table within one phase so each cell is still aged once per phase.
+        self.incremental_aging = incremental_aging
+        if sweep_budget is None:
+            sweep_budget = -(-num_cells // phase_duration)
+        if incremental_aging and sweep_budget * phase_duration < num_cells:
+            raise ValueError(
+                f"sweep_budget={sweep_budget} cannot sweep {num_cells} cells in {phase_duration} operations"
+            )
+        self.sweep_budget = sweep_budget
+        self.sweep_cursor = 0
+        self.phase = 0
         self.seeds = []
+        self.double_hashing = double_hashing
+        # optional LRU cache of the indices of the most recently seen (flow, state) pairs
+        self.index_cache = make_index_cache(cache_size)
+        # Read-only lookups set no timers and do not count towards the phase, for readers
+        # of a table another process updates (see shared_filter)
+        self.read_only = False
         self.setup_hash_func()
 
+    def setup_cells(self):
+        self.bit_array = bitarray(self.size)
+        self.bit_array.setall(0)
+
     def setup_hash_func(self):
         for i in range(self.hash_count):
             self.seeds.append(i)
     
     def compute_hash_vals(self, val, modulo_to_buckets=True):
-        ret = [xxhash.xxh64(val, seed=seed).intdigest() for seed in self.seeds]
+        if self.double_hashing:
+            ret = double_hash_vals(val, self.hash_count)
+        else:
+            ret = [xxhash.xxh64(val, seed=seed).intdigest() for seed in self.seeds]
         ret = [each % self.num_cells if modulo_to_buckets else each for each in ret]
         return ret
 
+    # (n, k) index matrix for a batch of items, row i == compute_hash_vals(items[i])
+    def compute_hash_matrix(self, items, modulo_to_buckets=True):
+        return compute_hash_matrix(
+            items, self.seeds, self.num_cells, self.double_hashing, modulo_to_buckets
+        )
+
+    # Cell indices of a (flow, state) pair, compute_hash_vals of its item key through the
+    # index cache
+    def item_indices(self, flow_id, state):
+        if self.index_cache is None:
+            return self.compute_item_indices((flow_id, state))
+        return self.index_cache.lookup((flow_id, state), self.compute_item_indices)
+
+    def compute_item_indices(self, item):
+        flow_id, state = item
+        return self.compute_hash_vals(f"{flow_id}_{state}")
+
+    def item_keys(self, flow_ids, states):
+        return [f"{flow_id}_{state}" for flow_id, state in zip(flow_ids, states)]
+
     # function that will track the time and remove the entries that are expired based on the 
     # phase_duration
     def handleDeletions(self):
         self.operations -= 1
+        self.advance_sweep(1)
         if self.operations == 0:
-            for i in range(0, self.size, 3):
-                if self.bit_array[i] == 0: 
-                    self.bit_array[i:i+3] = bitarray('000')
-                else: # reset just the flag timer 
-                    self.bit_array[i] = 0
-            self.operations = self.phase_duration
+            self.end_phase()
+
+    # Incremental aging: sweep the cells the cursor passes over during the next ops
+    # operations, cell c being aged right after operation c // sweep_budget + 1 of a phase
+    def advance_sweep(self, ops):
+        if self.incremental_aging:
+            stop = min(self.num_cells, self.sweep_cursor + ops * self.sweep_budget)
+            self.age_cells(self.sweep_cursor, stop)
+            self.sweep_cursor = stop
+
+    def end_phase(self):
+        if not self.incremental_aging:
+            self.age_cells()
+        self.operations = self.phase_duration
+        self.sweep_cursor = 0
+        self.phase += 1
+
+    def aging_status(self):
+        return {
+            "phase": self.phase,
+            "operations_left": self.operations,
+            "sweep_cursor": self.sweep_cursor,
+            "sweep_budget": self.sweep_budget if self.incremental_aging else self.num_cells,
+        }
+
+    def age_cells(self, start=0, stop=None):
+        stop = self.num_cells if stop is None else stop
+        for i in range(start * self.cell_bits, stop * self.cell_bits, self.cell_bits):
+            if self.bit_array[i] == 0: 
+                self.bit_array[i:i + self.cell_bits] = 0
+            else: # reset just the flag timer 
+                self.bit_array[i] = 0
 
 
     def getCounter(self, idx):
-        return (self.bit_array[(idx * 3 + 1) % self.size] << 1) | self.bit_array[(idx * 3 + 2) % self.size]
+        start = idx * self.cell_bits
+        return ba2int(self.bit_array[start + 1:start + self.cell_bits])
+
+    def setCounter(self, idx, counter):
+        start = idx * self.cell_bits
+        self.bit_array[start + 1:start + self.cell_bits] = int2ba(counter, length=self.counter_bits)
         
             
     def insert_entry(self, flow_id, state):
         # if state not in self.states:
         #     self.states.append(state)
-        item = f"{flow_id}_{state}"
-        for idx in (self.compute_hash_vals(item)):
+        for idx in (self.item_indices(flow_id, state)):
             # Set first bit as timer
-            self.bit_array[(idx * 3) % self.size] = 1
+            self.bit_array[idx * self.cell_bits] = 1
             # Get the current counter value
             counter = self.getCounter(idx)
-            # Increment the counter, and wrap around to 0 if it's currently 3 (11 in binary)
-            counter = min(3, counter + 1)
+            # Increment the counter, saturating at counter_max (3 for a 2-bit counter)
+            counter = min(self.counter_max, counter + 1)
             # Set the counter bits
-            self.bit_array[(idx * 3 + 1) % self.size] = (counter >> 1) & 1
-            self.bit_array[(idx * 3 + 2) % self.size] = counter & 1
+            self.setCounter(idx, counter)
         self.handleDeletions()
         
     
    
     def delete_entry(self, flow_id, oldstate):
-        item = f"{flow_id}_{oldstate}"
-        for idx in self.compute_hash_vals(item):
+        for idx in self.item_indices(flow_id, oldstate):
             # Get the current counter value
             counter = self.getCounter(idx)
             # Decrement the counter, and set it to 0 if it's currently 0
             counter = max(0, counter - 1)
             # Set the counter bits
-            self.bit_array[(idx * 3 + 1) % self.size] = (counter >> 1) & 1
-            self.bit_array[(idx * 3 + 2) % self.size] = counter & 1
+            self.setCounter(idx, counter)
         self.handleDeletions()
 
 
@@ -78,14 +170,15 @@ class DirectBloomFilter(object):
     
 
     def lookup_entry(self, flow_id, state):
+        if self.read_only:
+            return self.peek_entry(flow_id, state)
         # go through all the possible states and check if the flow_id is present
         # change to a set
         matches = [False for _ in range(self.hash_count)]
-        item = f"{flow_id}_{state}"
-        for i, idx  in enumerate(self.compute_hash_vals(item)):
-            if self.bit_array[(idx * 3) % self.size] == 0: #
-                self.bit_array[(idx * 3) % self.size] = 1
-            if not any(self.bit_array[(idx * 3 + 1 + j) % self.size] for j in range(2)):
+        for i, idx  in enumerate(self.item_indices(flow_id, state)):
+            if self.bit_array[idx * self.cell_bits] == 0: #
+                self.bit_array[idx * self.cell_bits] = 1
+            if not self.bit_array[idx * self.cell_bits + 1:(idx + 1) * self.cell_bits].any():
                 matches[i] = False
             else: 
                 matches[i] = True
@@ -94,51 +187,487 @@ class DirectBloomFilter(object):
             return state
         else:
             return None
+
+    # lookup_entry without side effects
+    def peek_entry(self, flow_id, state):
+        found = (self.cell_counters(np.asarray(self.item_indices(flow_id, state))) != 0).all()
+        return state if found else None
+
+    # State-agnostic lookup: which of candidate_states the flow is in, probing the k
+    # cells of every (flow, state) pair with one hash matrix and one vectorized read.
+    # Returns the state when exactly one candidate is found, "IDK" when several are and
+    # None otherwise. Only the cells of found candidates get their timer set, and the
+    # whole probe counts as a single operation towards the phase.
+    def lookup_any_state(self, flow_id, candidate_states):
+        candidate_states = list(candidate_states)
+        indices = self.compute_hash_matrix(self.item_keys([flow_id] * len(candidate_states), candidate_states))
+        found = (self.cell_counters(indices) != 0).all(axis=1)
+        if not self.read_only:
+            self.mark_cells(indices[found])
+            self.handleDeletions()
+        matches = np.flatnonzero(found)
+        if len(matches) == 0:
+            return None
+        if len(matches) > 1:
+            return "IDK"
+        return candidate_states[matches[0]]
+
+    # Counters of the cells at an array of indices, read straight from the bitarray's
+    # buffer: bit i of the (big-endian) bitarray is bit 7 - i % 8 of byte i // 8
+    def cell_counters(self, indices):
+        buffer = np.frombuffer(self.bit_array, dtype=np.uint8)
+        cells = indices.astype(np.intp) * self.cell_bits
+        counters = np.zeros(indices.shape, dtype=np.int64)
+        for bit in range(1, self.cell_bits):
+            i = cells + bit
+            counters = (counters << 1) | ((buffer[i >> 3] >> (7 - (i & 7))) & 1)
+        return counters
+
+    def mark_cells(self, indices):
+        for idx in indices.ravel().tolist():
+            self.bit_array[idx * self.cell_bits] = 1
     
     
   
-    # Print bits 3 at a time since each "cell" has 3 bits
+    def counters(self):
+        bits = np.frombuffer(self.bit_array.unpack(), dtype=np.uint8)[:self.size].reshape(-1, self.cell_bits)
+        return bits[:, 1:].astype(np.int64) @ (1 << np.arange(self.counter_bits - 1, -1, -1))
+
+    # Theoretical size is the cell_bits of every cell. A flow holds one count in each of
+    # its hash_count cells, so the counters give the number of flows, less whatever
+    # saturated cells lost.
+    def memory_report(self):
+        active_flows = int(self.counters().sum()) // self.hash_count
+        return build_memory_report(self.size, deep_sizeof(self), active_flows)
+
+    def snapshot_config(self):
+        return {
+            "num_cells": self.num_cells,
+            "hash_count": self.hash_count,
+            "phase_duration": self.phase_duration,
+            "double_hashing": self.double_hashing,
+            "incremental_aging": self.incremental_aging,
+            "sweep_budget": self.sweep_budget,
+            "counter_bits": self.counter_bits,
+        }
+
+    def snapshot_state(self):
+        return {"operations": self.operations, "sweep_cursor": self.sweep_cursor, "phase": self.phase, "seeds": self.seeds}
+
+    def snapshot_arrays(self):
+        return {"bits": np.frombuffer(self.bit_array, dtype=np.uint8)}
+
+    # The loaded bitarray is a view of the memory-mapped bytes, so it keeps their
+    # padding bits past size and cannot be resized
+    def restore(self, state, arrays):
+        self.__dict__.update(state)
+        self.bit_array = bitarray(buffer=arrays["bits"], endian="big")
+
+    # Print bits cell_bits at a time, one cell per line
     def print_bits(self):
         print("----------------------------------------------------------")
-        for i in range(0, self.size, 3):
-            chunk = self.bit_array[i:i+3]
+        for i in range(0, self.size, self.cell_bits):
+            chunk = self.bit_array[i:i + self.cell_bits]
             print("".join(map(str, chunk)))
         print("----------------------------------------------------------")
 
-# --------------------------------------------------------------------------------------------
-# --------------------------------- Test Functions -----------------------------------------
+# Storage of a cell_bits wide cell: two 4-bit cells share a byte, wider cells get a
+# whole uint8 or uint16 each
+CELL_DTYPES = {4: np.uint8, 8: np.uint8, 16: np.uint16}
+
+
+# Same filter as DirectBloomFilter, but each cell (timer flag + counter) is packed into
+# cell_bits of a NumPy array: a nibble, a byte or a uint16, with room for a counter of up
+# to cell_bits - 1 bits. A cell is read and written as a whole instead of bit by bit,
+# the phase sweep is a single array operation and the *_many methods apply a whole batch
+# of index rows at once.
+class PackedDirectBloomFilter(DirectBloomFilter):
+
+    def __init__(self, num_cells, hash_count, phase_duration=1000, double_hashing=False,
+                 incremental_aging=False, sweep_budget=None, cache_size=None, counter_bits=2, cell_bits=8):
+        if cell_bits not in CELL_DTYPES:
+            raise ValueError(f"cell_bits must be one of {sorted(CELL_DTYPES)}, got {cell_bits}")
+        if not 1 <= counter_bits < cell_bits:
+            raise ValueError(f"a {counter_bits}-bit counter and its timer bit do not fit in {cell_bits} bits")
+        self.storage_bits = cell_bits
+        super().__init__(num_cells, hash_count, phase_duration, double_hashing, incremental_aging,
+                         sweep_budget, cache_size, counter_bits)
+
+    def setup_cells(self):
+        if self.storage_bits == 4:
+            self.cells = np.zeros((self.num_cells + 1) // 2, dtype=np.uint8)
+        else:
+            self.cells = np.zeros(self.num_cells, dtype=CELL_DTYPES[self.storage_bits])
+
+    # Cells at an array (or scalar) of indices. With 4-bit cells, cell i is the low
+    # nibble of byte i // 2 for even i and the high nibble for odd i.
+    def read_cells(self, indices):
+        if self.storage_bits != 4:
+            return self.cells[indices]
+        return (self.cells[indices >> 1] >> ((indices & 1) << 2)) & 0xF
+
+    # Writes values to distinct cells. Two nibbles of one byte written in the same
+    # assignment would overwrite each other, so even and odd cells go one after another.
+    def write_cells(self, indices, values):
+        if self.storage_bits != 4:
+            self.cells[indices] = values
+            return
+        indices, values = np.atleast_1d(indices), np.atleast_1d(values)
+        for odd in (0, 1):
+            half = (indices & 1) == odd
+            shift = 4 * odd
+            bytes_ = indices[half] >> 1
+            self.cells[bytes_] = (self.cells[bytes_] & (0xF0 >> shift)) | (values[half] << shift)
+
+    # Clear every cell whose timer was not set during the phase and reset the timers:
+    # (cell >> counter_bits) * counter_max is the counter mask for timed cells and 0
+    # otherwise. For 4-bit cells it is done on both nibbles of a byte at once, & 0x11
+    # keeping the timer bits of the two cells.
+    def age_cells(self, start=0, stop=None):
+        stop = self.num_cells if stop is None else stop
+        if self.storage_bits != 4:
+            cells = self.cells[start:stop]
+            cells &= (cells >> self.counter_bits) * self.counter_max
+            return
+        # a nibble at either end of the range that shares its byte with a cell outside
+        # the range is aged on its own
+        if start & 1 and start < stop:
+            self.age_cell(start)
+            start += 1
+        if stop & 1 and start < stop:
+            self.age_cell(stop - 1)
+            stop -= 1
+        cells = self.cells[start // 2:stop // 2]
+        cells &= ((cells >> self.counter_bits) & 0x11) * self.counter_max
+
+    def snapshot_config(self):
+        return dict(super().snapshot_config(), cell_bits=self.storage_bits)
+
+    def snapshot_arrays(self):
+        return {"cells": self.cells}
+
+    def restore(self, state, arrays):
+        Snapshottable.restore(self, state, arrays)
+
+    def age_cell(self, idx):
+        cell = int(self.read_cells(idx))
+        self.write_cells(idx, cell & ((cell >> self.counter_bits) * self.counter_max))
 
+    def getCounter(self, idx):
+        return int(self.read_cells(idx)) & self.counter_max
 
+    def counters(self):
+        return self.read_cells(np.arange(self.num_cells)) & self.counter_max
 
-# Check accuracy of dbf # Joe's test function
-def test_dbf():
-    dbf = DirectBloomFilter(hash_count=4, num_cells=1000)
-    # insert 2 flows
-    dbf.insert_entry(1, "State 1") 
-    dbf.insert_entry(2, "State 8")
-    # lookup 2 flows
- 
-    assert dbf.lookup_entry(1, "State 1")  == "State 1"
-
-    assert dbf.lookup_entry(2, "State 8") == "State 8"
-    # modify flow 1
-    dbf.modify_entry(1, "State 2" , "State 2")
-    # lookup flow 1
-    assert dbf.lookup_entry(1, "State 2") == "State 2"
-    # delete flow 2
-    dbf.delete_entry(2, "State 8")
-    # lookup flow 2
-    assert dbf.lookup_entry(2, "State 8") == None
-    # insert flow 3
-    dbf.insert_entry(3, "State 3")
-    # lookup flow 3 2000 times
-    for _ in range(2004):
-        assert dbf.lookup_entry(3, "State 3") == "State 3"
-    # flow 1 should be deleted by now
-    assert dbf.lookup_entry(1, "State 2") == None
+    def cell_counters(self, indices):
+        return self.read_cells(indices) & self.counter_max
 
-    
-test_dbf()
+    def insert_entry(self, flow_id, state):
+        for idx in self.item_indices(flow_id, state):
+            counter = min(self.counter_max, self.getCounter(idx) + 1)
+            self.write_cells(idx, self.timer_bit | counter)
+        self.handleDeletions()
+
+    def delete_entry(self, flow_id, oldstate):
+        for idx in self.item_indices(flow_id, oldstate):
+            cell = int(self.read_cells(idx))
+            self.write_cells(idx, (cell & self.timer_bit) | max(0, (cell & self.counter_max) - 1))
+        self.handleDeletions()
+
+    def lookup_entry(self, flow_id, state):
+        if self.read_only:
+            return self.peek_entry(flow_id, state)
+        found = True
+        for idx in self.item_indices(flow_id, state):
+            cell = int(self.read_cells(idx))
+            self.write_cells(idx, cell | self.timer_bit)
+            if cell & self.counter_max == 0:
+                found = False
+        self.handleDeletions()
+        return state if found else None
+
+    # Batch operations, each row of the batch counts as one operation towards the
+    # phase. Rows are applied in slices that end on phase boundaries so cells are aged
+    # at exactly the same points as with one call per row.
+
+    def insert_many(self, flow_ids, states):
+        self.apply_phased(self.compute_hash_matrix(self.item_keys(flow_ids, states)), self.increment_cells)
+
+    def delete_many(self, flow_ids, oldstates):
+        self.apply_phased(self.compute_hash_matrix(self.item_keys(flow_ids, oldstates)), self.decrement_cells)
+
+    def lookup_many(self, flow_ids, states):
+        indices = self.compute_hash_matrix(self.item_keys(flow_ids, states))
+        if self.read_only:
+            found = (self.cell_counters(indices) != 0).all(axis=1).tolist()
+        else:
+            found = self.apply_phased(indices, self.mark_cells, read=True)
+        return [state if hit else None for state, hit in zip(states, found)]
+
+    # Applies update to the cells of an (n, k) index matrix, one row per operation. With
+    # incremental aging the sweep also advances during a slice, so each (row, cell) pair
+    # is split into the ones applied before the cursor passes the cell and the ones
+    # after. Updates of one kind commute, so applying the first group, sweeping, then
+    # the second gives the row-by-row result. With read=True it returns, per row,
+    # whether all its counters were non-zero at the time of that row's operation.
+    def apply_phased(self, indices, update, read=False):
+        results = []
+        start = 0
+        while start < len(indices):
+            stop = min(len(indices), start + self.operations)
+            chunk = indices[start:stop]
+            done = self.phase_duration - self.operations
+            if self.incremental_aging:
+                swept_after = chunk // self.sweep_budget + 1
+                ops = done + 1 + np.arange(len(chunk))[:, None]
+                after_sweep = (swept_after > done) & (swept_after < ops)
+            else:
+                after_sweep = np.zeros(chunk.shape, dtype=bool)
+            update(chunk[~after_sweep])
+            if read:
+                before = self.cell_counters(chunk)
+            self.advance_sweep(len(chunk))
+            update(chunk[after_sweep])
+            if read:
+                counters = np.where(after_sweep, self.cell_counters(chunk), before)
+                results.extend((counters != 0).all(axis=1).tolist())
+            self.operations -= len(chunk)
+            if self.operations == 0:
+                self.end_phase()
+            start = stop
+        return results
+
+    # Saturating increment/decrement: n hits on a cell move its counter by n, clamped
+    # to [0, counter_max], which is what n single steps would do
+    def increment_cells(self, indices):
+        cells, hits = np.unique(indices, return_counts=True)
+        counters = np.minimum(self.cell_counters(cells) + hits, self.counter_max)
+        self.write_cells(cells, self.timer_bit | counters)
+
+    def decrement_cells(self, indices):
+        cells, hits = np.unique(indices, return_counts=True)
+        current = self.read_cells(cells)
+        counters = np.maximum((current & self.counter_max).astype(np.int64) - hits, 0)
+        self.write_cells(cells, (current & self.timer_bit) | counters)
+
+    def mark_cells(self, indices):
+        cells = np.unique(indices)
+        self.write_cells(cells, self.read_cells(cells) | self.timer_bit)
+
+    def print_bits(self):
+        print("----------------------------------------------------------")
+        for cell in self.read_cells(np.arange(self.num_cells)):
+            print(format(int(cell), f"0{self.cell_bits}b"))
+        print("----------------------------------------------------------")
+
+# --------------------------------------------------------------------------------------------
+# --------------------------------- Test Functions -----------------------------------------
+
+
+class TestDirectBloomFilter(unittest.TestCase):
+
+    # Check accuracy of dbf # Joe's test function
+    def test_dbf(self):
+        dbf = DirectBloomFilter(hash_count=4, num_cells=1000)
+        # insert 2 flows
+        dbf.insert_entry(1, "State 1")
+        dbf.insert_entry(2, "State 8")
+        # lookup 2 flows
+        self.assertEqual(dbf.lookup_entry(1, "State 1"), "State 1")
+        self.assertEqual(dbf.lookup_entry(2, "State 8"), "State 8")
+        # modify flow 1
+        dbf.modify_entry(1, "State 2", "State 2")
+        # lookup flow 1
+        self.assertEqual(dbf.lookup_entry(1, "State 2"), "State 2")
+        # delete flow 2
+        dbf.delete_entry(2, "State 8")
+        # lookup flow 2
+        self.assertIsNone(dbf.lookup_entry(2, "State 8"))
+        # insert flow 3
+        dbf.insert_entry(3, "State 3")
+        # lookup flow 3 2000 times
+        for _ in range(2004):
+            self.assertEqual(dbf.lookup_entry(3, "State 3"), "State 3")
+        # flow 1 should be deleted by now
+        self.assertIsNone(dbf.lookup_entry(1, "State 2"))
+
+    # Same scenario for the packed cell layout
+    def test_packed_dbf(self):
+        dbf = PackedDirectBloomFilter(hash_count=4, num_cells=1000)
+        dbf.insert_entry(1, "State 1")
+        dbf.insert_entry(2, "State 8")
+        self.assertEqual(dbf.lookup_entry(1, "State 1"), "State 1")
+        self.assertEqual(dbf.lookup_entry(2, "State 8"), "State 8")
+        dbf.modify_entry(1, "State 2", "State 2")
+        self.assertEqual(dbf.lookup_entry(1, "State 2"), "State 2")
+        dbf.delete_entry(2, "State 8")
+        self.assertIsNone(dbf.lookup_entry(2, "State 8"))
+        dbf.insert_entry(3, "State 3")
+        for _ in range(2004):
+            self.assertEqual(dbf.lookup_entry(3, "State 3"), "State 3")
+        self.assertIsNone(dbf.lookup_entry(1, "State 2"))
+
+    # The packed engine has to agree with the bitarray one cell for cell, sweeps included,
+    # and the batch methods with a row-at-a-time replay
+    def check_packed_matches_bitarray(self, incremental_aging=False, counter_bits=2, cell_bits=8, num_cells=300):
+        rng = np.random.default_rng(0)
+        flows = rng.integers(0, 200, 1500).tolist()
+        states = rng.integers(1, 4, 1500).tolist()
+        config = dict(hash_count=3, num_cells=num_cells, phase_duration=97, incremental_aging=incremental_aging,
+                      counter_bits=counter_bits)
+        bits = DirectBloomFilter(**config)
+        packed = PackedDirectBloomFilter(cell_bits=cell_bits, **config)
+        batch = PackedDirectBloomFilter(cell_bits=cell_bits, **config)
+        for start in range(0, 1500, 250):
+            chunk = slice(start, start + 250)
+            op = (start // 250) % 3
+            for flow, state in zip(flows[chunk], states[chunk]):
+                if op == 0:
+                    bits.insert_entry(flow, state)
+                    packed.insert_entry(flow, state)
+                elif op == 1:
+                    self.assertEqual(bits.lookup_entry(flow, state), packed.lookup_entry(flow, state))
+                else:
+                    bits.delete_entry(flow, state)
+                    packed.delete_entry(flow, state)
+            if op == 0:
+                batch.insert_many(flows[chunk], states[chunk])
+            elif op == 1:
+                batch.lookup_many(flows[chunk], states[chunk])
+            else:
+                batch.delete_many(flows[chunk], states[chunk])
+            cells = [(bits.bit_array[idx * bits.cell_bits] << counter_bits) | bits.getCounter(idx)
+                     for idx in range(num_cells)]
+            self.assertEqual(packed.read_cells(np.arange(num_cells)).tolist(), cells)
+            self.assertEqual(batch.read_cells(np.arange(num_cells)).tolist(), cells)
+        self.assertEqual(batch.aging_status(), packed.aging_status())
+        self.assertEqual(packed.aging_status(), bits.aging_status())
+        self.assertEqual(batch.lookup_many(flows[:50], states[:50]),
+                         [packed.lookup_entry(f, s) for f, s in zip(flows[:50], states[:50])])
+
+    def test_packed_dbf_matches_bitarray(self):
+        self.check_packed_matches_bitarray()
+
+    def test_incremental_aging_matches_bitarray(self):
+        self.check_packed_matches_bitarray(incremental_aging=True)
+
+    # Every storage layout against the bitarray cells of the same counter width, including
+    # an odd number of 4-bit cells so the last byte is half used
+    def test_cell_widths(self):
+        for counter_bits, cell_bits in ((1, 4), (3, 4), (2, 8), (5, 8), (7, 8), (9, 16)):
+            for incremental_aging in (False, True):
+                with self.subTest(counter_bits=counter_bits, cell_bits=cell_bits, incremental_aging=incremental_aging):
+                    self.check_packed_matches_bitarray(incremental_aging, counter_bits, cell_bits, num_cells=301)
+        dbf = PackedDirectBloomFilter(num_cells=7, hash_count=1, counter_bits=3, cell_bits=4)
+        self.assertEqual(dbf.cells.nbytes, 4)
+        for _ in range(10):
+            dbf.increment_cells(np.arange(7))
+        self.assertEqual(dbf.counters().tolist(), [7] * 7)
+        dbf.age_cells(1, 6)
+        dbf.age_cells(1, 6)
+        self.assertEqual(dbf.read_cells(np.arange(7)).tolist(), [15, 0, 0, 0, 0, 0, 15])
+        for counter_bits, cell_bits in ((3, 3), (4, 4), (8, 8), (0, 8)):
+            with self.assertRaises(ValueError):
+                PackedDirectBloomFilter(num_cells=10, hash_count=1, counter_bits=counter_bits, cell_bits=cell_bits)
+        with self.assertRaises(ValueError):
+            DirectBloomFilter(num_cells=10, hash_count=1, counter_bits=0)
+
+    # Each phase sweeps every cell exactly once, sweep_budget cells per operation, and an
+    # entry nobody touches is gone within two phases just like with the full sweep
+    def test_incremental_aging(self):
+        dbf = PackedDirectBloomFilter(hash_count=3, num_cells=1000, phase_duration=300, incremental_aging=True)
+        self.assertEqual(dbf.sweep_budget, 4)
+        dbf.insert_entry(1, "State 1")
+        for op in range(2, 301):
+            dbf.lookup_entry(2, "State 2")
+            self.assertEqual(dbf.sweep_cursor, min(1000, op * 4) if op < 300 else 0)
+        self.assertEqual(dbf.aging_status(), {"phase": 1, "operations_left": 300, "sweep_cursor": 0, "sweep_budget": 4})
+        self.assertEqual(dbf.lookup_entry(1, "State 1"), "State 1")
+        for _ in range(600):
+            dbf.lookup_entry(2, "State 2")
+        self.assertIsNone(dbf.lookup_entry(1, "State 1"))
+        # a budget that cannot cover the table in one phase must be rejected
+        with self.assertRaises(ValueError):
+            DirectBloomFilter(hash_count=3, num_cells=1000, phase_duration=300, incremental_aging=True, sweep_budget=3)
+
+    def test_dbf_hash_matrix(self):
+        for double_hashing in (False, True):
+            dbf = DirectBloomFilter(hash_count=3, num_cells=1000, double_hashing=double_hashing)
+            items = dbf.item_keys([1, 2, 3], ["State 1", "State 2", "State 3"])
+            matrix = dbf.compute_hash_matrix(items)
+            self.assertEqual(matrix.shape, (3, 3))
+            for row, item in zip(matrix.tolist(), items):
+                self.assertEqual(row, dbf.compute_hash_vals(item))
+
+    def test_lookup_any_state(self):
+        states = list(range(1, 11))
+        for filter_class in (DirectBloomFilter, PackedDirectBloomFilter):
+            dbf = filter_class(num_cells=20000, hash_count=3, phase_duration=100000)
+            reference = filter_class(num_cells=20000, hash_count=3, phase_duration=100000)
+            for flow in range(50):
+                for filter in (dbf, reference):
+                    filter.insert_entry(flow, flow % 10 + 1)
+            for flow in range(60):
+                hits = [state for state in states if reference.lookup_entry(flow, state) is not None]
+                expected = None if not hits else hits[0] if len(hits) == 1 else "IDK"
+                self.assertEqual(dbf.lookup_any_state(flow, states), expected)
+            # a flow inserted under two states is ambiguous
+            dbf.insert_entry(0, 5)
+            self.assertEqual(dbf.lookup_any_state(0, states), "IDK")
+            self.assertEqual(dbf.lookup_any_state(0, [1, 2]), 1)
+            self.assertIsNone(dbf.lookup_any_state(0, []))
+            # counters are read the same way as getCounter
+            indices = np.arange(dbf.num_cells)
+            self.assertEqual(dbf.cell_counters(indices).tolist(), [dbf.getCounter(i) for i in range(dbf.num_cells)])
+
+    def test_index_cache(self):
+        for filter_class in (DirectBloomFilter, PackedDirectBloomFilter):
+            cached = filter_class(num_cells=3000, hash_count=3, phase_duration=500, cache_size=100)
+            plain = filter_class(num_cells=3000, hash_count=3, phase_duration=500)
+            for op in range(3000):
+                flow, state = op % 150, op % 4
+                for dbf in (cached, plain):
+                    if op % 3 == 0:
+                        dbf.insert_entry(flow, state)
+                    elif op % 3 == 1:
+                        dbf.delete_entry(flow, state)
+                self.assertEqual(cached.lookup_entry(flow, state), plain.lookup_entry(flow, state))
+            self.assertEqual(cached.getCounter(0), plain.getCounter(0))
+            self.assertEqual(len(cached.index_cache), 100)
+            self.assertGreater(cached.index_cache.hit_rate(), 0)
+
+    def test_snapshot(self):
+        rng = np.random.default_rng(3)
+        flows = rng.integers(0, 300, 3000).tolist()
+        states = rng.integers(1, 5, 3000).tolist()
+        layouts = [
+            (DirectBloomFilter, dict(counter_bits=3)),
+            (DirectBloomFilter, dict(incremental_aging=True)),
+            (PackedDirectBloomFilter, dict(cell_bits=4)),
+            (PackedDirectBloomFilter, dict(counter_bits=5, incremental_aging=True)),
+        ]
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, "dbf.snapshot")
+            for filter_class, args in layouts:
+                # 301 cells leaves padding bits after the last bitarray cell
+                dbf = filter_class(num_cells=301, hash_count=3, phase_duration=700, **args)
+                for flow, state in zip(flows[:1300], states[:1300]):
+                    dbf.insert_entry(flow, state)
+                dbf.save(path)
+                loaded = filter_class.load(path)
+                self.assertEqual(loaded.aging_status(), dbf.aging_status())
+                # both carry on in step, through phase ends
+                for i, (flow, state) in enumerate(zip(flows[1300:], states[1300:])):
+                    for f in (dbf, loaded):
+                        if i % 3 == 2:
+                            f.delete_entry(flow, state)
+                        else:
+                            f.insert_entry(flow, state)
+                    self.assertEqual(loaded.lookup_entry(flow, state), dbf.lookup_entry(flow, state))
+                self.assertTrue((loaded.counters() == dbf.counters()).all())
+                self.assertEqual(loaded.aging_status(), dbf.aging_status())
+                # copy-on-write by default, the snapshot still holds the saved table
+                self.assertEqual(filter_class.load(path, mode="r").aging_status()["phase"], 1)
 
 
 
@@ -300,3 +829,5 @@ test_dbf()
 # test_dbf()
 
 
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+
+from direct_bloom_filter import DirectBloomFilter, PackedDirectBloomFilter
+from fingerprint_compressed_filter import FCF, ArrayFCF
+from packet_generator import STATES
+from stateful_bloom_filter import ArrayStatefulBloomFilter, StatefulBloomFilter
+
+# States of the generated workloads, what a keyed filter is probed with on a lookup
+WORKLOAD_STATES = STATES
+
+# Filters a driver can be built around, by name, as (num_cells, hash_count) -> filter
+FILTERS = {
+    "sbf": lambda cells, k: StatefulBloomFilter(hash_count=k, num_cells=cells),
+    "array-sbf": lambda cells, k: ArrayStatefulBloomFilter(hash_count=k, num_cells=cells, states=WORKLOAD_STATES),
+    "dbf": lambda cells, k: DirectBloomFilter(cells, k),
+    "packed-dbf": lambda cells, k: PackedDirectBloomFilter(cells, k),
+    "fcf": lambda cells, k: FCF(k, cells - cells % k, 6, 10),
+    "array-fcf": lambda cells, k: ArrayFCF(k, cells - cells % k, 6, 10, states=WORKLOAD_STATES),
+}
+
+
+class FilterDriver:
+    # Feeds packets to a filter the way otter-fcf does: the first transition of a flow
+    # inserts its new state, later ones modify it. The filters that key cells by (flow,
+    # state) pairs, the DBFs, need the flow's current state to modify it and are looked
+    # up by probing every one of states. The current state of the last max_flows flows
+    # is kept for this, the least recently active flow going first.
+
+    def __init__(self, filter, states=WORKLOAD_STATES, max_flows=1 << 20):
+        self.filter = filter
+        self.states = list(states)
+        self.keyed = isinstance(filter, DirectBloomFilter)
+        self.max_flows = max_flows
+        self.current = OrderedDict()
+
+    def apply(self, flow_ids, states_from, states_to):
+        # One batch of packets as arrays, -1 marking packets without a transition.
+        # Returns the number of transitions applied.
+        transitions = np.flatnonzero((np.asarray(states_from) != -1) & (np.asarray(states_to) != -1))
+        flow_ids = np.asarray(flow_ids)[transitions].tolist()
+        new_states = np.asarray(states_to)[transitions].tolist()
+        for flow, state in zip(flow_ids, new_states):
+            old = self.current.pop(flow, None)
+            if old is None:
+                self.filter.insert_entry(flow, state)
+            elif self.keyed:
+                self.filter.modify_entry(flow, old, state)
+            else:
+                self.filter.modify_entry(flow, state)
+            self.current[flow] = state
+            if len(self.current) > self.max_flows:
+                self.current.popitem(last=False)
+        return len(transitions)
+
+    def lookup(self, flow_ids):
+        flow_ids = [int(flow) for flow in flow_ids]
+        if self.keyed:
+            return [self.filter.lookup_any_state(flow, self.states) for flow in flow_ids]
+        if hasattr(self.filter, "lookup_many"):
+            return self.filter.lookup_many(flow_ids)
+        return [self.filter.lookup_entry(flow) for flow in flow_ids]
+
+
+class TestFilterDriver(unittest.TestCase):
+
+    def test_drives_every_filter(self):
+        flow_ids = np.array([1, 2, 1, 3, 2, 1])
+        states_from = np.array([1, -1, 2, 4, 1, -1])
+        states_to = np.array([2, -1, 3, 5, 2, -1])
+        for name, make_filter in FILTERS.items():
+            driver = FilterDriver(make_filter(3000, 3))
+            self.assertEqual(driver.apply(flow_ids, states_from, states_to), 4)
+            results = driver.lookup([1, 2, 3, 4])
+            self.assertEqual(results[1:], [2, 5, None], name)
+            # the SBF cells of a modified flow go DK
+            self.assertIn(results[0], (3, "IDK"), name)
+            # the last step of an interesting flow
+            driver.apply([7], [10], [11])
+            self.assertEqual(driver.lookup([7]), [11], name)
+
+    def test_bounded_flow_states(self):
+        driver = FilterDriver(PackedDirectBloomFilter(3000, 3), max_flows=2)
+        driver.apply([1, 2, 3], [1, 1, 1], [2, 2, 2])
+        driver.apply([2], [2], [3])
+        self.assertEqual(list(driver.current.items()), [(3, 2), (2, 3)])
+        self.assertEqual(driver.lookup([2]), [3])
+
+
+if __name__ == "__main__":
+    unittest.main()
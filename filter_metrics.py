@@ -0,0 +1,372 @@
+"""
+Opt-in instrumentation of the filters. enable_metrics(filter) wraps the hot-path
+methods of that one filter on the instance, its class is left alone, to count
+operations, hash evaluations and cells probed and to time operations and deletion
+handling. A filter without metrics runs exactly the code it always did, and disable()
+takes the wrappers off again. What describes the table rather than the traffic (bucket
+occupancy, saturated counters, DK cells, ...) is read from it when a snapshot is taken
+instead of being kept up to date on every operation.
+
+    metrics = enable_metrics(filter)
+    ... run the workload ...
+    metrics.export("metrics.jsonl", config="small")   # one JSON line per call
+"""
+import json
+import os
+import tempfile
+import time
+import unittest
+from collections import Counter
+
+import numpy as np
+
+from direct_bloom_filter import DirectBloomFilter, PackedDirectBloomFilter
+from fingerprint_compressed_filter import FCF, ArrayFCF
+from state_codebook import DK, EMPTY
+from stateful_bloom_filter import MAX_REFCOUNT, ArrayStatefulBloomFilter, DontKnow, StatefulBloomFilter
+
+# Single operations, and batch operations that count one operation per row. An
+# operation called from another (a DBF modify is a delete and an insert) is part of it.
+OPERATIONS = ("insert_entry", "modify_entry", "lookup_entry", "delete_entry", "lookup_any_state")
+BATCH_OPERATIONS = ("insert_many", "modify_many", "lookup_many", "delete_many")
+# Deletion handling, timed on every call whether or not an operation is under way
+MAINTENANCE = ("handleDeletions", "handle_deletions", "end_phase", "end_window", "sweep")
+
+
+def bloom_hashes(filter):
+    # hash evaluations behind one set of bloom filter indices
+    return 1 if filter.double_hashing else len(filter.seeds)
+
+
+# method -> [(counter, amount(filter, args, result))] added up on every call. Hashing
+# methods count hash evaluations, index methods the cells of the table an operation
+# probes (for the FCFs, every cell of every candidate bucket). An index cache hit skips
+# the hashing but not the probing.
+COUNTED = {
+    "compute_hash_vals": [("hash_calls", lambda filter, args, result: bloom_hashes(filter))],
+    "compute_hash_matrix": [
+        ("hash_calls", lambda filter, args, result: len(args[0]) * bloom_hashes(filter)),
+        ("cells_probed", lambda filter, args, result: result.size),
+    ],
+    "flow_indices": [("cells_probed", lambda filter, args, result: len(result))],
+    "item_indices": [("cells_probed", lambda filter, args, result: len(result))],
+    # the hash_fns bucket hashes and the fingerprint
+    "compute_location": [("hash_calls", lambda filter, args, result: len(filter.hash_fns) + 1)],
+    "hash_location": [("cells_probed", lambda filter, args, result: len(result[0]) * filter.cells_per_bucket)],
+}
+
+
+class TimingHistogram:
+    # Durations in power-of-two buckets, bucket b counting the ones of [2**(b-1), 2**b)
+    # nanoseconds, so recording one is an int.bit_length() and an increment
+
+    def __init__(self):
+        self.buckets = [0] * 65
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, ns):
+        self.buckets[ns.bit_length()] += 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def percentile(self, q):
+        # upper bound of the bucket holding the q-th percentile, in nanoseconds
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(1 << bucket, self.max_ns)
+        return 0
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "total_seconds": self.total_ns / 1e9,
+            "mean_us": self.total_ns / self.count / 1e3 if self.count else None,
+            "p50_us": self.percentile(50) / 1e3 if self.count else None,
+            "p99_us": self.percentile(99) / 1e3 if self.count else None,
+            "max_us": self.max_ns / 1e3 if self.count else None,
+            "log2_ns_buckets": {bucket: count for bucket, count in enumerate(self.buckets) if count},
+        }
+
+
+def stateful_gauges(filter):
+    states = [cell.state for cell in filter.store]
+    return {
+        "cells": len(states),
+        "occupied_cells": sum(state is not None for state in states),
+        "dk_cells": sum(isinstance(state, DontKnow) for state in states),
+    }
+
+
+def array_stateful_gauges(filter):
+    return {
+        "cells": len(filter.state),
+        "occupied_cells": int(np.count_nonzero(filter.state != EMPTY)),
+        "dk_cells": int(np.count_nonzero(filter.state == DK)),
+        "saturated_refcounts": int(np.count_nonzero(filter.refcount == MAX_REFCOUNT)),
+    }
+
+
+def dbf_gauges(filter):
+    counters = filter.counters()
+    return {
+        "cells": len(counters),
+        "nonzero_cells": int(np.count_nonzero(counters)),
+        "saturated_counters": int(np.count_nonzero(counters == filter.counter_max)),
+        **filter.aging_status(),
+    }
+
+
+def fcf_gauges(filter):
+    occupancy = [len(bucket) for subtable in filter.table for bucket in subtable]
+    return {
+        "entries": sum(occupancy),
+        "bucket_occupancy": np.bincount(occupancy, minlength=filter.cells_per_bucket + 1).tolist(),
+    }
+
+
+def array_fcf_gauges(filter):
+    return {
+        "entries": int(np.count_nonzero(filter.live_entries())) + filter.stash_count,
+        # slots in use, expired entries not reclaimed yet included
+        "bucket_occupancy": np.bincount(filter.occupancy.ravel(), minlength=filter.cells_per_bucket + 1).tolist(),
+        "load_factor": filter.load_factor(),
+        "stash_count": filter.stash_count,
+        "overflows": filter.overflows,
+        "kicks": filter.kicks,
+    }
+
+
+# Table gauges of each filter class, the first class of a filter's MRO found here applies
+GAUGES = {
+    StatefulBloomFilter: stateful_gauges,
+    ArrayStatefulBloomFilter: array_stateful_gauges,
+    DirectBloomFilter: dbf_gauges,
+    FCF: fcf_gauges,
+    ArrayFCF: array_fcf_gauges,
+}
+
+
+def table_gauges(filter):
+    for cls in type(filter).__mro__:
+        if cls in GAUGES:
+            gauges = GAUGES[cls](filter)
+            break
+    else:
+        gauges = {}
+    if getattr(filter, "index_cache", None) is not None:
+        gauges["index_cache"] = filter.index_cache.stats()
+    return gauges
+
+
+class FilterMetrics:
+    # The counters and timings of one filter. With timing=False only the counters are
+    # kept, which saves the two clock reads per call.
+
+    def __init__(self, filter, timing=True):
+        if any(name in vars(filter) for name in OPERATIONS + BATCH_OPERATIONS):
+            raise ValueError(f"this {type(filter).__name__} already has metrics enabled")
+        self.filter = filter
+        self.timing = timing
+        self.depth = 0
+        self.wrapped = []
+        self.reset()
+        for name in OPERATIONS + BATCH_OPERATIONS:
+            if hasattr(filter, name):
+                self.wrap(name, self.operation(name, getattr(filter, name), name in BATCH_OPERATIONS))
+        for name in MAINTENANCE:
+            if hasattr(filter, name) and timing:
+                self.wrap(name, self.timed(name, getattr(filter, name)))
+        for name, counters in COUNTED.items():
+            if hasattr(filter, name):
+                self.wrap(name, self.counted(getattr(filter, name), counters))
+
+    def wrap(self, name, wrapper):
+        # plain functions in the instance __dict__, which deep_sizeof leaves out of
+        # memory_report
+        setattr(self.filter, name, wrapper)
+        self.wrapped.append(name)
+
+    def operation(self, name, method, batch):
+        ops = self.ops
+        def wrapper(*args, **kwargs):
+            if self.depth:
+                return method(*args, **kwargs)
+            self.depth = 1
+            start = time.perf_counter_ns() if self.timing else 0
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.depth = 0
+                if self.timing:
+                    self.timings[name].record(time.perf_counter_ns() - start)
+                ops[name] += len(args[0]) if batch else 1
+        return wrapper
+
+    def timed(self, name, method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.timings[name].record(time.perf_counter_ns() - start)
+        return wrapper
+
+    def counted(self, method, counters):
+        filter, counts = self.filter, self.counts
+        def wrapper(*args, **kwargs):
+            result = method(*args, **kwargs)
+            for counter, amount in counters:
+                counts[counter] += amount(filter, args, result)
+            return result
+        return wrapper
+
+    def reset(self):
+        # Clears the counters and timings; the wrappers hold on to these objects
+        if hasattr(self, "ops"):
+            self.ops.clear()
+            self.counts.clear()
+            for histogram in self.timings.values():
+                histogram.__init__()
+        else:
+            self.ops = Counter()
+            self.counts = Counter()
+            self.timings = {name: TimingHistogram() for name in OPERATIONS + BATCH_OPERATIONS + MAINTENANCE}
+
+    def disable(self):
+        for name in self.wrapped:
+            delattr(self.filter, name)
+        self.wrapped = []
+
+    def snapshot(self):
+        total_ops = sum(self.ops.values())
+        return {
+            "filter": type(self.filter).__name__,
+            "operations": dict(self.ops),
+            "hash_calls": self.counts["hash_calls"],
+            "cells_probed": self.counts["cells_probed"],
+            "hash_calls_per_op": self.counts["hash_calls"] / total_ops if total_ops else None,
+            "cells_probed_per_op": self.counts["cells_probed"] / total_ops if total_ops else None,
+            "timings": {name: histogram.stats() for name, histogram in self.timings.items() if histogram.count},
+            "gauges": table_gauges(self.filter),
+        }
+
+    def export(self, path, **labels):
+        # Appends the snapshot, with the wall clock time and labels, as one JSON line
+        record = {"time": time.time(), **labels, **self.snapshot()}
+        with open(path, "a") as out:
+            out.write(json.dumps(record, default=str) + "\n")
+        return record
+
+
+def enable_metrics(filter, timing=True):
+    return FilterMetrics(filter, timing=timing)
+
+
+class TestFilterMetrics(unittest.TestCase):
+
+    def test_counts(self):
+        filter = ArrayStatefulBloomFilter(hash_count=3, num_cells=500, states=range(5))
+        metrics = enable_metrics(filter)
+        for flow in range(10):
+            filter.insert_entry(flow, flow % 5)
+        for flow in range(10):
+            self.assertEqual(filter.lookup_entry(flow), flow % 5)
+        filter.lookup_many(list(range(4)))
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["operations"], {"insert_entry": 10, "lookup_entry": 10, "lookup_many": 4})
+        self.assertEqual((snapshot["hash_calls"], snapshot["cells_probed"]), (72, 72))
+        self.assertEqual(snapshot["cells_probed_per_op"], 3)
+        self.assertEqual(snapshot["timings"]["insert_entry"]["count"], 10)
+        self.assertEqual(snapshot["gauges"]["occupied_cells"], np.count_nonzero(filter.state))
+
+        # cache hits probe cells without hashing
+        cached = ArrayFCF(3, 300, 4, 12, states=range(5), cache_size=100)
+        metrics = enable_metrics(cached, timing=False)
+        for _ in range(3):
+            cached.insert_entry(7, 1)
+        snapshot = metrics.snapshot()
+        self.assertEqual((snapshot["hash_calls"], snapshot["cells_probed"]), (4, 3 * 3 * 4))
+        self.assertEqual(snapshot["timings"], {})
+        self.assertEqual(snapshot["gauges"]["bucket_occupancy"][:2], [297, 3])
+        self.assertEqual(snapshot["gauges"]["index_cache"]["hits"], 2)
+
+    def test_nested_operations_and_maintenance(self):
+        filter = DirectBloomFilter(num_cells=200, hash_count=3, phase_duration=10)
+        metrics = enable_metrics(filter)
+        for flow in range(12):
+            filter.insert_entry(flow, 1)
+        for flow in range(4):
+            filter.modify_entry(flow, 1, 2)
+        snapshot = metrics.snapshot()
+        # a modify is one operation, probing the cells of both states
+        self.assertEqual(snapshot["operations"], {"insert_entry": 12, "modify_entry": 4})
+        self.assertEqual(snapshot["cells_probed"], 12 * 3 + 4 * 6)
+        self.assertEqual(snapshot["timings"]["handleDeletions"]["count"], 20)
+        self.assertEqual(snapshot["timings"]["end_phase"]["count"], 2)
+
+        packed = PackedDirectBloomFilter(num_cells=200, hash_count=3, counter_bits=2, cell_bits=4)
+        metrics = enable_metrics(packed)
+        for _ in range(5):
+            packed.insert_entry(1, 1)
+        self.assertEqual(metrics.snapshot()["gauges"]["saturated_counters"], np.count_nonzero(packed.counters() == 3))
+        self.assertGreater(metrics.snapshot()["gauges"]["saturated_counters"], 0)
+
+    def test_gauges(self):
+        filter = StatefulBloomFilter(hash_count=3, num_cells=20)
+        metrics = enable_metrics(filter)
+        for flow in range(30):
+            filter.insert_entry(flow, flow)
+        gauges = metrics.snapshot()["gauges"]
+        self.assertEqual(gauges["dk_cells"], sum(isinstance(cell.state, DontKnow) for cell in filter.store))
+        self.assertGreater(gauges["dk_cells"], 0)
+
+        fcf = FCF(3, 300, 4, 12, deletion_window=5)
+        metrics = enable_metrics(fcf)
+        for flow in range(12):
+            fcf.insert_entry(flow, 1)
+        snapshot = metrics.snapshot()
+        # entries not accessed for a deletion window are gone
+        self.assertEqual(snapshot["gauges"]["entries"], fcf.memory_report()["active_flows"])
+        self.assertLess(snapshot["gauges"]["entries"], 12)
+        self.assertEqual(sum(snapshot["gauges"]["bucket_occupancy"]), 300)
+        self.assertEqual(snapshot["timings"]["handle_deletions"]["count"], 12)
+
+    def test_disable_and_export(self):
+        filter = ArrayFCF(3, 300, 4, 12, states=range(5), lazy_expiry=True, deletion_window=50)
+        plain = ArrayFCF(3, 300, 4, 12, states=range(5), lazy_expiry=True, deletion_window=50)
+        metrics = enable_metrics(filter)
+        with self.assertRaises(ValueError):
+            enable_metrics(filter)
+        for flow in range(200):
+            for target in (filter, plain):
+                target.insert_entry(flow % 40, flow % 5)
+                target.lookup_entry(flow % 7)
+        self.assertEqual(filter.lookup_many(list(range(50))), plain.lookup_many(list(range(50))))
+        np.testing.assert_array_equal(filter.fingerprints, plain.fingerprints)
+        metrics.disable()
+        self.assertFalse(any(name in vars(filter) for name in OPERATIONS + MAINTENANCE + tuple(COUNTED)))
+        filter.insert_entry(1, 1)
+        self.assertEqual(metrics.snapshot()["operations"]["insert_entry"], 200)
+
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, "metrics.jsonl")
+            metrics.export(path, config="small")
+            metrics.reset()
+            metrics.export(path, config="small")
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual([record["config"] for record in records], ["small", "small"])
+        self.assertEqual(records[0]["operations"]["lookup_many"], 50)
+        self.assertEqual(records[1]["operations"], {})
+        self.assertGreater(records[0]["timings"]["sweep"]["count"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
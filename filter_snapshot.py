@@ -0,0 +1,226 @@
+"""
+Flat binary snapshots of filter state, so a restarted process can pick up every flow's
+state instead of relearning it. A snapshot file is a 64 byte header, a JSON description
+and the filter's arrays back to back:
+
+    header      magic, version, length of the JSON description
+    JSON        {"kind": class name, "config": constructor arguments,
+                 "state": counters and seeds, "arrays": [{name, dtype, shape, offset}]}
+    arrays      raw array data, each starting on a 64 byte boundary
+
+The arrays are opened with numpy.memmap, so restoring a filter costs the same however
+large its table is: pages are read in from the page cache as the filter touches them.
+"""
+import json
+import os
+import random
+import struct
+import tempfile
+import unittest
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+MAGIC = b"FLTSNAP\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIQ")
+HEADER_SIZE = 64
+ALIGNMENT = 64
+
+# Types a state may have to be kept in a snapshot's JSON description
+JSON_SCALARS = (str, int, float, bool, type(None))
+
+
+def aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def array_layout(arrays):
+    # Where each of arrays (name -> ndarray) goes when they are laid out back to back,
+    # as [{name, dtype, shape, offset}], and the total size
+    layout = []
+    offset = 0
+    for name, array in arrays.items():
+        layout.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        offset = aligned(offset + array.nbytes)
+    return layout, offset
+
+
+def write_snapshot(path, kind, config, state, arrays):
+    # arrays: name -> ndarray. The file is written next to path and moved over it once
+    # complete, so a crash mid-save leaves the previous snapshot in place.
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout, offset = array_layout(arrays)
+    description = json.dumps({"kind": kind, "config": config, "state": state, "arrays": layout}).encode()
+    data_start = aligned(HEADER_SIZE + len(description))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, scratch = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(HEADER.pack(MAGIC, VERSION, len(description)).ljust(HEADER_SIZE, b"\0"))
+            out.write(description)
+            for entry, array in zip(layout, arrays.values()):
+                out.seek(data_start + entry["offset"])
+                out.write(array.tobytes())
+            out.truncate(data_start + offset)
+        os.replace(scratch, path)
+    except BaseException:
+        os.unlink(scratch)
+        raise
+
+
+def read_snapshot(path, kind, mode="c"):
+    # (config, state, arrays) of a snapshot of a kind filter, the arrays memory-mapped
+    # with the numpy.memmap mode: "c" copy-on-write, "r" read-only or "r+" writing
+    # through to the file
+    with open(path, "rb") as f:
+        magic, version, description_size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} filter snapshot")
+        f.seek(HEADER_SIZE)
+        description = json.loads(f.read(description_size))
+    if description["kind"] != kind:
+        raise ValueError(f"{path} holds a {description['kind']}, not a {kind}")
+    data_start = aligned(HEADER_SIZE + description_size)
+    arrays = {}
+    for entry in description["arrays"]:
+        shape = tuple(entry["shape"])
+        if np.prod(shape) == 0:
+            arrays[entry["name"]] = np.empty(shape, dtype=entry["dtype"])
+        else:
+            arrays[entry["name"]] = np.memmap(path, dtype=entry["dtype"], mode=mode,
+                                              offset=data_start + entry["offset"], shape=shape)
+    return description["config"], description["state"], arrays
+
+
+def check_states(states):
+    # The states of a codebook go into the JSON description and must come back equal
+    states = list(states)
+    for state in states:
+        if not isinstance(state, JSON_SCALARS):
+            raise ValueError(f"cannot snapshot state {state!r}, states must be str, int, float or bool")
+    return states
+
+
+# random.Random state as JSON and back
+def rng_state(rng):
+    version, internal, gauss = rng.getstate()
+    return [version, list(internal), gauss]
+
+
+def set_rng_state(rng, state):
+    version, internal, gauss = state
+    rng.setstate((version, tuple(internal), gauss))
+
+
+class Snapshottable(ABC):
+    # save()/load() for a filter class. snapshot_config() gives the constructor
+    # arguments, snapshot_state() the counters and seeds and snapshot_arrays() the
+    # arrays. load() builds a filter from the config and hands it the state and the
+    # memory-mapped arrays through restore(). Runtime-only arguments such as
+    # cache_size are passed to load() again.
+
+    @abstractmethod
+    def snapshot_config(self):
+        pass
+
+    def snapshot_state(self):
+        return {}
+
+    @abstractmethod
+    def snapshot_arrays(self):
+        pass
+
+    def restore(self, state, arrays):
+        self.__dict__.update(state)
+        self.__dict__.update(arrays)
+
+    def save(self, path):
+        write_snapshot(path, type(self).__name__, self.snapshot_config(), self.snapshot_state(),
+                       self.snapshot_arrays())
+
+    @classmethod
+    def load(cls, path, mode="c", **runtime_args):
+        config, state, arrays = read_snapshot(path, cls.__name__, mode)
+        filter = cls(**config, **runtime_args)
+        filter.restore(state, arrays)
+        return filter
+
+
+class TestFilterSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.scratch.name, "filter.snapshot")
+
+    def tearDown(self):
+        self.scratch.cleanup()
+
+    def test_round_trip(self):
+        arrays = {
+            "cells": np.arange(1000, dtype=np.uint16),
+            "flags": np.ones((3, 7), dtype=np.uint8),
+            "empty": np.zeros((0, 4), dtype=np.int64),
+        }
+        write_snapshot(self.path, "Filter", {"num_cells": 1000}, {"phase": 3}, arrays)
+        config, state, loaded = read_snapshot(self.path, "Filter")
+        self.assertEqual((config, state), ({"num_cells": 1000}, {"phase": 3}))
+        for name, array in arrays.items():
+            np.testing.assert_array_equal(loaded[name], array)
+            self.assertEqual(loaded[name].dtype, array.dtype)
+        self.assertIsInstance(loaded["cells"], np.memmap)
+        # copy-on-write: the file keeps the saved values
+        loaded["cells"][:] = 0
+        np.testing.assert_array_equal(read_snapshot(self.path, "Filter")[2]["cells"], arrays["cells"])
+
+    def test_modes_and_errors(self):
+        write_snapshot(self.path, "Filter", {}, {}, {"cells": np.zeros(10, dtype=np.uint8)})
+        with self.assertRaises(ValueError):
+            read_snapshot(self.path, "OtherFilter")
+        read_only = read_snapshot(self.path, "Filter", mode="r")[2]["cells"]
+        with self.assertRaises(ValueError):
+            read_only[0] = 1
+        read_snapshot(self.path, "Filter", mode="r+")[2]["cells"][0] = 7
+        self.assertEqual(read_snapshot(self.path, "Filter")[2]["cells"][0], 7)
+        with open(self.path, "r+b") as f:
+            f.write(b"garbage!")
+        with self.assertRaises(ValueError):
+            read_snapshot(self.path, "Filter")
+
+    def test_states_and_rng(self):
+        self.assertEqual(check_states([1, "open", 2.5]), [1, "open", 2.5])
+        with self.assertRaises(ValueError):
+            check_states([(1, 2)])
+        rng = random.Random(3)
+        state = json.loads(json.dumps(rng_state(rng)))
+        expected = rng.random()
+        set_rng_state(rng, state)
+        self.assertEqual(rng.random(), expected)
+
+    def test_snapshottable(self):
+        class Cells(Snapshottable):
+            def __init__(self, num_cells):
+                self.cells = np.zeros(num_cells, dtype=np.uint8)
+
+            def snapshot_config(self):
+                return {"num_cells": len(self.cells)}
+
+            def snapshot_arrays(self):
+                return {"cells": self.cells}
+
+        filter = Cells(16)
+        filter.cells[3] = 5
+        filter.save(self.path)
+        self.assertEqual(Cells.load(self.path).cells.tolist(), filter.cells.tolist())
+        # a filter class has to say what it saves
+        class NoArrays(Snapshottable):
+            def snapshot_config(self):
+                return {}
+        with self.assertRaises(TypeError):
+            NoArrays()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,31 @@
+import os
 import random
+import tempfile
+import unittest
 
+import numpy as np
+import xxhash
+
+from bloom_filter import hash_input
+from filter_snapshot import Snapshottable, check_states, rng_state, set_rng_state
+from hash_index_cache import make_index_cache
+from memory_usage import build_memory_report, deep_sizeof
+from state_codebook import DK, EMPTY, StateCodebook
+
+# Seeded xxhash rather than Python's hash(), which is randomized per process for str
+# and bytes flow ids, so every process puts a flow in the same buckets
 def generate_hash_functions(n):
     hash_functions = []
     for i in range(n):
         def hash_func(x, i=i):
-            return hash((x, i))
+            return xxhash.xxh64_intdigest(hash_input(x), seed=i)
         hash_functions.append(hash_func)
     return hash_functions
 
 
-class FCF:
-    def __init__(self, hash_fns, table_size, cells_per_bucket, fingerprint_size, deletion_window=6000000):
+class FCF(Snapshottable):
+    def __init__(self, hash_fns, table_size, cells_per_bucket, fingerprint_size, deletion_window=6000000,
+                 cache_size=None):
         assert table_size % hash_fns == 0
         self.deletion_window = deletion_window
         self.hash_fns = generate_hash_functions(hash_fns)
@@ -18,13 +33,20 @@ class FCF:
         self.table = [[[] for _ in range(self.subtable_size)] for _ in range(hash_fns)]
         self.cells_per_bucket = cells_per_bucket
         self.fingerprint_size = fingerprint_size
-        self.fingerprint_generator = lambda x: hash((x, hash_fns + 1)) % (2 ** fingerprint_size)
+        self.fingerprint_generator = lambda x: xxhash.xxh64_intdigest(hash_input(x), seed=hash_fns + 1) % (2 ** fingerprint_size)
         self.required_memory = table_size * cells_per_bucket * (fingerprint_size + 8) # add for state
         self.num_ops = 0
+        self.index_cache = make_index_cache(cache_size)
         print(f"FCF requires {self.required_memory} bits of memory")
+    # bucket index in every subtable and fingerprint of a flow, through the index cache
+    def hash_location(self, flow_id):
+        if self.index_cache is None:
+            return self.compute_location(flow_id)
+        return self.index_cache.lookup(flow_id, self.compute_location)
+    def compute_location(self, flow_id):
+        return [fn(flow_id) % self.subtable_size for fn in self.hash_fns], self.fingerprint_generator(flow_id)
     def insert_entry(self, flow_id, state):
-        indices = [fn(flow_id) % self.subtable_size for fn in self.hash_fns]
-        fingerprint = self.fingerprint_generator(flow_id)
+        indices, fingerprint = self.hash_location(flow_id)
         subtable_entries = [self.table[i][indices[i]] for i in range(len(self.hash_fns))]
         # find the entry with the fewest elements
         min_index = min(range(len(subtable_entries)), key=lambda i: len(subtable_entries[i]))
@@ -32,8 +54,7 @@ class FCF:
         subtable_entries[min_index].append((1, fingerprint, state))
         self.handle_deletions()
     def modify_entry(self, flow_id, state):
-        indices = [fn(flow_id) % self.subtable_size for fn in self.hash_fns]
-        fingerprint = self.fingerprint_generator(flow_id)
+        indices, fingerprint = self.hash_location(flow_id)
         subtable_entries = [self.table[i][indices[i]] for i in range(len(self.hash_fns))]
         for entry in subtable_entries:
             for i, (flag, f, s) in enumerate(entry):
@@ -42,8 +63,7 @@ class FCF:
         self.handle_deletions()
     def lookup_entry(self, flow_id):
         result = None
-        indices = [fn(flow_id) % self.subtable_size for fn in self.hash_fns]
-        fingerprint = self.fingerprint_generator(flow_id)
+        indices, fingerprint = self.hash_location(flow_id)
         subtable_entries = [self.table[i][indices[i]] for i in range(len(self.hash_fns))]
         for entry in subtable_entries:
             for i, (flag, f, s) in enumerate(entry):
@@ -55,13 +75,10 @@ class FCF:
         self.handle_deletions()
         return result
     def delete_entry(self, flow_id):
-        indices = [fn(flow_id) % self.subtable_size for fn in self.hash_fns]
-        fingerprint = self.fingerprint_generator(flow_id)
+        indices, fingerprint = self.hash_location(flow_id)
         subtable_entries = [self.table[i][indices[i]] for i in range(len(self.hash_fns))]
         for entry in subtable_entries:
-            for i, (flag, f, s) in enumerate(entry):
-                if f == fingerprint:
-                    del entry[i]
+            entry[:] = [(flag, f, s) for (flag, f, s) in entry if f != fingerprint]
     def handle_deletions(self):
         self.num_ops += 1
         if self.num_ops >= self.deletion_window:
@@ -69,31 +86,819 @@ class FCF:
             for i in range(len(self.hash_fns)):
                 for j in range(self.subtable_size):
                     self.table[i][j] = [(0, f, s) for (flag, f, s) in self.table[i][j] if flag == 1]
+    # required_memory is the theoretical size; every entry is one flow
+    def memory_report(self):
+        active_flows = sum(len(bucket) for subtable in self.table for bucket in subtable)
+        return build_memory_report(self.required_memory, deep_sizeof(self), active_flows)
+
+    # Snapshots flatten the buckets into entry arrays and restoring rebuilds the lists.
+
+    def snapshot_config(self):
+        return {
+            "hash_fns": len(self.hash_fns),
+            "table_size": self.subtable_size * len(self.hash_fns),
+            "cells_per_bucket": self.cells_per_bucket,
+            "fingerprint_size": self.fingerprint_size,
+            "deletion_window": self.deletion_window,
+        }
+
+    def entries(self):
+        return [entry for subtable in self.table for bucket in subtable for entry in bucket]
+
+    def snapshot_state(self):
+        return {"num_ops": self.num_ops, "states": check_states(dict.fromkeys(s for _, _, s in self.entries()))}
+
+    def snapshot_arrays(self):
+        entries = self.entries()
+        states = {state: code for code, state in enumerate(dict.fromkeys(s for _, _, s in entries))}
+        return {
+            "sizes": np.array([[len(bucket) for bucket in subtable] for subtable in self.table], dtype=np.int64),
+            "flags": np.array([flag for flag, _, _ in entries], dtype=np.uint8),
+            "fingerprints": np.array([f for _, f, _ in entries], dtype=np.uint64),
+            "states": np.array([states[s] for _, _, s in entries], dtype=np.uint8 if len(states) <= 256 else np.int64),
+        }
+
+    def restore(self, state, arrays):
+        self.num_ops = state["num_ops"]
+        entries = list(zip(arrays["flags"].tolist(), arrays["fingerprints"].tolist(),
+                           [state["states"][code] for code in arrays["states"].tolist()]))
+        start = 0
+        for subtable, sizes in zip(self.table, arrays["sizes"].tolist()):
+            for j, size in enumerate(sizes):
+                subtable[j] = entries[start:start + size]
+                start += size
+
+def fingerprint_dtype(fingerprint_size):
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if fingerprint_size <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError(f"fingerprints of {fingerprint_size} bits do not fit in 64 bits")
+
+
+# Fingerprints are matched a word at a time: the fingerprints of a bucket are the
+# lanes of little-endian uint64 words, XORed with the looked-up fingerprint copied into
+# every lane, and the zero lanes of the result are the matches. For lanes of lane_bits,
+# ones has the lowest bit of every lane set, high the highest and low all the others.
+def lane_constants(lane_bits):
+    ones = sum(1 << lane for lane in range(0, 64, lane_bits))
+    high = ones << (lane_bits - 1)
+    low = ones * ((1 << (lane_bits - 1)) - 1)
+    return np.uint64(ones), np.uint64(high), np.uint64(low)
+
+
+# High bit set in every zero lane of words: (lane & low) + low carries into the high bit
+# whenever the low bits are not all zero, without ever carrying out of the lane
+def zero_lanes(words, high, low):
+    return ~(((words & low) + low) | words | low) & high
+
+
+class ArrayFCF(Snapshottable):
+    # Same filter as FCF, but the table is preallocated instead of lists of tuples:
+    # fingerprint, state and flag arrays of shape (hash_fns, subtable_size,
+    # cells_per_bucket), where the first occupancy[i, j] slots of bucket j in subtable i
+    # are in use. Buckets are padded to whole uint64 words of fingerprints, which is
+    # how find() and lookup_many() match them (see zero_lanes), so a lookup costs the
+    # same however full its buckets are. States are stored as codes (see
+    # state_codebook). When every candidate
+    # bucket of a flow is full the insert fails and is counted in overflows instead of
+    # growing the bucket past cells_per_bucket.
+    #
+    # With lazy_expiry the flags hold the (uint8) generation of the last access instead
+    # of 0/1, and the end of a deletion window only bumps the current generation. An
+    # entry last touched two or more generations ago is what the window sweep would
+    # have dropped; such entries are reclaimed when their bucket is next touched and by
+    # a background sweep of sweep_budget buckets per operation, which visits every
+    # bucket once per window so a tag can never wrap around.
+    #
+    # With max_kicks an insert into full buckets relocates entries cuckoo style instead
+    # of failing: the new entry takes the slot of a random entry of one of its buckets,
+    # which moves on to one of its other buckets, for at most max_kicks moves. To find
+    # the other buckets of an entry from its fingerprint alone, a flow's bucket in
+    # subtable i is then (b + i * offset(fingerprint)) % subtable_size, b being its
+    # first hash. An entry left without a bucket goes to a stash of stash_size entries,
+    # which lookups also search and which is moved back into the table as room frees
+    # up. Only when the stash is full as well is the chain undone and the insert fails.
+    def __init__(self, hash_fns, table_size, cells_per_bucket, fingerprint_size, deletion_window=6000000, states=(),
+                 lazy_expiry=False, sweep_budget=None, cache_size=None, max_kicks=0, stash_size=0, seed=0):
+        assert table_size % hash_fns == 0
+        assert cells_per_bucket <= np.iinfo(np.uint8).max
+        if max_kicks and hash_fns < 2:
+            raise ValueError("relocation needs at least two subtables to move entries between")
+        self.deletion_window = deletion_window
+        self.hash_fns = generate_hash_functions(hash_fns)
+        self.subtable_size = table_size // hash_fns
+        self.cells_per_bucket = cells_per_bucket
+        self.fingerprint_size = fingerprint_size
+        self.fingerprint_generator = lambda x: xxhash.xxh64_intdigest(hash_input(x), seed=hash_fns + 1) % (2 ** fingerprint_size)
+        self.required_memory = table_size * cells_per_bucket * (fingerprint_size + 8) # add for state
+        # a stash entry also keeps the bucket index of the flow in every subtable
+        self.required_memory += stash_size * (fingerprint_size + 8 + hash_fns * max(1, (self.subtable_size - 1).bit_length()))
+        self.num_ops = 0
+        self.overflows = 0
+        self.max_kicks = max_kicks
+        self.kicks = 0
+        self.kick_rng = random.Random(seed)
+        self.codebook = StateCodebook(states)
+        dtype = np.dtype(fingerprint_dtype(fingerprint_size)).newbyteorder("<")
+        self.lane_bits = dtype.itemsize * 8
+        lanes_per_word = 64 // self.lane_bits
+        self.bucket_words = -(-cells_per_bucket // lanes_per_word)
+        self.bucket_width = self.bucket_words * lanes_per_word
+        shape = (hash_fns, self.subtable_size, self.bucket_width)
+        self.fingerprints = np.zeros(shape, dtype=dtype)
+        self.words = self.fingerprints.view("<u8")
+        self.states = np.zeros(shape, dtype=np.uint8)
+        self.flags = np.zeros(shape, dtype=np.uint8)
+        self.occupancy = np.zeros(shape[:2], dtype=np.uint8)
+        self.rows = np.arange(hash_fns)
+        self.slots = np.arange(self.bucket_width)
+        self.lane_ones, self.lane_high, self.lane_low = lane_constants(self.lane_bits)
+        # bit position of the high bit of every lane of a word
+        self.lane_shifts = np.arange(lanes_per_word, dtype=np.uint64) * np.uint64(self.lane_bits) + np.uint64(self.lane_bits - 1)
+        # high bits of the lanes in use, in each word of a bucket, for every occupancy
+        in_use = (self.slots < np.arange(cells_per_bucket + 1)[:, None]).reshape(-1, self.bucket_words, lanes_per_word)
+        self.in_use_masks = np.bitwise_or.reduce(in_use.astype(np.uint64) << self.lane_shifts, axis=2)
+        # the same constants for find(), over the words of all hash_fns buckets at once
+        self.in_use_ints = [int.from_bytes(masks.astype("<u8").tobytes(), "little") for masks in self.in_use_masks]
+        self.row_constants = tuple(
+            int.from_bytes(np.full(hash_fns * self.bucket_words, constant, dtype="<u8").tobytes(), "little")
+            for constant in (self.lane_ones, self.lane_high, self.lane_low))
+        self.lazy_expiry = lazy_expiry
+        self.generation = 0
+        # value written to the flag of an accessed entry
+        self.access_tag = 1
+        self.num_buckets = hash_fns * self.subtable_size
+        if sweep_budget is None:
+            sweep_budget = -(-self.num_buckets // deletion_window)
+        self.sweep_budget = sweep_budget
+        self.sweep_cursor = 0
+        if lazy_expiry:
+            self.access_tag = self.generation
+            assert sweep_budget * deletion_window >= self.num_buckets
+        self.index_cache = make_index_cache(cache_size)
+        # Read-only lookups refresh no flags, reclaim nothing and do not count towards
+        # the window, for readers of a table another process updates (see shared_filter)
+        self.read_only = False
+        self.stash_indices = np.zeros((stash_size, hash_fns), dtype=np.int64)
+        self.stash_fingerprints = np.zeros(stash_size, dtype=self.fingerprints.dtype)
+        self.stash_states = np.zeros(stash_size, dtype=np.uint8)
+        self.stash_flags = np.zeros(stash_size, dtype=np.uint8)
+        self.stash_count = 0
+
+    def locate(self, flow_id):
+        indices, fingerprint = self.hash_location(flow_id)
+        if self.lazy_expiry and not self.read_only:
+            self.reclaim(self.rows * self.subtable_size + indices)
+        return indices, fingerprint
+
+    # (bucket indices, fingerprint) of a flow, through the index cache
+    def hash_location(self, flow_id):
+        if self.index_cache is None:
+            return self.compute_location(flow_id)
+        return self.index_cache.lookup(flow_id, self.compute_location)
+
+    def compute_location(self, flow_id):
+        if self.max_kicks:
+            fingerprint = self.fingerprint_generator(flow_id)
+            return self.alternate_indices(0, self.hash_fns[0](flow_id) % self.subtable_size, fingerprint), fingerprint
+        return np.array([fn(flow_id) % self.subtable_size for fn in self.hash_fns]), self.fingerprint_generator(flow_id)
+
+    # Bucket indices in every subtable of the entry with the given fingerprint in the
+    # given bucket of subtable row, when locations are derived for relocation. The
+    # fingerprint is an int, whose hash() is the same in every process.
+    def alternate_indices(self, row, bucket, fingerprint):
+        offset = 1 + hash((fingerprint, -1)) % max(1, self.subtable_size - 1)
+        first = (bucket - row * offset) % self.subtable_size
+        return (first + self.rows * offset) % self.subtable_size
+
+    # The tables seen as (num_buckets, bucket_width), bucket j of subtable i being row
+    # i * subtable_size + j
+    def bucket_view(self, table):
+        return table.reshape(-1, self.bucket_width)
+
+    # Drop expired entries from the given buckets (flat ids or a slice)
+    def reclaim(self, buckets):
+        age = np.uint8(self.generation) - self.bucket_view(self.flags)[buckets]
+        stale = age > 1
+        stale &= self.slots < self.occupancy.reshape(-1)[buckets][:, None]
+        if stale.any():
+            self.compact(~stale, buckets)
+
+    # (subtable, slot) pairs holding the fingerprint, in the order FCF scans its buckets
+    # For a single flow the hash_fns buckets are matched as one Python int, the words of
+    # all of them side by side, which takes a handful of big-int operations in place of
+    # a round of NumPy calls per step
+    def find(self, indices, fingerprint):
+        buckets = int.from_bytes(self.fingerprints[self.rows, indices].tobytes(), "little")
+        ones, high, low = self.row_constants
+        x = buckets ^ (fingerprint * ones)
+        hits = ~(((x & low) + low) | x | low) & high
+        in_use = 0
+        for row, occupancy in enumerate(self.occupancy[self.rows, indices].tolist()):
+            in_use |= self.in_use_ints[occupancy] << (row * self.bucket_width * self.lane_bits)
+        hits &= in_use
+        rows, slots = [], []
+        while hits:
+            lowest = hits & -hits
+            lane = lowest.bit_length() // self.lane_bits - 1
+            rows.append(lane // self.bucket_width)
+            slots.append(lane % self.bucket_width)
+            hits ^= lowest
+        rows, slots = np.array(rows, dtype=np.intp), np.array(slots, dtype=np.intp)
+        if self.lazy_expiry and self.read_only:
+            # expired entries that a lookup would have reclaimed first
+            live = np.uint8(self.generation) - self.flags[rows, indices[rows], slots] <= 1
+            rows, slots = rows[live], slots[live]
+        return rows, slots
+
+    # Lane high bits of the words (..., bucket_words) of buckets with the given
+    # occupancies (...) that hold the fingerprints (...)
+    def match(self, words, occupancy, fingerprints):
+        broadcast = np.asarray(fingerprints, dtype=np.uint64)[..., None] * self.lane_ones
+        return zero_lanes(words ^ broadcast, self.lane_high, self.lane_low) & self.in_use_masks[occupancy]
+
+    # match() results as booleans over the bucket_width slots
+    def hit_lanes(self, hits):
+        lanes = (hits[..., None] >> self.lane_shifts) & np.uint64(1)
+        return lanes.reshape(*hits.shape[:-1], self.bucket_width).astype(bool)
+
+    # Stash slots holding the flow with these bucket indices and fingerprint
+    def find_stashed(self, indices, fingerprint):
+        count = self.stash_count
+        matches = self.stash_fingerprints[:count] == fingerprint
+        matches &= (self.stash_indices[:count] == indices).all(axis=1)
+        return np.flatnonzero(matches)
+
+    def insert_entry(self, flow_id, state):
+        indices, fingerprint = self.locate(flow_id)
+        entry = (fingerprint, self.codebook.encode(state), self.access_tag)
+        inserted = self.place(self.rows, indices, entry)
+        if not inserted:
+            path, homeless = self.kick(indices, entry)
+            inserted = homeless is None or self.stash(*homeless)
+            if not inserted:
+                self.undo(path, homeless[1])
+                self.overflows += 1
+        self.handle_deletions()
+        return inserted
+
+    # Puts the entry in the least loaded of its buckets in the given subtables, if one
+    # has room
+    def place(self, rows, indices, entry):
+        sizes = self.occupancy[rows, indices[rows]]
+        # find the entry with the fewest elements
+        best = int(np.argmin(sizes))
+        if sizes[best] >= self.cells_per_bucket:
+            return False
+        row = rows[best]
+        bucket = indices[row]
+        self.write_entry(row, bucket, sizes[best], entry)
+        self.occupancy[row, bucket] += 1
+        return True
+
+    def read_entry(self, row, bucket, slot):
+        return (self.fingerprints[row, bucket, slot], self.states[row, bucket, slot], self.flags[row, bucket, slot])
+
+    def write_entry(self, row, bucket, slot, entry):
+        self.fingerprints[row, bucket, slot], self.states[row, bucket, slot], self.flags[row, bucket, slot] = entry
+
+    # Cuckoo relocation of an entry whose buckets are all full. Returns the (subtable,
+    # bucket, slot) cells it swapped entries through and the (indices, entry) left
+    # without a bucket, None once every entry has one.
+    def kick(self, indices, entry):
+        path = []
+        rows = self.rows
+        for _ in range(self.max_kicks):
+            row = self.kick_rng.choice(rows.tolist())
+            bucket, slot = indices[row], self.kick_rng.randrange(self.cells_per_bucket)
+            victim = self.read_entry(row, bucket, slot)
+            self.write_entry(row, bucket, slot, entry)
+            path.append((row, bucket, slot))
+            self.kicks += 1
+            entry = victim
+            # no reclaiming here, it would move the entries along the path
+            indices = self.alternate_indices(row, bucket, entry[0])
+            rows = self.rows[self.rows != row]
+            if self.place(rows, indices, entry):
+                return path, None
+        return path, (indices, entry)
+
+    # Reverses the swaps of kick, given the entry the chain ended with
+    def undo(self, path, entry):
+        for row, bucket, slot in reversed(path):
+            displaced = self.read_entry(row, bucket, slot)
+            self.write_entry(row, bucket, slot, entry)
+            entry = displaced
+
+    def stash(self, indices, entry):
+        if self.stash_count == len(self.stash_fingerprints):
+            return False
+        i = self.stash_count
+        self.stash_indices[i] = indices
+        self.stash_fingerprints[i], self.stash_states[i], self.stash_flags[i] = entry
+        self.stash_count += 1
+        return True
+
+    # Keep only the stashed entries selected by keep, in order
+    def compact_stash(self, keep):
+        count = self.stash_count
+        kept = np.flatnonzero(keep[:count])
+        for stash in (self.stash_indices, self.stash_fingerprints, self.stash_states, self.stash_flags):
+            stash[:len(kept)] = stash[kept]
+        self.stash_count = len(kept)
+
+    # Moves stashed entries back into the table where one of their buckets has room
+    def drain_stash(self):
+        if self.stash_count == 0:
+            return
+        placed = np.zeros(self.stash_count, dtype=bool)
+        for i in range(self.stash_count):
+            entry = (self.stash_fingerprints[i], self.stash_states[i], self.stash_flags[i])
+            placed[i] = self.place(self.rows, self.stash_indices[i], entry)
+        self.compact_stash(~placed)
+
+    def modify_entry(self, flow_id, state):
+        indices, fingerprint = self.locate(flow_id)
+        rows, slots = self.find(indices, fingerprint)
+        self.states[rows, indices[rows], slots] = self.codebook.encode(state)
+        self.flags[rows, indices[rows], slots] = self.access_tag
+        stashed = self.find_stashed(indices, fingerprint)
+        self.stash_states[stashed] = self.codebook.encode(state)
+        self.stash_flags[stashed] = self.access_tag
+        self.handle_deletions()
+
+    def lookup_entry(self, flow_id):
+        if self.read_only:
+            return self.peek_entry(flow_id)
+        indices, fingerprint = self.locate(flow_id)
+        rows, slots = self.find(indices, fingerprint)
+        stashed = self.find_stashed(indices, fingerprint) if self.stash_count else ()
+        if len(rows) + len(stashed) == 0:
+            self.handle_deletions()
+            return None
+        # like FCF, only the first match gets its flag refreshed, the stash coming last
+        if len(rows):
+            row, slot = rows[0], slots[0]
+            self.flags[row, indices[row], slot] = self.access_tag
+            state = self.states[row, indices[row], slot]
+        else:
+            self.stash_flags[stashed[0]] = self.access_tag
+            state = self.stash_states[stashed[0]]
+        if len(rows) + len(stashed) > 1:
+            return "IDK"
+        result = self.codebook.decode(state)
+        self.handle_deletions()
+        return result
+
+    # lookup_entry without side effects
+    def peek_entry(self, flow_id):
+        indices, fingerprint = self.locate(flow_id)
+        rows, slots = self.find(indices, fingerprint)
+        stashed = self.find_stashed(indices, fingerprint) if self.stash_count else ()
+        if len(rows) + len(stashed) == 0:
+            return None
+        if len(rows) + len(stashed) > 1:
+            return "IDK"
+        if len(rows):
+            return self.codebook.decode(self.states[rows[0], indices[rows[0]], slots[0]])
+        return self.codebook.decode(self.stash_states[stashed[0]])
+
+    # lookup_entry of every flow in turn: the same results and the same table after.
+    # The whole batch is matched in one pass over (flows, hash_fns, bucket_words)
+    # words. Within a deletion window the lookups only refresh flags and reclaim
+    # expired entries, neither of which changes what later lookups match, so the batch
+    # is only cut where a window ends. Like lookup_entry, an "IDK" does not count as an
+    # operation of the window. Read-only, it is one pass that changes nothing.
+    def lookup_many(self, flow_ids):
+        locations = [self.hash_location(flow_id) for flow_id in flow_ids]
+        indices = np.array([indices for indices, _ in locations], dtype=np.intp).reshape(-1, len(self.rows))
+        fingerprints = np.array([fingerprint for _, fingerprint in locations], dtype=np.uint64)
+        codes = []
+        start = 0
+        while start < len(indices):
+            idx, fps = indices[start:], fingerprints[start:]
+            if self.lazy_expiry and not self.read_only:
+                self.reclaim(np.unique(self.rows * self.subtable_size + idx))
+            lanes = self.hit_lanes(self.match(self.words[self.rows, idx], self.occupancy[self.rows, idx], fps[:, None]))
+            if self.lazy_expiry and self.read_only:
+                lanes &= np.uint8(self.generation) - self.flags[self.rows, idx] <= 1
+            lanes = lanes.reshape(len(idx), -1)
+            table_hits = lanes.sum(axis=1)
+            stash_hits = np.zeros((len(idx), self.stash_count), dtype=bool)
+            if self.stash_count:
+                stash_hits = self.stash_fingerprints[:self.stash_count] == fps[:, None]
+                stash_hits &= (self.stash_indices[None, :self.stash_count] == idx[:, None]).all(axis=2)
+            matches = table_hits + stash_hits.sum(axis=1)
+            # cut the batch after the lookup that ends the window
+            counted = np.cumsum(matches < 2)
+            remaining = self.deletion_window - self.num_ops
+            stop = int(np.searchsorted(counted, remaining)) + 1 if counted[-1] >= remaining else len(idx)
+            if self.read_only:
+                stop = len(idx)
+
+            # refresh the first match, in the table before the stash
+            in_table = np.flatnonzero(table_hits[:stop])
+            first = lanes[in_table].argmax(axis=1)
+            rows, slots = first // self.bucket_width, first % self.bucket_width
+            buckets = idx[in_table, rows]
+            if not self.read_only:
+                self.flags[rows, buckets, slots] = self.access_tag
+            batch_codes = np.full(stop, EMPTY, dtype=np.uint8)
+            batch_codes[in_table] = self.states[rows, buckets, slots]
+            only_stashed = np.flatnonzero((table_hits[:stop] == 0) & (matches[:stop] > 0))
+            if len(only_stashed):
+                stashed = stash_hits[only_stashed].argmax(axis=1)
+                if not self.read_only:
+                    self.stash_flags[stashed] = self.access_tag
+                batch_codes[only_stashed] = self.stash_states[stashed]
+            batch_codes[matches[:stop] > 1] = DK
+            codes.append(batch_codes)
+            if self.read_only:
+                break
+
+            ops = int(counted[stop - 1])
+            self.num_ops += ops
+            if self.lazy_expiry:
+                self.sweep(ops)
+            if self.num_ops >= self.deletion_window:
+                self.end_window()
+            start += stop
+        return self.codebook.decode_many(np.concatenate(codes)) if codes else []
+
+    def delete_entry(self, flow_id):
+        indices, fingerprint = self.locate(flow_id)
+        rows = np.unique(self.find(indices, fingerprint)[0])
+        if len(rows):
+            buckets = rows * self.subtable_size + indices[rows]
+            self.compact(self.bucket_view(self.fingerprints)[buckets] != fingerprint, buckets)
+        if self.stash_count:
+            stashed = self.find_stashed(indices, fingerprint)
+            if len(stashed):
+                keep = np.ones(self.stash_count, dtype=bool)
+                keep[stashed] = False
+                self.compact_stash(keep)
+            self.drain_stash()
+
+    def handle_deletions(self):
+        self.num_ops += 1
+        if self.lazy_expiry:
+            self.sweep(1)
+        if self.num_ops >= self.deletion_window:
+            self.end_window()
+
+    # The background sweep of ops operations, reclaiming the buckets they cover at once
+    def sweep(self, ops):
+        start, swept = self.sweep_cursor, 0
+        for _ in range(ops):
+            stop = min(self.num_buckets, self.sweep_cursor + self.sweep_budget)
+            swept += stop - self.sweep_cursor
+            self.sweep_cursor = stop % self.num_buckets
+        if swept >= self.num_buckets:
+            self.reclaim(slice(None))
+        elif start + swept <= self.num_buckets:
+            self.reclaim(slice(start, start + swept))
+        else:
+            self.reclaim(slice(start, None))
+            self.reclaim(slice(0, start + swept - self.num_buckets))
+
+    def end_window(self):
+        self.num_ops = 0
+        if self.lazy_expiry:
+            self.generation = (self.generation + 1) % 256
+            self.access_tag = self.generation
+            # the stash is small enough to expire on the spot
+            self.compact_stash((np.uint8(self.generation) - self.stash_flags) <= 1)
+        else:
+            self.compact(self.bucket_view(self.flags) == 1)
+            self.flags[...] = 0
+            self.compact_stash(self.stash_flags == 1)
+            self.stash_flags[...] = 0
+        self.drain_stash()
+
+    # Keep only the slots selected by keep (one row per bucket in buckets), moved to the
+    # front of their bucket in their original order. Writes back into the same arrays.
+    def compact(self, keep, buckets=slice(None)):
+        occupancy = self.occupancy.reshape(-1)
+        keep &= self.slots < occupancy[buckets][:, None]
+        order = np.argsort(~keep, axis=1, kind="stable")
+        for table in (self.fingerprints, self.states, self.flags):
+            view = self.bucket_view(table)
+            view[buckets] = np.take_along_axis(view[buckets], order, axis=1)
+        occupancy[buckets] = np.count_nonzero(keep, axis=1)
+
+    # Slots holding a live entry: with lazy expiry a bucket may still hold expired
+    # entries that have not been reclaimed yet
+    def live_entries(self):
+        live = self.slots < self.occupancy[..., None]
+        if self.lazy_expiry:
+            live &= (np.uint8(self.generation) - self.flags) <= 1
+        return live
+
+    def load_factor(self):
+        return np.count_nonzero(self.live_entries()) / (self.num_buckets * self.cells_per_bucket)
+
+    def memory_report(self):
+        active_flows = np.count_nonzero(self.live_entries()) + self.stash_count
+        return build_memory_report(self.required_memory, deep_sizeof(self), active_flows)
+
+    # A loaded filter works directly on the memory-mapped arrays.
+
+    def snapshot_config(self):
+        return {
+            "hash_fns": len(self.hash_fns),
+            "table_size": self.num_buckets,
+            "cells_per_bucket": self.cells_per_bucket,
+            "fingerprint_size": self.fingerprint_size,
+            "deletion_window": self.deletion_window,
+            "states": check_states(self.codebook.states[1:]),
+            "lazy_expiry": self.lazy_expiry,
+            "sweep_budget": self.sweep_budget,
+            "max_kicks": self.max_kicks,
+            "stash_size": len(self.stash_fingerprints),
+        }
+
+    def snapshot_state(self):
+        counters = ("num_ops", "overflows", "kicks", "generation", "access_tag", "sweep_cursor", "stash_count")
+        return dict({name: int(getattr(self, name)) for name in counters}, kick_rng=rng_state(self.kick_rng))
+
+    def snapshot_arrays(self):
+        names = ("fingerprints", "states", "flags", "occupancy",
+                 "stash_indices", "stash_fingerprints", "stash_states", "stash_flags")
+        return {name: getattr(self, name) for name in names}
+
+    def restore(self, state, arrays):
+        state = dict(state)
+        set_rng_state(self.kick_rng, state.pop("kick_rng"))
+        Snapshottable.restore(self, state, arrays)
+        self.words = self.fingerprints.view("<u8")
+
+
+class TestFingerprintCompressedFilter(unittest.TestCase):
+
+    # Check accuracy of FCF
+    def check_fcf(self, filter_class=FCF):
+        fcf = filter_class(hash_fns=4, table_size=1000, cells_per_bucket=4, fingerprint_size=8, deletion_window=1000)
+        # insert 2 flows
+        fcf.insert_entry(1, "State 1")
+        fcf.insert_entry(2, "State 2")
+        # lookup 2 flows
+        self.assertEqual(fcf.lookup_entry(1), "State 1")
+        self.assertEqual(fcf.lookup_entry(2), "State 2")
+        # modify flow 1
+        fcf.modify_entry(1, "Modified State 1")
+        # lookup flow 1
+        self.assertEqual(fcf.lookup_entry(1), "Modified State 1")
+        # delete flow 2
+        fcf.delete_entry(2)
+        # lookup flow 2
+        self.assertIsNone(fcf.lookup_entry(2))
+        # insert flow 3
+        fcf.insert_entry(3, "State 3")
+        # lookup flow 3 2000 times
+        for _ in range(2004):
+            self.assertEqual(fcf.lookup_entry(3), "State 3")
+        # flow 1 should be deleted by now
+        self.assertIsNone(fcf.lookup_entry(1))
+
+    def test_fcf(self):
+        self.check_fcf()
+
+    def test_array_fcf(self):
+        self.check_fcf(ArrayFCF)
+        self.check_fcf(lambda **config: ArrayFCF(lazy_expiry=True, **config))
+
+    # With buckets large enough that FCF never grows past cells_per_bucket, both tables
+    # have to hold the same live entries in the same order
+    def check_array_fcf_matches_fcf(self, lazy_expiry=False):
+        rng = np.random.default_rng(0)
+        flows = rng.integers(0, 300, 4000).tolist()
+        states = rng.integers(1, 11, 4000).tolist()
+        lists = FCF(hash_fns=3, table_size=300, cells_per_bucket=32, fingerprint_size=6, deletion_window=700)
+        arrays = ArrayFCF(hash_fns=3, table_size=300, cells_per_bucket=32, fingerprint_size=6, deletion_window=700,
+                          lazy_expiry=lazy_expiry)
+        for i, (flow, state) in enumerate(zip(flows, states)):
+            op = i % 4
+            for fcf in (lists, arrays):
+                if op == 0:
+                    fcf.insert_entry(flow, state)
+                elif op == 1:
+                    fcf.modify_entry(flow, state)
+                elif op == 3 and i % 3 == 0:
+                    fcf.delete_entry(flow)
+            self.assertEqual(lists.lookup_entry(flow), arrays.lookup_entry(flow))
+        live = arrays.live_entries()
+        flags = (arrays.flags == arrays.access_tag).astype(int)
+        for i in range(3):
+            for j in range(arrays.subtable_size):
+                used = live[i, j]
+                entries = list(zip(flags[i, j][used].tolist(), arrays.fingerprints[i, j][used].tolist(),
+                                   arrays.codebook.decode_many(arrays.states[i, j][used])))
+                self.assertEqual(lists.table[i][j], entries)
+        self.assertEqual(arrays.overflows, 0)
+
+    def test_array_fcf_matches_fcf(self):
+        self.check_array_fcf_matches_fcf()
+
+    def test_lazy_expiry_matches_fcf(self):
+        self.check_array_fcf_matches_fcf(lazy_expiry=True)
+
+    # A window rollover leaves the table alone, expired entries go when touched or swept
+    def test_lazy_expiry(self):
+        fcf = ArrayFCF(hash_fns=2, table_size=200, cells_per_bucket=4, fingerprint_size=16, deletion_window=50,
+                       lazy_expiry=True)
+        self.assertEqual(fcf.sweep_budget, 4)
+        for flow in range(40):
+            fcf.insert_entry(flow, 1)
+        occupancy = fcf.occupancy.copy()
+        for _ in range(10):
+            fcf.lookup_entry(0)
+        self.assertEqual(fcf.generation, 1)
+        self.assertTrue((fcf.occupancy == occupancy).all())
+        for _ in range(60):
+            fcf.lookup_entry(0)
+        self.assertEqual(fcf.generation, 2)
+        self.assertEqual(fcf.lookup_entry(0), 1)
+        self.assertIsNone(fcf.lookup_entry(1))
+        for _ in range(50):
+            fcf.lookup_entry(0)
+        # a full window of background sweeping has visited every bucket
+        self.assertEqual(fcf.occupancy.sum(), 1)
+
+    def test_array_fcf_overflow(self):
+        fcf = ArrayFCF(hash_fns=2, table_size=2, cells_per_bucket=2, fingerprint_size=16)
+        self.assertTrue(all(fcf.insert_entry(flow, 1) for flow in range(4)))
+        self.assertEqual(fcf.load_factor(), 1.0)
+        self.assertIs(fcf.insert_entry(4, 1), False)
+        self.assertEqual(fcf.overflows, 1)
+        self.assertEqual(fcf.occupancy.max(), 2)
+
+    def test_memory_report(self):
+        lists = FCF(hash_fns=3, table_size=300, cells_per_bucket=4, fingerprint_size=12)
+        arrays = ArrayFCF(hash_fns=3, table_size=300, cells_per_bucket=4, fingerprint_size=12)
+        for fcf in (lists, arrays):
+            for flow in range(100):
+                fcf.insert_entry(flow, 1)
+        reports = [fcf.memory_report() for fcf in (lists, arrays)]
+        for report in reports:
+            self.assertEqual(report["theoretical_bits"], 300 * 4 * (12 + 8))
+            self.assertEqual(report["active_flows"], 100)
+            self.assertEqual(report["bits_per_active_flow"], report["actual_bytes"] * 8 / 100)
+        # tuples in lists against preallocated arrays
+        self.assertLess(reports[1]["actual_bytes"], reports[0]["actual_bytes"])
+
+    def test_index_cache(self):
+        for filter_class in (FCF, ArrayFCF):
+            cached = filter_class(hash_fns=3, table_size=300, cells_per_bucket=4, fingerprint_size=8, cache_size=50)
+            plain = filter_class(hash_fns=3, table_size=300, cells_per_bucket=4, fingerprint_size=8)
+            for op in range(2000):
+                flow = (op * 7) % 120 if op % 3 else op % 40
+                for fcf in (cached, plain):
+                    if op % 11 == 0:
+                        fcf.delete_entry(flow)
+                    elif op % 4 == 0:
+                        fcf.insert_entry(flow, op % 5)
+                    elif op % 4 == 1:
+                        fcf.modify_entry(flow, op % 5)
+                self.assertEqual(cached.lookup_entry(flow), plain.lookup_entry(flow))
+            stats = cached.index_cache.stats()
+            self.assertEqual(stats["size"], 50)
+            self.assertGreater(stats["hits"], 0)
+            self.assertIsNone(plain.index_cache)
+
+    # Fill tables until the first insert fails: relocation reaches a far higher load
+    def test_relocation(self):
+        loads = {}
+        for max_kicks in (0, 100):
+            fcf = ArrayFCF(hash_fns=2, table_size=400, cells_per_bucket=4, fingerprint_size=24, max_kicks=max_kicks)
+            flow = 0
+            while fcf.insert_entry(flow, flow % 10):
+                flow += 1
+            loads[max_kicks] = fcf.load_factor()
+            # every flow that got in is still found after being moved around
+            self.assertEqual([fcf.lookup_entry(f) for f in range(flow)], [f % 10 for f in range(flow)])
+            self.assertIsNone(fcf.lookup_entry(flow))
+            self.assertEqual(fcf.overflows, 1)
+        self.assertGreater(loads[100], 0.9)
+        self.assertGreater(0.9, loads[0])
+        self.assertGreater(fcf.kicks, 0)
+        # relocated locations are consistent with each entry's bucket
+        for row in range(2):
+            for bucket in range(fcf.subtable_size):
+                for slot in range(fcf.occupancy[row, bucket]):
+                    indices = fcf.alternate_indices(row, bucket, fcf.fingerprints[row, bucket, slot])
+                    self.assertEqual(indices[row], bucket)
+        with self.assertRaises(ValueError):
+            ArrayFCF(hash_fns=1, table_size=400, cells_per_bucket=4, fingerprint_size=24, max_kicks=100)
+
+    def test_stash(self):
+        fcf = ArrayFCF(hash_fns=2, table_size=2, cells_per_bucket=2, fingerprint_size=16, max_kicks=5, stash_size=2)
+        self.assertTrue(all(fcf.insert_entry(flow, flow) for flow in range(6)))
+        self.assertEqual(fcf.stash_count, 2)
+        self.assertEqual([fcf.lookup_entry(flow) for flow in range(6)], list(range(6)))
+        # a full stash undoes the chain, leaving the table as it was
+        table = fcf.fingerprints.copy()
+        self.assertIs(fcf.insert_entry(6, 6), False)
+        self.assertTrue((fcf.fingerprints == table).all())
+        self.assertEqual(fcf.memory_report()["active_flows"], 6)
+        fcf.modify_entry(5, 50)
+        self.assertEqual(fcf.lookup_entry(5), 50)
+        # deletions make room for stashed flows
+        fcf.delete_entry(0)
+        fcf.delete_entry(1)
+        self.assertEqual(fcf.stash_count, 0)
+        self.assertEqual([fcf.lookup_entry(flow) for flow in range(2, 6)], [2, 3, 4, 50])
+        # stashed entries expire with the deletion window like the rest
+        for lazy_expiry in (False, True):
+            fcf = ArrayFCF(hash_fns=2, table_size=2, cells_per_bucket=2, fingerprint_size=16, deletion_window=10,
+                           lazy_expiry=lazy_expiry, max_kicks=5, stash_size=2)
+            for flow in range(6):
+                fcf.insert_entry(flow, flow)
+            for _ in range(30):
+                fcf.lookup_entry(0)
+            self.assertEqual(fcf.memory_report()["active_flows"], 1)
+            self.assertEqual(fcf.lookup_entry(0), 0)
+
+    def test_zero_lanes(self):
+        rng = np.random.default_rng(0)
+        for lane_bits in (8, 16, 32, 64):
+            ones, high, low = lane_constants(lane_bits)
+            dtype = np.dtype(f"<u{lane_bits // 8}")
+            lanes = rng.integers(0, 4, 4096, dtype=np.uint64).astype(dtype)
+            # lanes next to zero lanes, where a borrow would leak in a plain (x - ones) & ~x test
+            lanes[::3] = np.iinfo(dtype).max
+            hits = zero_lanes(lanes.view("<u8"), high, low)
+            per_lane = (hits[:, None] >> (np.arange(64 // lane_bits, dtype=np.uint64) * np.uint64(lane_bits)
+                                          + np.uint64(lane_bits - 1))) & np.uint64(1)
+            self.assertTrue((per_lane.reshape(-1).astype(bool) == (lanes == 0)).all())
+
+    # lookup_many against lookup_entry one flow at a time on a twin filter, across window
+    # ends, IDKs, stashed entries and lazy expiry
+    def check_lookup_many(self, lazy_expiry=False):
+        rng = np.random.default_rng(1)
+        config = dict(hash_fns=3, table_size=60, cells_per_bucket=5, fingerprint_size=5, deletion_window=251,
+                      lazy_expiry=lazy_expiry, max_kicks=20, stash_size=8)
+        single, batched = ArrayFCF(**config), ArrayFCF(**config)
+        results, stashed = [], 0
+        for _ in range(20):
+            inserts = rng.integers(0, 400, 100).tolist()
+            for fcf in (single, batched):
+                for flow in inserts:
+                    fcf.insert_entry(flow, flow % 7)
+            flows = rng.integers(0, 400, int(rng.integers(1, 300))).tolist()
+            stashed = max(stashed, single.stash_count)
+            results += batched.lookup_many(flows)
+            self.assertEqual(results[-len(flows):], [single.lookup_entry(flow) for flow in flows])
+            for name in ("fingerprints", "states", "flags", "occupancy", "stash_fingerprints", "stash_flags"):
+                self.assertTrue((getattr(single, name) == getattr(batched, name)).all(), name)
+            self.assertEqual((single.num_ops, single.generation, single.sweep_cursor, single.stash_count),
+                             (batched.num_ops, batched.generation, batched.sweep_cursor, batched.stash_count))
+        self.assertIn("IDK", results)
+        self.assertIn(None, results)
+        self.assertGreater(stashed, 0)
+        self.assertEqual(batched.lookup_many([]), [])
+
+    def test_lookup_many(self):
+        self.check_lookup_many()
+
+    def test_lookup_many_lazy_expiry(self):
+        self.check_lookup_many(lazy_expiry=True)
+
+    def test_snapshot(self):
+        rng = np.random.default_rng(4)
+        flows = rng.integers(0, 500, 3000).tolist()
+        filters = [
+            lambda: FCF(hash_fns=3, table_size=150, cells_per_bucket=4, fingerprint_size=10, deletion_window=900),
+            lambda: ArrayFCF(hash_fns=3, table_size=150, cells_per_bucket=4, fingerprint_size=10, deletion_window=900,
+                             states=["open"], max_kicks=10, stash_size=4),
+            lambda: ArrayFCF(hash_fns=2, table_size=150, cells_per_bucket=6, fingerprint_size=40, deletion_window=900,
+                             lazy_expiry=True),
+        ]
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, "fcf.snapshot")
+            for make_filter in filters:
+                fcf = make_filter()
+                for flow in flows[:1000]:
+                    fcf.insert_entry(flow, "open" if flow % 3 else flow % 7)
+                fcf.save(path)
+                loaded = type(fcf).load(path)
+                self.assertEqual(loaded.memory_report()["active_flows"], fcf.memory_report()["active_flows"])
+                # both carry on in step, through window ends and relocations
+                for i, flow in enumerate(flows[1000:]):
+                    for f in (fcf, loaded):
+                        if i % 4 == 0:
+                            f.insert_entry(flow, i % 5)
+                        elif i % 4 == 1:
+                            f.modify_entry(flow, "closed")
+                        elif i % 4 == 2:
+                            f.delete_entry(flow)
+                    self.assertEqual(loaded.lookup_entry(flow), fcf.lookup_entry(flow))
+                if isinstance(fcf, ArrayFCF):
+                    self.assertIsInstance(loaded.fingerprints, np.memmap)
+                    self.assertTrue((loaded.fingerprints == fcf.fingerprints).all())
+                    self.assertEqual(fcf.kicks, loaded.kicks)
+                else:
+                    self.assertEqual(loaded.table, fcf.table)
+
 
-# Check accuracy of FCF
-def test_fcf():
-    fcf = FCF(hash_fns=4, table_size=1000, cells_per_bucket=4, fingerprint_size=8)
-    # insert 2 flows
-    fcf.insert_entry(1, "State 1")
-    fcf.insert_entry(2, "State 2")
-    # lookup 2 flows
-    assert fcf.lookup_entry(1) == "State 1"
-    assert fcf.lookup_entry(2) == "State 2"
-    # modify flow 1
-    fcf.modify_entry(1, "Modified State 1")
-    # lookup flow 1
-    assert fcf.lookup_entry(1) == "Modified State 1"
-    # delete flow 2
-    fcf.delete_entry(2)
-    # lookup flow 2
-    assert fcf.lookup_entry(2) == None
-    # insert flow 3
-    fcf.insert_entry(3, "State 3")
-    # lookup flow 3 2000 times
-    for _ in range(2004):
-        assert fcf.lookup_entry(3) == "State 3"
-    # flow 1 should be deleted by now
-    assert fcf.lookup_entry(1) == None
-
-    
-test_fcf()
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,248 @@
+"""
+Packet scheduling for the simulations: a fixed population of active flows, each step a
+uniformly random active flow sends its next packet, and a flow that has sent its last
+packet retires. FlowScheduler draws whole batches of steps at once with NumPy instead
+of a random.choice and a list scan per packet.
+"""
+import unittest
+
+import numpy as np
+
+
+# Index of each element among the earlier elements with the same key, e.g. of every
+# packet among the packets of the same flow in a batch
+def occurrence_ranks(keys):
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    positions = np.arange(len(keys))
+    starts = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+    group_start = np.maximum.accumulate(np.where(starts, positions, 0))
+    ranks = np.empty(len(keys), dtype=np.intp)
+    ranks[order] = positions - group_start
+    return ranks
+
+
+def sequential_packets(rng, lengths, num_transitions, max_length):
+    # Packets of len(lengths) flows as (n, max_length) state_from/state_to matrices:
+    # flow i has num_transitions[i] transitions 1 -> 2 -> 3 ... at uniformly random
+    # positions among its first lengths[i] packets, -1 everywhere else
+    lengths = np.asarray(lengths)
+    keys = rng.random((len(lengths), max_length))
+    keys[np.arange(max_length) >= lengths[:, None]] = np.inf
+    # the positions holding a flow's n smallest keys, a uniform sample like random.sample
+    rank = np.empty_like(keys, dtype=np.int64)
+    np.put_along_axis(rank, np.argsort(keys, axis=1), np.arange(max_length), axis=1)
+    is_transition = rank < np.asarray(num_transitions)[:, None]
+    step = np.cumsum(is_transition, axis=1)
+    states_from = np.where(is_transition, step, -1).astype(np.int8)
+    states_to = np.where(is_transition, step + 1, -1).astype(np.int8)
+    return states_from, states_to
+
+
+class ActiveFlowPool:
+    # The active flows as parallel arrays, flow i of the pool in slot i < len(pool):
+    # its id, type, length, the position of its next packet and its packets as rows of
+    # (capacity, max_length) state matrices. Flows are added in bulk at the end and
+    # removed by moving the last flows into the freed slots, so neither depends on the
+    # pool size.
+
+    def __init__(self, capacity, max_length):
+        self.max_length = max_length
+        self.size = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        def grow(array, shape, dtype):
+            new = np.zeros(shape, dtype=dtype)
+            if array is not None:
+                new[:self.size] = array[:self.size]
+            return new
+        self.flow_ids = grow(getattr(self, "flow_ids", None), capacity, np.int64)
+        self.types = grow(getattr(self, "types", None), capacity, np.int8)
+        self.lengths = grow(getattr(self, "lengths", None), capacity, np.int64)
+        self.positions = grow(getattr(self, "positions", None), capacity, np.int64)
+        self.states_from = grow(getattr(self, "states_from", None), (capacity, self.max_length), np.int8)
+        self.states_to = grow(getattr(self, "states_to", None), (capacity, self.max_length), np.int8)
+
+    def __len__(self):
+        return self.size
+
+    def columns(self):
+        return (self.flow_ids, self.types, self.lengths, self.positions, self.states_from, self.states_to)
+
+    def add(self, flow_ids, types, lengths, states_from, states_to):
+        count = len(flow_ids)
+        if self.size + count > len(self.flow_ids):
+            self.allocate(max(2 * len(self.flow_ids), self.size + count))
+        self.replace(np.arange(self.size, self.size + count), flow_ids, types, lengths, states_from, states_to)
+        self.size += count
+
+    def replace(self, slots, flow_ids, types, lengths, states_from, states_to):
+        # new flows in the given slots, starting from their first packet
+        self.flow_ids[slots] = flow_ids
+        self.types[slots] = types
+        self.lengths[slots] = lengths
+        self.positions[slots] = 0
+        self.states_from[slots] = states_from
+        self.states_to[slots] = states_to
+
+    def remove(self, slots):
+        # swap-remove: the flows in the last len(slots) slots that stay fill the holes
+        slots = np.unique(slots)
+        new_size = self.size - len(slots)
+        holes = slots[slots < new_size]
+        tail = np.ones(self.size - new_size, dtype=bool)
+        tail[slots[slots >= new_size] - new_size] = False
+        movers = np.flatnonzero(tail) + new_size
+        for column in self.columns():
+            column[holes] = column[movers]
+        self.size = new_size
+
+
+class FlowScheduler:
+    # Starts with one active flow per entry of types. A retired flow is replaced by a
+    # fresh one of the same type in its slot, unless replace is False, in which case the
+    # pool drains and draw() returns nothing once every flow has finished.
+    #
+    # make_packets(rng, types) -> (lengths, states_from, states_to) creates the packets
+    # of a batch of new flows of the given types, as (n, max_length) matrices.
+
+    def __init__(self, make_packets, types, max_length, seed=0, replace=True):
+        self.rng = np.random.default_rng(seed)
+        self.make_packets = make_packets
+        self.replace = replace
+        self.pool = ActiveFlowPool(len(types), max_length)
+        self.next_flow_id = 0
+        self.finished = 0
+        self.spawn(np.asarray(types, dtype=np.int8))
+
+    def new_flows(self, types):
+        flow_ids = np.arange(self.next_flow_id, self.next_flow_id + len(types), dtype=np.int64)
+        self.next_flow_id += len(types)
+        return (flow_ids, types) + tuple(self.make_packets(self.rng, types))
+
+    def spawn(self, types):
+        self.pool.add(*self.new_flows(types))
+
+    def draw(self, batch_size):
+        # The next batch_size packets as (flow_ids, types, states_from, states_to, last)
+        # arrays, last marking the final packet of a flow. Fewer packets come back when
+        # the pool drains.
+        pool = self.pool
+        if len(pool) == 0:
+            return self.empty()
+        slots = self.rng.integers(0, len(pool), batch_size)
+        ranks = occurrence_ranks(slots)
+        if not self.replace:
+            # without replacements a draw past the end of a flow cannot be redirected,
+            # so the batch stops at the first one
+            remaining = (pool.lengths - pool.positions)[slots]
+            past_end = np.flatnonzero(ranks >= remaining)
+            if len(past_end):
+                slots, ranks = slots[:past_end[0]], ranks[:past_end[0]]
+
+        flow_ids = np.empty(len(slots), dtype=np.int64)
+        types = np.empty(len(slots), dtype=np.int8)
+        states_from = np.empty(len(slots), dtype=np.int8)
+        states_to = np.empty(len(slots), dtype=np.int8)
+        last = np.empty(len(slots), dtype=bool)
+        pending = np.arange(len(slots))
+        while len(pending):
+            # draws within the slot's current flow are its next packets, the rest go on
+            # to the flow that replaces it
+            slot, rank = slots[pending], ranks[pending]
+            remaining = pool.lengths[slot] - pool.positions[slot]
+            fits = rank < remaining
+            done, slot, rank = pending[fits], slot[fits], rank[fits]
+            position = pool.positions[slot] + rank
+            flow_ids[done] = pool.flow_ids[slot]
+            types[done] = pool.types[slot]
+            states_from[done] = pool.states_from[slot, position]
+            states_to[done] = pool.states_to[slot, position]
+            last[done] = position == pool.lengths[slot] - 1
+            np.maximum.at(pool.positions, slot, position + 1)
+            self.retire(np.unique(slots[done[last[done]]]))
+            # a draw past the end of a flow only happens once the draws up to its last
+            # packet are done, so the flow has been replaced by now
+            ranks[pending[~fits]] -= remaining[~fits]
+            pending = pending[~fits]
+        return flow_ids, types, states_from, states_to, last
+
+    def retire(self, slots):
+        self.finished += len(slots)
+        if self.replace:
+            self.pool.replace(slots, *self.new_flows(self.pool.types[slots]))
+        else:
+            self.pool.remove(slots)
+
+    def empty(self):
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8), np.empty(0, dtype=np.int8),
+                np.empty(0, dtype=np.int8), np.empty(0, dtype=bool))
+
+
+class TestFlowScheduler(unittest.TestCase):
+
+    @staticmethod
+    def make_packets(rng, types):
+        lengths = rng.integers(3, 9, len(types))
+        return (lengths,) + sequential_packets(rng, lengths, types.astype(np.int64), 8)
+
+    def collect(self, scheduler, batch_size):
+        batches = []
+        while True:
+            batch = scheduler.draw(batch_size)
+            if not len(batch[0]):
+                return [np.concatenate(column) for column in zip(*batches)]
+            batches.append(batch)
+
+    def test_drain(self):
+        scheduler = FlowScheduler(self.make_packets, [0, 1, 2, 3] * 25, 8, seed=1, replace=False)
+        lengths = dict(zip(scheduler.pool.flow_ids.tolist(), scheduler.pool.lengths.tolist()))
+        flow_ids, types, states_from, states_to, last = self.collect(scheduler, 64)
+        self.assertEqual(scheduler.finished, 100)
+        self.assertEqual(len(scheduler.pool), 0)
+        # every packet of every flow exactly once, in order
+        self.assertEqual(len(flow_ids), sum(lengths.values()))
+        for flow_id, length in lengths.items():
+            packets = flow_ids == flow_id
+            self.assertEqual(packets.sum(), length)
+            self.assertEqual(np.flatnonzero(last[packets]).tolist(), [length - 1])
+            transitions = states_from[packets] != -1
+            self.assertEqual(states_from[packets][transitions].tolist(), list(range(1, types[packets][0] + 1)))
+            self.assertTrue((states_to[packets][transitions] == states_from[packets][transitions] + 1).all())
+
+    def test_replace(self):
+        scheduler = FlowScheduler(self.make_packets, [0, 1, 2] * 10, 8, seed=2)
+        flow_ids, types, _, _, last = [], [], [], [], []
+        for _ in range(20):
+            batch = scheduler.draw(100)
+            self.assertEqual(len(batch[0]), 100)
+            for column, values in zip((flow_ids, types, last), (batch[0], batch[1], batch[4])):
+                column.append(values)
+        flow_ids, types, last = (np.concatenate(column) for column in (flow_ids, types, last))
+        self.assertEqual(len(scheduler.pool), 30)
+        self.assertEqual(scheduler.finished, last.sum())
+        # replacements keep the type of the flow they replace
+        self.assertEqual(np.bincount(scheduler.pool.types).tolist(), [10, 10, 10])
+        finished = set(flow_ids[last].tolist())
+        for flow_id in finished:
+            # nothing of a flow comes after its last packet
+            self.assertEqual(np.flatnonzero(flow_ids == flow_id)[-1], np.flatnonzero((flow_ids == flow_id) & last)[0])
+        self.assertEqual(scheduler.next_flow_id, 30 + len(finished))
+
+    def test_pool_remove(self):
+        pool = ActiveFlowPool(2, 4)
+        rows = np.zeros((5, 4), dtype=np.int8)
+        pool.add(np.arange(5), np.arange(5), np.full(5, 4), rows, rows)
+        pool.remove([1, 4, 3])
+        self.assertEqual(pool.flow_ids[:len(pool)].tolist(), [0, 2])
+        pool.remove([0])
+        self.assertEqual(pool.flow_ids[:len(pool)].tolist(), [2])
+
+    def test_occurrence_ranks(self):
+        self.assertEqual(occurrence_ranks([5, 3, 5, 5, 3]).tolist(), [0, 0, 1, 2, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+from collections import OrderedDict
+
+
+class HashIndexCache:
+    # Bounded LRU map from a flow key to its precomputed hash indices (whatever the
+    # filter derives from the key: bucket indices, a fingerprint, ...). The same flow is
+    # looked up on every one of its packets, so with flow-local traffic most calls are
+    # served from here instead of recomputing the k hashes. Cached values are shared
+    # between calls and must not be modified.
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError(f"cache capacity must be positive, got {capacity}")
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key, compute):
+        # The cached value of key, or compute(key) stored as the most recent entry
+        value = self.entries.get(key)
+        if value is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+        self.misses += 1
+        value = compute(key)
+        self.entries[key] = value
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return value
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate(),
+            "size": len(self.entries),
+            "capacity": self.capacity,
+        }
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def make_index_cache(cache_size):
+    # What the filters keep in index_cache: no cache unless a size is given
+    return HashIndexCache(cache_size) if cache_size else None
+
+
+class TestHashIndexCache(unittest.TestCase):
+
+    def test_lru(self):
+        calls = []
+        def compute(key):
+            calls.append(key)
+            return (key, key * 2)
+        cache = HashIndexCache(2)
+        self.assertEqual(cache.lookup(1, compute), (1, 2))
+        self.assertEqual(cache.lookup(2, compute), (2, 4))
+        self.assertEqual(cache.lookup(1, compute), (1, 2))
+        # 2 is the least recently used entry
+        cache.lookup(3, compute)
+        self.assertEqual(list(cache.entries), [1, 3])
+        cache.lookup(2, compute)
+        self.assertEqual(calls, [1, 2, 3, 2])
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 4, "hit_rate": 0.2, "size": 2, "capacity": 2})
+        cache.clear()
+        self.assertEqual((len(cache), cache.hit_rate()), (0, 0.0))
+
+    def test_capacity(self):
+        with self.assertRaises(ValueError):
+            HashIndexCache(0)
+        self.assertIsNone(make_index_cache(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
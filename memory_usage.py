@@ -0,0 +1,138 @@
+import gc
+import mmap
+import os
+import sys
+import tempfile
+import unittest
+from types import FunctionType, ModuleType
+
+import numpy as np
+from bitarray import bitarray
+from numpy.lib.array_utils import byte_bounds
+
+# Bits of a stored state, the byte FCF.required_memory and the state codes budget for
+STATE_BITS = 8
+
+# Shared by every instance, not part of what a filter holds
+SHARED_TYPES = (type, ModuleType, FunctionType)
+
+
+def deep_sizeof(*objs):
+    # Bytes held by objs and everything they reference: object headers, __dict__s, the
+    # tuples and lists of the Python tables, array and bitarray buffers. Each object is
+    # counted once however often it is referenced; classes, modules and functions are
+    # skipped so a lambda attribute does not pull in its module's globals.
+    seen = set()
+    size = 0
+    mapped = []
+    pending = [obj for obj in objs if not isinstance(obj, SHARED_TYPES)]
+    while pending:
+        referents = []
+        for obj in pending:
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            # sys.getsizeof already counts the buffer an array or bitarray owns
+            size += sys.getsizeof(obj)
+            referents.append(obj)
+        owners = []
+        for obj in referents:
+            bounds, owner = borrowed_buffer(obj)
+            if owner is not None:
+                owners.append(owner)
+            elif bounds is not None:
+                mapped.append(bounds)
+        pending = [obj for obj in gc.get_referents(*referents) + owners
+                   if not isinstance(obj, SHARED_TYPES) and id(obj) not in seen]
+    return size + union_size(mapped)
+
+
+def borrowed_buffer(obj):
+    # Memory an array or bitarray uses without owning it, which sys.getsizeof leaves
+    # out: (start, stop) addresses for a memory-mapped snapshot or a shared memory
+    # segment, or the array that owns it for a view of an ordinary array
+    if isinstance(obj, np.ndarray) and not obj.flags.owndata:
+        root = obj
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+        if root.flags.owndata:
+            return None, root
+        return byte_bounds(obj), None
+    if isinstance(obj, bitarray):
+        info = obj.buffer_info()
+        # address, nbytes, ..., imported
+        if info[6]:
+            return (info[0], info[0] + info[1]), None
+    return None, None
+
+
+def union_size(bounds):
+    # Bytes covered by (start, stop) address ranges, overlapping views counted once
+    size, covered = 0, 0
+    for start, stop in sorted(bounds):
+        start = max(start, covered)
+        if stop > start:
+            size += stop - start
+        covered = max(covered, stop)
+    return size
+
+
+def build_memory_report(theoretical_bits, actual_bytes, active_flows):
+    # What memory_report() of every filter returns. active_flows is the filter's estimate
+    # of how many flows it holds, the per flow figures are None while it holds none.
+    active_flows = int(active_flows)
+    return {
+        "theoretical_bits": int(theoretical_bits),
+        "actual_bytes": int(actual_bytes),
+        "active_flows": active_flows,
+        "bits_per_active_flow": actual_bytes * 8 / active_flows if active_flows else None,
+        "theoretical_bits_per_active_flow": theoretical_bits / active_flows if active_flows else None,
+    }
+
+
+class TestMemoryUsage(unittest.TestCase):
+
+    def test_deep_sizeof(self):
+        table = [[(1, 2, "x")] for _ in range(100)]
+        self.assertGreater(deep_sizeof(table), sys.getsizeof(table) + 100 * sys.getsizeof([]))
+        array = np.zeros(100000, dtype=np.uint8)
+        self.assertGreaterEqual(deep_sizeof(array), array.nbytes)
+        bits = bitarray(800000)
+        self.assertGreaterEqual(deep_sizeof(bits), 100000)
+        # shared objects count once
+        self.assertLess(deep_sizeof([array, array]), 2 * array.nbytes)
+
+    def test_borrowed_buffers(self):
+        # views of an ordinary array count its buffer once
+        array = np.zeros(100000, dtype=np.uint8)
+        self.assertLess(deep_sizeof([array[10:], array[:10].view(np.int8)]), 2 * array.nbytes)
+        self.assertGreaterEqual(deep_sizeof(array[10:]), array.nbytes)
+        # memory-mapped arrays and bitarrays count the mapped bytes, overlapping views once
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, "cells")
+            np.zeros(100000, dtype=np.uint8).tofile(path)
+            mapped = np.memmap(path, dtype=np.uint8, mode="r")
+            self.assertGreaterEqual(deep_sizeof(mapped), 100000)
+            self.assertLess(deep_sizeof([mapped, mapped[:50000].view("<u8")]), 150000)
+            self.assertGreaterEqual(deep_sizeof([mapped[:50000], mapped[50000:]]), 100000)
+            buffer = mmap.mmap(-1, 100000)
+            bits = bitarray(buffer=buffer)
+            self.assertGreaterEqual(deep_sizeof(bits), 100000)
+            del mapped, bits
+            buffer.close()
+
+    def test_skips_shared_objects(self):
+        class Holder:
+            def __init__(self):
+                self.fn = lambda x: x
+        self.assertLess(deep_sizeof(Holder()), 10000)
+
+    def test_report(self):
+        report = build_memory_report(3000, 500, 10)
+        self.assertEqual(report["bits_per_active_flow"], 400)
+        self.assertEqual(report["theoretical_bits_per_active_flow"], 300)
+        self.assertIsNone(build_memory_report(3000, 500, 0)["bits_per_active_flow"])
+
+
+if __name__ == "__main__":
+    unittest.main()
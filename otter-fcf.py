@@ -1,11 +1,16 @@
 import random
 import datetime
 from collections import deque
+import numpy as np
 import xxhash
 
+from bloom_filter import seeded_hash_matrix
+from flow_scheduler import FlowScheduler, occurrence_ranks, sequential_packets
+from memory_usage import STATE_BITS, build_memory_report, deep_sizeof
+
 def generate_hash_fn(seed):
     def hash_fn(x):
-	return xxhash.xx64(x, seed=seed)
+        return xxhash.xxh64_intdigest(str(x), seed=seed)
     return hash_fn
 
 def generate_hash_functions(n):
@@ -14,30 +19,53 @@ def generate_hash_functions(n):
         hash_functions.append(generate_hash_fn(i))
     return hash_functions
 
+# Groups of positions in a list of cell updates such that a group touches every cell at
+# most once and the r-th update of each cell is in group r, so applying the groups one
+# after the other updates every cell in the order of the list
+def update_rounds(cells):
+    ranks = occurrence_ranks(cells)
+    order = np.argsort(ranks, kind="stable")
+    return np.split(order, np.cumsum(np.bincount(ranks))[:-1]) if len(cells) else []
+
+# Splits a batch of packets into slices that end where the deletion window runs out,
+# calling apply on each slice and handle_deletions after the slice that empties it.
+def process_in_windows(filter, num_packets, apply):
+    start = 0
+    while start < num_packets:
+        stop = min(num_packets, start + max(filter.time_before_deletion, 1))
+        apply(start, stop)
+        filter.time_before_deletion -= stop - start
+        if filter.time_before_deletion <= 0:
+            filter.handle_deletions()
+        start = stop
+
 class DBF:
-    def __init__(self, hash_fns, table_size, deletion_window=6000000):
-        self.table = [(0, "unused")] * table_size
+    def __init__(self, hash_fns, table_size, deletion_window=6000000, max_count=4):
+        # cell counters, saturating at max_count, and whether the cell was used during
+        # the current window
+        self.max_count = max_count
+        self.counts = np.zeros(table_size, dtype=np.uint8 if max_count <= np.iinfo(np.uint8).max else np.uint32)
+        self.used = np.zeros(table_size, dtype=bool)
         self.hash_fns = generate_hash_functions(hash_fns)
+        self.seeds = list(range(hash_fns))
         self.deletion_window = deletion_window
         self.time_before_deletion = self.deletion_window
+    def indices(self, flow_id, state):
+        return [hash_fn((flow_id, state)) % len(self.counts) for hash_fn in self.hash_fns]
     def insert_entry(self, flow_id, state):
-        indices = [hash_fn((flow_id, state)) % len(self.table) for hash_fn in self.hash_fns]
         # increment the count of each index
-        for index in indices:
-            self.table[index] = (min(4, self.table[index][0] + 1), "used")
+        for index in self.indices(flow_id, state):
+            self.counts[index] = min(self.max_count, int(self.counts[index]) + 1)
+            self.used[index] = True
     def delete_entry(self, flow_id, state):
-        indices = [hash_fn((flow_id, state)) % len(self.table) for hash_fn in self.hash_fns]
-        # decrement the count of each index
-        for index in indices:
-            self.table[index] = (max(self.table[index][0] - 1, 0), self.table[index][1]) # preserve the state
+        # decrement the count of each index, preserving the used flag
+        for index in self.indices(flow_id, state):
+            self.counts[index] = max(int(self.counts[index]) - 1, 0)
     def handle_deletions(self):
         self.time_before_deletion = self.deletion_window
-        print("deleting {0} entries".format(len([entry for entry in self.table if entry[1] == "unused" and entry[0] > 0])))
-        for i in range(len(self.table)):
-            if self.table[i][1] == "unused":
-                self.table[i] = (0, "unused")
-            else:
-                self.table[i] = (self.table[i][0], "unused")
+        print("deleting {0} entries".format(np.count_nonzero(~self.used & (self.counts > 0))))
+        self.counts[~self.used] = 0
+        self.used[:] = False
     def modify_entry(self, flow_id, og_state, new_state):
         self.delete_entry(flow_id, og_state)
         self.insert_entry(flow_id, new_state)
@@ -49,55 +77,105 @@ class DBF:
             self.modify_entry(flow_id, packet[0], packet[1])
         if self.time_before_deletion <= 0:
             self.handle_deletions()
+    # Columnar process_packet: a modify is a delete of (flow, from) and an insert of
+    # (flow, to). The counter updates of a window slice are applied in packet order,
+    # every packet's deletes before its inserts, as process_packet would.
+    def process_packets(self, flow_ids, froms, tos):
+        flow_ids, froms, tos = np.asarray(flow_ids), np.asarray(froms), np.asarray(tos)
+        triggers = (froms != -1) & (tos != -1)
+        first = triggers & (froms == 1) & (tos == 2)
+        deletes = seeded_hash_matrix(zip(flow_ids.tolist(), froms.tolist()), self.seeds) % np.uint64(len(self.counts))
+        inserts = seeded_hash_matrix(zip(flow_ids.tolist(), np.where(first, 2, tos).tolist()), self.seeds) % np.uint64(len(self.counts))
+        def apply(start, stop):
+            packets = np.flatnonzero(triggers[start:stop]) + start
+            cells = np.concatenate((deletes[packets], inserts[packets]), axis=1).astype(np.intp)
+            steps = np.ones(cells.shape, dtype=np.int64)
+            # a first packet only inserts
+            steps[:, :len(self.seeds)] = np.where(first[packets], 0, -1)[:, None]
+            keep = steps.ravel() != 0
+            self.step_counts(cells.ravel()[keep], steps.ravel()[keep])
+        process_in_windows(self, len(flow_ids), apply)
+    # Saturating +1/-1 updates of the counters, each cell's applied in the given order
+    def step_counts(self, cells, steps):
+        for updates in update_rounds(cells):
+            hit = cells[updates]
+            self.counts[hit] = np.clip(self.counts[hit].astype(np.int64) + steps[updates], 0, self.max_count)
+        self.used[cells[steps > 0]] = True
     def lookup_entry(self, flow_id, state):
-        indices = [hash_fn((flow_id, state)) % len(self.table) for hash_fn in self.hash_fns]
-        counts = [self.table[index][0] for index in indices]
+        counts = [self.counts[index] for index in self.indices(flow_id, state)]
         return all(count > 0 for count in counts)
+    # the bits of a count of at most max_count and the used flag per cell in theory
+    def memory_report(self):
+        active_flows = int(self.counts.sum()) // len(self.hash_fns)
+        cell_bits = self.max_count.bit_length() + 1
+        return build_memory_report(len(self.counts) * cell_bits, deep_sizeof(self), active_flows)
 
-# make a DBF with 3 hash functions and 256k cells
-dbf = DBF(3, 256*1024)
-# Make a bunch of random packets
-packets = [random.randint(1, 10) for _ in range(100000)]
-# insert half of packets
-print("inserting entries")
-for i in range(len(packets) // 2):
-    dbf.insert_entry(i, packets[i])
-print("Check for no fn")
-for i in range(len(packets) // 2):
-    assert dbf.lookup_entry(i, packets[i])
-fp = 0
-print("calculating Fp rate")
-for i in range(len(packets) // 2, len(packets)):
-    if dbf.lookup_entry(i, packets[i]):
-        fp += 1
-print("Fp rate: ", fp / (len(packets) // 2))
-k = 3
-m = 256*1024
-n = len(packets) // 2
-print("Theoretical Fp rate: ", (1 - (1 - 1/m)**(k*n))**k)
+def test_dbf():
+    # make a DBF with 3 hash functions and 256k cells
+    dbf = DBF(3, 256*1024)
+    # Make a bunch of random packets
+    packets = [random.randint(1, 10) for _ in range(100000)]
+    # insert half of packets
+    print("inserting entries")
+    for i in range(len(packets) // 2):
+        dbf.insert_entry(i, packets[i])
+    print("Check for no fn")
+    for i in range(len(packets) // 2):
+        assert dbf.lookup_entry(i, packets[i])
+    fp = 0
+    print("calculating Fp rate")
+    for i in range(len(packets) // 2, len(packets)):
+        if dbf.lookup_entry(i, packets[i]):
+            fp += 1
+    print("Fp rate: ", fp / (len(packets) // 2))
+    k = 3
+    m = 256*1024
+    n = len(packets) // 2
+    print("Theoretical Fp rate: ", (1 - (1 - 1/m)**(k*n))**k)
+    # wider counters only saturate at max_count
+    wide = DBF(1, 8, max_count=300)
+    for _ in range(400):
+        wide.insert_entry(1, 2)
+    assert wide.counts.max() == 300
+    wide.step_counts(np.repeat(wide.indices(1, 2), 1000), np.full(1000, -1))
+    assert wide.counts.max() == 0
 
 
-print("DBF test passed")
+    print("DBF test passed")
 
 class FCF:
     def __init__(self, hash_fns, table_size, cells_per_bucket, fingerprint_size, deletion_window=6000000):
         self.cells_per_bucket = cells_per_bucket
         self.hash_fns = generate_hash_functions(hash_fns)
+        self.seeds = list(range(hash_fns)) + [hash_fns + 8]
         self.subtable_size = table_size // hash_fns
         self.table = [[[] for __ in range (self.subtable_size)] for _ in range(hash_fns)]
         self.deletion_window = deletion_window
         self.time_before_deletion = self.deletion_window
         fingerprint_hasher = generate_hash_fn(hash_fns + 8)
+        self.fingerprint_size = fingerprint_size
         self.fingerprint_fn = lambda x: fingerprint_hasher(x) % (2 ** fingerprint_size)
         self.started_ids = set()
+
+    # bucket index in each subtable and fingerprint of a flow
+    def locate(self, flow_id):
+        return [hash_fn(flow_id) % self.subtable_size for hash_fn in self.hash_fns], self.fingerprint_fn(flow_id)
+
+    # locate() for every distinct flow of a batch in one hashing pass
+    def locate_many(self, flow_ids):
+        flows = list(dict.fromkeys(flow_ids))
+        hashes = seeded_hash_matrix(flows, self.seeds)
+        indices = (hashes[:, :-1] % np.uint64(self.subtable_size)).tolist()
+        fingerprints = (hashes[:, -1] % np.uint64(2 ** self.fingerprint_size)).tolist()
+        return {flow: (index, fingerprint) for flow, index, fingerprint in zip(flows, indices, fingerprints)}
         
-    def insert_entry(self, flow_id, state):
-        if(self.lookup_entry(flow_id) != None):
+    def insert_entry(self, flow_id, state, location=None):
+        potential_indices, fingerprint = location or self.locate(flow_id)
+        if(self.lookup_entry(flow_id, location=(potential_indices, fingerprint)) != None):
             return
-        potential_indices = [hash_fn(flow_id) % self.subtable_size for hash_fn in self.hash_fns]
         sizes = [len(self.table[i][potential_indices[i]]) for i in range(len(potential_indices))]
         smallest_bucket_index = sizes.index(min(sizes))
-        self.table[smallest_bucket_index][potential_indices[smallest_bucket_index]].append((self.fingerprint_fn(flow_id), state, 1))
+        self.table[smallest_bucket_index][potential_indices[smallest_bucket_index]].append((fingerprint, state, 1))
         if len(self.table[smallest_bucket_index][potential_indices[smallest_bucket_index]]) > self.cells_per_bucket:
             cnt = 0
             for st in self.table:
@@ -107,18 +185,19 @@ class FCF:
             self.handle_deletions()
             print(f"WARNING: Bucket overflow. total of {len(self.started_ids)} flows started.")
         
-    def modify_entry(self, flow_id, og_state, new_state):
-        deletions = self.delete_entry(flow_id, og_state)
+    def modify_entry(self, flow_id, og_state, new_state, location=None):
+        location = location or self.locate(flow_id)
+        deletions = self.delete_entry(flow_id, og_state, location=location)
         if deletions > 0:
-            self.insert_entry(flow_id, new_state)
+            self.insert_entry(flow_id, new_state, location=location)
         
-    def lookup_entry(self, flow_id, st=None):
-        potential_indices = [hash_fn(flow_id) % self.subtable_size for hash_fn in self.hash_fns]
+    def lookup_entry(self, flow_id, st=None, location=None):
+        potential_indices, flow_fingerprint = location or self.locate(flow_id)
         # if the fingerprint occurs more than once, return IDK
         result = None
         for i in range(len(potential_indices)):
             for fingerprint, state, _ in self.table[i][potential_indices[i]]:
-                if fingerprint == self.fingerprint_fn(flow_id):
+                if fingerprint == flow_fingerprint:
                     if result is not None:
                         return "IDK"
                     result = state
@@ -126,32 +205,62 @@ class FCF:
             return result
         return result == st
 
-    def delete_entry(self, flow_id, og_state):
-        potential_indices = [hash_fn(flow_id) % self.subtable_size for hash_fn in self.hash_fns]
+    def delete_entry(self, flow_id, og_state, location=None):
+        potential_indices, flow_fingerprint = location or self.locate(flow_id)
         num_deleted = 0
         for i in range(len(potential_indices)):
             for j, (fingerprint, state, _) in enumerate(self.table[i][potential_indices[i]]):
-                if fingerprint == self.fingerprint_fn(flow_id) and state == og_state:
+                if fingerprint == flow_fingerprint and state == og_state:
                     num_deleted += 1
                     del self.table[i][potential_indices[i]][j]
         return num_deleted
         
-    def process_packet(self, flow_id, packet):
+    def process_packet(self, flow_id, packet, location=None):
         self.time_before_deletion -= 1
         if -1 not in packet and flow_id not in self.started_ids:
             self.started_ids.add(flow_id)
-            self.insert_entry(flow_id, max(1, packet[1]))
+            self.insert_entry(flow_id, max(1, packet[1]), location=location)
         elif -1 not in packet:
-            self.modify_entry(flow_id, packet[0], packet[1])
+            self.modify_entry(flow_id, packet[0], packet[1], location=location)
         if self.time_before_deletion <= 0:
             self.handle_deletions()
 
+    # Columnar process_packet. Bucket overflows can trigger a deletion pass mid-batch, so
+    # trigger packets are still applied one at a time and in order; the gain is that
+    # every flow is hashed once per batch and packets without a trigger only advance the
+    # deletion clock.
+    def process_packets(self, flow_ids, froms, tos):
+        flow_ids, froms, tos = np.asarray(flow_ids), np.asarray(froms), np.asarray(tos)
+        triggers = np.flatnonzero((froms != -1) & (tos != -1))
+        locations = self.locate_many(flow_ids[triggers].tolist())
+        done = 0
+        for i in triggers.tolist():
+            self.advance_clock(i - done)
+            flow_id = flow_ids[i].item()
+            self.process_packet(flow_id, (froms[i].item(), tos[i].item()), location=locations[flow_id])
+            done = i + 1
+        self.advance_clock(len(flow_ids) - done)
+
+    # packets without a trigger only move the deletion clock
+    def advance_clock(self, packets):
+        while packets > 0:
+            step = min(packets, self.time_before_deletion)
+            self.time_before_deletion -= step
+            packets -= step
+            if self.time_before_deletion <= 0:
+                self.handle_deletions()
+
     def handle_deletions(self):
         self.time_before_deletion = self.deletion_window
         # delete all entries with flag 0
         for i in range(len(self.table)):
             for j in range(len(self.table[i])):
                 self.table[i][j] = [(id, state, 0) for (id,state, flag) in self.table[i][j] if flag == 1]
+    # fingerprint, state and flag of every cell in theory, every entry is one flow
+    def memory_report(self):
+        cells = len(self.table) * self.subtable_size * self.cells_per_bucket
+        active_flows = sum(len(bucket) for subtable in self.table for bucket in subtable)
+        return build_memory_report(cells * (self.fingerprint_size + STATE_BITS + 1), deep_sizeof(self), active_flows)
 
 
 next_flow_id = 0
@@ -182,6 +291,16 @@ def make_flows(num_flows):
     types = ['i'] * 3 + ['n'] * 3 + ['r'] * 3
     return [make_flow(random.choice(types)) for _ in range(num_flows)] 
 
+# The same flows for a FlowScheduler, which keeps the types as codes into FLOW_CODES
+FLOW_CODES = ('i', 'n', 'r')
+NUM_TRANSITIONS = np.array([9, 8, 0])
+MAX_PACKETS = 140
+BATCH_SIZE = 65536
+
+def make_flow_packets(rng, types):
+    lengths = rng.integers(60, MAX_PACKETS + 1, len(types))
+    return (lengths,) + sequential_packets(rng, lengths, NUM_TRANSITIONS[types], MAX_PACKETS)
+
 
 """
 We can define rules for the various operations. Below,
@@ -205,28 +324,33 @@ value i or DK (and at least one cell has value i), return
 i. If there is more than one value in the cells, the item
 is not in the set.
     """
+# the states are ints, IDK is kept as -1 in the state array
+IDK_STATE = -1
+
 class SBF:
     def __init__(self, hash_fns, table_size, deletion_window=6000000):
-        self.table = [(0, 0, "unused")] * table_size # (state, count, used flag)
+        # (state, count, used flag) of every cell as three arrays
+        self.states = np.zeros(table_size, dtype=np.int64)
+        self.counts = np.zeros(table_size, dtype=np.int64)
+        self.used = np.zeros(table_size, dtype=bool)
         self.hash_fns = generate_hash_functions(hash_fns)
+        self.seeds = list(range(hash_fns))
         self.deletion_window = deletion_window
         self.time_before_deletion = self.deletion_window
+    def indices(self, flow_id):
+        return [hash_fn(flow_id) % len(self.states) for hash_fn in self.hash_fns]
     def insert_entry(self, flow_id, state):
-        indices = [hash_fn(flow_id) % len(self.table) for hash_fn in self.hash_fns]
-        for index in indices:
-            if self.table[index][1] == 0:
-                self.table[index] = (state, 1, "used")
-            elif self.table[index][0] == state:
-                self.table[index] = (state, self.table[index][1] + 1, "used")
-            elif self.table[index][0] != state:
-                self.table[index] = ("IDK", self.table[index][1] + 1, "used")
+        for index in self.indices(flow_id):
+            if self.counts[index] == 0:
+                self.states[index] = state
+            elif self.states[index] != state:
+                self.states[index] = IDK_STATE
+            self.counts[index] += 1
+            self.used[index] = True
     def modify_entry(self, flow_id, state):
-        indices = [hash_fn(flow_id) % len(self.table) for hash_fn in self.hash_fns]
-        for index in indices:
-            if self.table[index][1] == 1:
-                self.table[index] = (state, self.table[index][1], "used")
-            else:
-                self.table[index] = ("IDK", self.table[index][1], "used")
+        for index in self.indices(flow_id):
+            self.states[index] = state if self.counts[index] == 1 else IDK_STATE
+            self.used[index] = True
     def process_packet(self, flow_id, packet):
         self.time_before_deletion -= 1
         if packet == (1, 2): # first real packet
@@ -235,59 +359,126 @@ class SBF:
             self.modify_entry(flow_id, packet[1])
         if self.time_before_deletion <= 0:
             self.handle_deletions()
+    # Columnar process_packet, the cell updates of a window slice applied in packet order
+    def process_packets(self, flow_ids, froms, tos):
+        flow_ids, froms, tos = np.asarray(flow_ids), np.asarray(froms), np.asarray(tos)
+        triggers = (froms != -1) & (tos != -1)
+        first = triggers & (froms == 1) & (tos == 2)
+        indices = (seeded_hash_matrix(flow_ids.tolist(), self.seeds) % np.uint64(len(self.states))).astype(np.intp)
+        def apply(start, stop):
+            packets = np.flatnonzero(triggers[start:stop]) + start
+            k = indices.shape[1]
+            self.update_cells(indices[packets].ravel(), np.repeat(first[packets], k),
+                              np.repeat(np.where(first[packets], 2, tos[packets]), k))
+        process_in_windows(self, len(flow_ids), apply)
+    # Inserts (where insert is set) and modifies of cells to states, each cell's applied
+    # in the given order with the rules of insert_entry and modify_entry
+    def update_cells(self, cells, insert, states):
+        for updates in update_rounds(cells):
+            hit, inserting, new = cells[updates], insert[updates], states[updates]
+            counts, current = self.counts[hit], self.states[hit]
+            inserted = np.where(counts == 0, new, np.where(current == new, current, IDK_STATE))
+            modified = np.where(counts == 1, new, IDK_STATE)
+            self.states[hit] = np.where(inserting, inserted, modified)
+            self.counts[hit] = counts + inserting
+            self.used[hit] = True
     def handle_deletions(self):
         self.time_before_deletion = self.deletion_window
-        for i in range(len(self.table)):
-            if self.table[i][2] == "unused":
-                self.table[i] = (0, 0, "unused")
-            else:
-                self.table[i] = (self.table[i][0], self.table[i][1], "unused")
+        self.states[~self.used] = 0
+        self.counts[~self.used] = 0
+        self.used[:] = False
     def lookup_entry(self, flow_id, state):
-        indices = [hash_fn(flow_id) % len(self.table) for hash_fn in self.hash_fns]
-        states = [self.table[index][0] for index in indices]
+        states = [self.states[index] for index in self.indices(flow_id)]
         # We can only have state and IDK in the table
-        if all(s == "IDK" for s in states):
+        if all(s == IDK_STATE for s in states):
             return "IDK"
-        return all(s == "IDK" or s == state for s in states)
+        return all(s == IDK_STATE or s == state for s in states)
+    # a state and the used flag per cell in theory
+    def memory_report(self):
+        active_flows = int(self.counts.sum()) // len(self.hash_fns)
+        return build_memory_report(len(self.states) * (STATE_BITS + 1), deep_sizeof(self), active_flows)
 
 
-filters = [
-    SBF(3, 256*1024),
-    SBF(4, 512*1024),
-    SBF(5, 1024*1024),
-    DBF(3, 256*1024),
-    DBF(4, 512*1024),
-    DBF(5, 1024*1024),
-    FCF(3, 6*1024, 6, 10),
-    FCF(4, 8*1024, 6, 10),
-    FCF(4, 16*1024, 6, 18)
-]
-for fcf in filters:
-    flows = make_flows(60000)
-    finished_flows = 0
-    fn = 0
-    fp = 0
-    idk = 0
-    total = 0
-    while finished_flows < 1000000:
-        total += 1
-        # pick a random flow
+# process_packets has to end up where one process_packet call per packet does
+def test_process_packets():
+    random.seed(0)
+    flows = make_flows(300)
+    packets = []
+    while flows:
         flow = random.choice(flows)
-        # pop the first packet
-        packet = flow[2].popleft()
-        # process the packet
-        fcf.process_packet(flow[1], packet)
-        # if the flow is done, increment finished_flows, remove the flow, and make a new flow of the same type
+        packets.append((flow[1],) + flow[2].popleft())
         if not flow[2]:
-            if fcf.lookup_entry(flow[1], 10) == "IDK":
-                idk += 1
-            # if flow is i and state is not 10, increment fn
-            elif flow[0] == 'i' and not fcf.lookup_entry(flow[1], 10):
-                fn += 1
-            # if flow is not i and state is 10, increment fp
-            elif flow[0] != 'i' and fcf.lookup_entry(flow[1], 10):
-                fp += 1
-            finished_flows += 1
             flows.remove(flow)
-            flows.append(make_flow(flow[0]))
-    print(f"IDK: {idk}, FN: {fn}, FP: {fp}, Total: {finished_flows}, Total packets: {total}")
+    flow_ids, froms, tos = (np.array(column) for column in zip(*packets))
+    # the small tables saturate and share cells between flows, where the order of
+    # updates from different flows matters
+    for make_filter in (lambda: DBF(3, 1 << 16, deletion_window=7000),
+                        lambda: DBF(2, 50, deletion_window=7000, max_count=2),
+                        lambda: SBF(3, 1 << 16, deletion_window=7000),
+                        lambda: SBF(2, 50, deletion_window=7000),
+                        lambda: FCF(3, 3 * 1024, 6, 10, deletion_window=7000)):
+        single, batched = make_filter(), make_filter()
+        for flow_id, state_from, state_to in packets:
+            single.process_packet(flow_id, (state_from, state_to))
+        for start in range(0, len(packets), 2500):
+            batched.process_packets(flow_ids[start:start + 2500], froms[start:start + 2500], tos[start:start + 2500])
+        assert single.time_before_deletion == batched.time_before_deletion
+        if isinstance(single, FCF):
+            assert single.table == batched.table
+        else:
+            for name in ("states", "counts", "used"):
+                if hasattr(single, name):
+                    assert (getattr(single, name) == getattr(batched, name)).all(), name
+
+
+if __name__ == "__main__":
+    test_dbf()
+    test_process_packets()
+
+    filters = [
+        SBF(3, 256*1024),
+        SBF(4, 512*1024),
+        SBF(5, 1024*1024),
+        DBF(3, 256*1024),
+        DBF(4, 512*1024),
+        DBF(5, 1024*1024),
+        FCF(3, 6*1024, 6, 10),
+        FCF(4, 8*1024, 6, 10),
+        FCF(4, 16*1024, 6, 18)
+    ]
+    for fcf in filters:
+        rng = np.random.default_rng()
+        scheduler = FlowScheduler(make_flow_packets, rng.integers(0, len(FLOW_CODES), 60000), MAX_PACKETS,
+                                  seed=rng.integers(2 ** 32))
+        finished_flows = 0
+        fn = 0
+        fp = 0
+        idk = 0
+        total = 0
+        while finished_flows < 1000000:
+            # the next packets of randomly picked active flows, finished flows are
+            # replaced by new flows of the same type
+            flow_ids, types, froms, tos, last = scheduler.draw(BATCH_SIZE)
+            ends = np.flatnonzero(last)
+            if finished_flows + len(ends) > 1000000:
+                ends = ends[:1000000 - finished_flows]
+                flow_ids, froms, tos = (column[:ends[-1] + 1] for column in (flow_ids, froms, tos))
+            total += len(flow_ids)
+            # the batch is applied up to each flow's last packet and the flow checked
+            # right there, before any later packet can age or overwrite its entry
+            start = 0
+            for end, flow_id, flow_type in zip(ends.tolist(), flow_ids[ends].tolist(), types[ends].tolist()):
+                fcf.process_packets(flow_ids[start:end + 1], froms[start:end + 1], tos[start:end + 1])
+                start = end + 1
+                response = fcf.lookup_entry(flow_id, 10)
+                if response == "IDK":
+                    idk += 1
+                # if flow is i and state is not 10, increment fn
+                elif FLOW_CODES[flow_type] == 'i' and not response:
+                    fn += 1
+                # if flow is not i and state is 10, increment fp
+                elif FLOW_CODES[flow_type] != 'i' and response:
+                    fp += 1
+            fcf.process_packets(flow_ids[start:], froms[start:], tos[start:])
+            finished_flows += len(ends)
+        print(f"IDK: {idk}, FN: {fn}, FP: {fp}, Total: {finished_flows}, Total packets: {total}")
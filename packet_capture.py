@@ -0,0 +1,546 @@
+"""
+Packet captures as workloads: a pcap or pcapng file is memory-mapped, the IPv4/IPv6
+5-tuples of its packets are extracted a batch at a time with NumPy and a rule turns
+them into flow ids and state transitions. PacketCapture.batches() yields the same
+(flow_ids, flow_types, states_from, states_to) columns as stream_packets and
+PacketTrace.batches, so a capture can drive a FilterDriver, the packet service or be
+written to a packet trace for replaying, whatever its size. drive_filter() scores a
+filter against the flows' own states; the run_experiments simulators do not take
+captures, as they score flows by whether generated 'interesting' flows reach state 10.
+
+Only walking from one record to the next is done in Python, as every record's length
+decides where the next one starts; the headers themselves are read with array indexing
+into the mapped file. Non-IP packets and packets cut off before their transport header
+are skipped and counted.
+"""
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from filter_driver import FILTERS, FilterDriver
+from packet_generator import FLOW_TYPES
+from packet_trace import open_trace, write_trace
+
+# link-layer header types, as numbered by tcpdump.org
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+# pcap file magic -> (byte order, seconds per timestamp fraction)
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_INTERFACE = 1
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+# IPv6 extension headers skipped to reach the transport header
+IPV6_EXTENSIONS = (0, 43, 60)
+IPV6_FRAGMENT = 44
+MAX_EXTENSION_HEADERS = 4
+TCP, UDP, SCTP = 6, 17, 132
+
+# One IP packet; IPv4 addresses are stored IPv4-mapped (::ffff:a.b.c.d), ports are 0
+# for other protocols and for fragments past the first
+HEADER_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("length", "<u4"),
+    ("proto", "u1"),
+    ("src", "u1", (16,)),
+    ("dst", "u1", (16,)),
+    ("src_port", "<u2"),
+    ("dst_port", "<u2"),
+    ("tcp_flags", "u1"),
+])
+
+
+def gather(data, offsets, width):
+    # the width bytes at each of offsets as an (n, width) matrix; offsets past the end
+    # of data read its last byte, the callers check lengths against the capture length
+    index = np.asarray(offsets, dtype=np.int64)[:, None] + np.arange(width)
+    return data[np.clip(index, 0, len(data) - 1)]
+
+
+def read_u8(data, offsets):
+    return gather(data, offsets, 1)[:, 0]
+
+
+def read_be16(data, offsets):
+    pairs = gather(data, offsets, 2).astype(np.uint16)
+    return pairs[:, 0] << 8 | pairs[:, 1]
+
+
+def parse_headers(data, starts, caplens, lengths, timestamps, linktypes):
+    # HEADER_DTYPE records of the IP packets among the captured frames at starts, and
+    # how many frames were skipped
+    starts = np.asarray(starts, dtype=np.int64)
+    end = starts + caplens
+
+    # network header offset and IP version by link type
+    ethertype = read_be16(data, starts + 12)
+    ethernet_l3 = starts + 14
+    for _ in range(2):
+        tagged = np.isin(ethertype, ETHERTYPE_VLAN)
+        ethertype = np.where(tagged, read_be16(data, ethernet_l3 + 2), ethertype)
+        ethernet_l3 = np.where(tagged, ethernet_l3 + 4, ethernet_l3)
+    sll_type = read_be16(data, starts + 14)
+    l3 = np.select(
+        [linktypes == LINKTYPE_ETHERNET, linktypes == LINKTYPE_LINUX_SLL, linktypes == LINKTYPE_NULL],
+        [ethernet_l3, starts + 16, starts + 4], starts)
+    ethertype = np.where(linktypes == LINKTYPE_LINUX_SLL, sll_type, ethertype)
+    version = read_u8(data, l3) >> 4
+    by_type = np.where(ethertype == ETHERTYPE_IPV4, 4, np.where(ethertype == ETHERTYPE_IPV6, 6, 0))
+    framed = np.isin(linktypes, (LINKTYPE_ETHERNET, LINKTYPE_LINUX_SLL))
+    version = np.where(framed & (by_type != version), 0, version)
+    version = np.where(linktypes == LINKTYPE_IPV4, np.where(version == 4, 4, 0), version)
+    version = np.where(linktypes == LINKTYPE_IPV6, np.where(version == 6, 6, 0), version)
+    known = np.isin(linktypes, (LINKTYPE_NULL, LINKTYPE_ETHERNET, LINKTYPE_RAW, LINKTYPE_LINUX_SLL,
+                                LINKTYPE_IPV4, LINKTYPE_IPV6))
+    v4 = known & (version == 4) & (l3 + 20 <= end)
+    v6 = known & (version == 6) & (l3 + 40 <= end)
+
+    # transport header offset, protocol and whether it is a later fragment
+    ihl = (read_u8(data, l3) & 15).astype(np.int64) * 4
+    v4 &= ihl >= 20
+    proto = np.where(v4, read_u8(data, l3 + 9), read_u8(data, l3 + 6))
+    l4 = np.where(v4, l3 + ihl, l3 + 40)
+    fragmented = v4 & ((read_be16(data, l3 + 6) & 0x1FFF) != 0)
+    for _ in range(MAX_EXTENSION_HEADERS):
+        extension = v6 & np.isin(proto, IPV6_EXTENSIONS)
+        fragment = v6 & (proto == IPV6_FRAGMENT)
+        if not (extension.any() or fragment.any()):
+            break
+        size = np.where(fragment, 8, (read_u8(data, l4 + 1).astype(np.int64) + 1) * 8)
+        fragmented |= fragment & ((read_be16(data, l4 + 2) & 0xFFF8) != 0)
+        skip = extension | fragment
+        proto = np.where(skip, read_u8(data, l4), proto)
+        l4 = np.where(skip, l4 + size, l4)
+
+    kept = np.flatnonzero(v4 | v6)
+    v4, l3, l4, proto, fragmented, end = v4[kept], l3[kept], l4[kept], proto[kept], fragmented[kept], end[kept]
+    headers = np.zeros(len(kept), dtype=HEADER_DTYPE)
+    headers["timestamp"] = np.asarray(timestamps)[kept]
+    headers["length"] = np.asarray(lengths)[kept]
+    headers["proto"] = proto
+    for field, v4_offset, v6_offset in (("src", 12, 8), ("dst", 16, 24)):
+        addresses = np.where(v4[:, None], 0, gather(data, l3 + v6_offset, 16))
+        addresses[v4, 10:12] = 0xFF
+        addresses[v4, 12:] = gather(data, l3[v4] + v4_offset, 4)
+        headers[field] = addresses
+    has_ports = np.isin(proto, (TCP, UDP, SCTP)) & ~fragmented & (l4 + 4 <= end)
+    headers["src_port"] = np.where(has_ports, read_be16(data, l4), 0)
+    headers["dst_port"] = np.where(has_ports, read_be16(data, l4 + 2), 0)
+    headers["tcp_flags"] = np.where(has_ports & (proto == TCP) & (l4 + 14 <= end), read_u8(data, l4 + 13), 0)
+    return headers, len(starts) - len(kept)
+
+
+def mix64(values):
+    # splitmix64 finalizer over a uint64 array
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def flow_keys(headers, bidirectional=True, seed=0):
+    # Non-negative int64 flow id of each packet's 5-tuple. With bidirectional both
+    # directions of a connection get the same id: the endpoints are put in a fixed order
+    # before hashing.
+    count = len(headers)
+    ends = []
+    for address, port in (("src", "src_port"), ("dst", "dst_port")):
+        port_bytes = headers[port].astype(">u2").view(np.uint8).reshape(count, 2)
+        ends.append(np.concatenate([headers[address], port_bytes], axis=1))
+    first, second = ends
+    if bidirectional and count:
+        differ = (first != second).argmax(axis=1)
+        rows = np.arange(count)
+        swap = (first[rows, differ] > second[rows, differ])[:, None]
+        first, second = np.where(swap, second, first), np.where(swap, first, second)
+    key = np.zeros((count, 40), dtype=np.uint8)
+    key[:, :18] = first
+    key[:, 18:36] = second
+    key[:, 36] = headers["proto"]
+    words = key.view("<u8")
+    hashed = np.full(count, np.uint64(0x9E3779B97F4A7C15) ^ np.uint64(seed), dtype=np.uint64)
+    for column in range(words.shape[1]):
+        hashed = mix64(hashed ^ words[:, column])
+    return (hashed >> np.uint64(1)).astype(np.int64)
+
+
+# TCP flag bits
+FIN, SYN, RST, ACK = 0x01, 0x02, 0x04, 0x10
+# Transitions of the default rule's connection state machine, 1 new, 2 SYN sent, 3 SYN
+# acknowledged, 4 closing, 5 reset, as (flags set, flags clear, state_from, state_to);
+# the first matching entry applies
+TCP_TRIGGERS = (
+    (RST, 0, 3, 5),
+    (SYN, ACK, 1, 2),
+    (SYN | ACK, 0, 2, 3),
+    (FIN, SYN, 3, 4),
+)
+
+
+def tcp_state_rule(headers):
+    # The default rule: a flow per connection, TCP connections stepping through the
+    # states of TCP_TRIGGERS as 'interesting' flows, everything else 'random' flows
+    # without transitions. A rule takes a batch of HEADER_DTYPE records and returns the
+    # (flow_ids, flow_types, states_from, states_to) columns.
+    flags = headers["tcp_flags"]
+    tcp = headers["proto"] == TCP
+    states_from = np.full(len(headers), -1, dtype=np.int8)
+    states_to = np.full(len(headers), -1, dtype=np.int8)
+    for set_flags, clear_flags, state_from, state_to in reversed(TCP_TRIGGERS):
+        match = tcp & ((flags & set_flags) == set_flags) & ((flags & clear_flags) == 0)
+        states_from[match] = state_from
+        states_to[match] = state_to
+    flow_types = np.where(tcp, FLOW_TYPES.index("interesting"), FLOW_TYPES.index("random")).astype(np.int8)
+    return flow_keys(headers), flow_types, states_from, states_to
+
+
+def if_tsresol(value):
+    # seconds per timestamp tick of a pcapng if_tsresol option
+    return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+
+
+class PacketCapture:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = np.frombuffer(self.map, dtype=np.uint8)
+        magic = bytes(self.map[:4])
+        if magic in PCAP_MAGIC:
+            self.format = "pcap"
+        elif magic == struct.pack("<I", PCAPNG_SECTION_HEADER):
+            self.format = "pcapng"
+        else:
+            self.close()
+            raise ValueError(f"{path} is not a pcap or pcapng capture")
+        self.frames = 0
+        self.skipped = 0
+
+    def records(self, batch_size):
+        # (starts, caplens, lengths, timestamps, linktypes) arrays of the next batch_size
+        # frames at a time
+        if self.format == "pcap":
+            return self.pcap_records(batch_size)
+        return self.pcapng_records(batch_size)
+
+    def pcap_records(self, batch_size):
+        order, resolution = PCAP_MAGIC[bytes(self.map[:4])]
+        linktype = struct.unpack_from(order + "I", self.map, 20)[0] & 0xFFFF
+        caplen_field = struct.Struct(order + "I").unpack_from
+        offset, size = 24, len(self.map)
+        while offset + 16 <= size:
+            # the loop only follows the record lengths, the record headers are read
+            # as a whole afterwards
+            records = []
+            while len(records) < batch_size and offset + 16 <= size:
+                caplen, = caplen_field(self.map, offset + 8)
+                if offset + 16 + caplen > size:
+                    # a capture cut off mid-record
+                    offset = size
+                    break
+                records.append(offset)
+                offset += 16 + caplen
+            if records:
+                fields = gather(self.data, records, 16).view(order + "u4").astype(np.int64)
+                seconds, fractions, caplens, lengths = fields.T
+                starts = np.array(records, dtype=np.int64) + 16
+                yield starts, caplens, lengths, seconds + fractions * resolution, np.full(len(records), linktype)
+
+    def pcapng_records(self, batch_size):
+        order = "<"
+        offset, size = 0, len(self.map)
+        # link type and seconds per tick of the interfaces of the current section
+        interfaces = []
+        batch = []
+        while offset + 12 <= size:
+            block_type, block_length = struct.unpack_from(order + "II", self.map, offset)
+            if block_type == PCAPNG_SECTION_HEADER:
+                if batch:
+                    # interface ids start over in a new section
+                    yield self.pcapng_batch(batch, interfaces)
+                    batch = []
+                magic, = struct.unpack_from("<I", self.map, offset + 8)
+                order = "<" if magic == PCAPNG_BYTE_ORDER_MAGIC else ">"
+                block_length, = struct.unpack_from(order + "I", self.map, offset + 4)
+                interfaces = []
+            if block_length < 12 or offset + block_length > size:
+                break
+            if block_type == PCAPNG_INTERFACE:
+                linktype, = struct.unpack_from(order + "H", self.map, offset + 8)
+                interfaces.append((linktype, self.interface_resolution(order, offset + 16, offset + block_length - 4)))
+            elif block_type == PCAPNG_ENHANCED_PACKET:
+                interface, high, low, caplen, length = struct.unpack_from(order + "IIIII", self.map, offset + 8)
+                # a capture length past the end of the block would read the next blocks
+                batch.append((offset + 28, min(caplen, block_length - 32), length, high << 32 | low, interface))
+            elif block_type == PCAPNG_SIMPLE_PACKET:
+                length, = struct.unpack_from(order + "I", self.map, offset + 8)
+                batch.append((offset + 12, min(length, block_length - 16), length, 0, 0))
+            offset += block_length
+            if len(batch) == batch_size:
+                yield self.pcapng_batch(batch, interfaces)
+                batch = []
+        if batch:
+            yield self.pcapng_batch(batch, interfaces)
+
+    def interface_resolution(self, order, offset, end):
+        while offset + 4 <= end:
+            code, length = struct.unpack_from(order + "HH", self.map, offset)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                return if_tsresol(self.map[offset + 4])
+            offset += 4 + -(-length // 4) * 4
+        return 1e-6
+
+    def pcapng_batch(self, batch, interfaces):
+        starts, caplens, lengths, ticks, interface = np.array(batch, dtype=np.int64).T
+        linktypes = np.array([linktype for linktype, _ in interfaces] or [-1])
+        resolutions = np.array([resolution for _, resolution in interfaces] or [1e-6])
+        interface = np.minimum(interface, len(linktypes) - 1)
+        return starts, caplens, lengths, ticks * resolutions[interface], linktypes[interface]
+
+    def headers(self, batch_size=65536):
+        # HEADER_DTYPE records of the capture's IP packets, from batch_size frames at a time
+        for starts, caplens, lengths, timestamps, linktypes in self.records(batch_size):
+            headers, skipped = parse_headers(self.data, starts, caplens, lengths, timestamps, linktypes)
+            self.frames += len(starts)
+            self.skipped += skipped
+            if len(headers):
+                yield headers
+
+    def batches(self, batch_size=65536, rule=tcp_state_rule):
+        # (flow_ids, flow_types, states_from, states_to) columns as rule maps them
+        for headers in self.headers(batch_size):
+            yield rule(headers)
+
+    def close(self):
+        self.data = None
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_capture(path):
+    return path if isinstance(path, PacketCapture) else PacketCapture(path)
+
+
+def capture_to_trace(capture_path, trace_path, rule=tcp_state_rule, batch_size=65536):
+    # Packet trace of a capture for the simulators, which regroup it per flow. Returns
+    # the packet count.
+    with PacketCapture(capture_path) as capture:
+        return write_trace(trace_path, capture.batches(batch_size, rule))
+
+
+def drive_filter(capture_path, driver, rule=tcp_state_rule, batch_size=65536, probes=100000, seed=0):
+    # Streams a capture through a FilterDriver and checks the filter against the flows'
+    # true states afterwards: the current state of every flow the driver still tracks
+    # is looked up (wrong answers, DKs) and so are probes random flow ids (false
+    # positives). The probes are 63-bit, so hitting a flow of the capture is next to
+    # impossible; the few that hit a tracked flow are dropped.
+    packets = transitions = 0
+    start = time.perf_counter()
+    with PacketCapture(capture_path) as capture:
+        for flow_ids, _, states_from, states_to in capture.batches(batch_size, rule):
+            transitions += driver.apply(flow_ids, states_from, states_to)
+            packets += len(flow_ids)
+        skipped = capture.skipped
+    elapsed = time.perf_counter() - start
+
+    flows = list(driver.current)
+    answers = driver.lookup(flows)
+    wrong = sum(answer not in (state, "IDK") for answer, state in zip(answers, driver.current.values()))
+    dont_know = sum(answer == "IDK" for answer in answers)
+    unseen = np.random.default_rng(seed).integers(0, 2 ** 63 - 1, probes).tolist()
+    unseen = [flow for flow in unseen if flow not in driver.current]
+    false_positives = sum(answer not in (None, "IDK") for answer in driver.lookup(unseen))
+    return {
+        'Packets': packets,
+        'Skipped Frames': skipped,
+        'Transitions': transitions,
+        'Packets per Second': packets / elapsed if elapsed else None,
+        'Tracked Flows': len(flows),
+        'Wrong State Rate': wrong / len(flows) if flows else None,
+        'DK Rate': dont_know / len(flows) if flows else None,
+        'FP Rate': false_positives / len(unseen) if unseen else None,
+    }
+
+
+class TestPacketCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "capture")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @staticmethod
+    def ipv4(src, dst, proto, payload, fragment=0):
+        header = struct.pack(">BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), 0, fragment, 64, proto, 0,
+                             bytes(src), bytes(dst))
+        return header + payload
+
+    @staticmethod
+    def ipv6(src, dst, proto, payload):
+        return struct.pack(">IHBB16s16s", 6 << 28, len(payload), proto, 64, bytes(src), bytes(dst)) + payload
+
+    @staticmethod
+    def tcp(src_port, dst_port, flags):
+        return struct.pack(">HHIIBBHHH", src_port, dst_port, 0, 0, 5 << 4, flags, 0, 0, 0)
+
+    @staticmethod
+    def udp(src_port, dst_port):
+        return struct.pack(">HHHH", src_port, dst_port, 8, 0)
+
+    @staticmethod
+    def ethernet(payload, ethertype, vlan=None):
+        tag = struct.pack(">HH", 0x8100, vlan) if vlan is not None else b""
+        return b"\x02" * 6 + b"\x04" * 6 + tag + struct.pack(">H", ethertype) + payload
+
+    def frames(self):
+        a, b = [10, 0, 0, 1], [10, 0, 0, 2]
+        a6, b6 = [0x20, 0x01] + [0] * 13 + [1], [0x20, 0x01] + [0] * 13 + [2]
+        hop_by_hop = struct.pack(">BB6x", UDP, 0)
+        return [
+            self.ethernet(self.ipv4(a, b, TCP, self.tcp(1234, 80, SYN)), ETHERTYPE_IPV4),
+            self.ethernet(self.ipv4(b, a, TCP, self.tcp(80, 1234, SYN | ACK)), ETHERTYPE_IPV4, vlan=7),
+            self.ethernet(self.ipv4(a, b, TCP, self.tcp(1234, 80, ACK)), ETHERTYPE_IPV4),
+            self.ethernet(b"\0" * 28, 0x0806),
+            self.ethernet(self.ipv6(a6, b6, 0, hop_by_hop + self.udp(53, 5353)), ETHERTYPE_IPV6),
+            self.ethernet(self.ipv4(a, b, UDP, self.udp(9, 9), fragment=100), ETHERTYPE_IPV4),
+            self.ethernet(self.ipv4(a, b, TCP, self.tcp(1234, 80, FIN | ACK)), ETHERTYPE_IPV4)[:30],
+            self.ethernet(self.ipv4(b, a, TCP, self.tcp(80, 1234, RST)), ETHERTYPE_IPV4),
+        ]
+
+    def write_pcap(self, frames, linktype=LINKTYPE_ETHERNET):
+        with open(self.path, "wb") as f:
+            f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, linktype))
+            for index, frame in enumerate(frames):
+                f.write(struct.pack("<IIII", 100 + index, 500000, len(frame), len(frame)) + frame)
+
+    def write_pcapng(self, frames, linktypes, caplens=None):
+        def block(block_type, body):
+            body += b"\0" * (-len(body) % 4)
+            return struct.pack("<II", block_type, len(body) + 12) + body + struct.pack("<I", len(body) + 12)
+        with open(self.path, "wb") as f:
+            f.write(block(PCAPNG_SECTION_HEADER, struct.pack("<IHHq", PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1)))
+            for linktype in linktypes:
+                # if_tsresol of 3: millisecond timestamps
+                f.write(block(PCAPNG_INTERFACE, struct.pack("<HHI", linktype, 0, 65535)
+                              + struct.pack("<HHB3x", 9, 1, 3) + struct.pack("<HH", 0, 0)))
+            for index, (interface, frame) in enumerate(frames):
+                f.write(block(PCAPNG_ENHANCED_PACKET,
+                              struct.pack("<IIIII", interface, 0, 2000 + index,
+                                          caplens[index] if caplens else len(frame), len(frame)) + frame))
+
+    def check_headers(self, capture, batch_size):
+        headers = np.concatenate(list(capture.headers(batch_size)))
+        self.assertEqual(capture.skipped, 2)
+        self.assertEqual(headers["proto"].tolist(), [TCP, TCP, TCP, UDP, UDP, TCP])
+        self.assertEqual(headers["src_port"].tolist(), [1234, 80, 1234, 53, 0, 80])
+        self.assertEqual(headers["dst_port"].tolist(), [80, 1234, 80, 5353, 0, 1234])
+        self.assertEqual(headers["tcp_flags"].tolist(), [SYN, SYN | ACK, ACK, 0, 0, RST])
+        self.assertEqual(headers["src"][0].tolist(), [0] * 10 + [255, 255, 10, 0, 0, 1])
+        self.assertEqual(headers["dst"][3].tolist(), [0x20, 0x01] + [0] * 13 + [2])
+        return headers
+
+    def test_pcap(self):
+        self.write_pcap(self.frames())
+        with open_capture(self.path) as capture:
+            headers = self.check_headers(capture, 3)
+            self.assertEqual(capture.frames, 8)
+        self.assertEqual(headers["timestamp"][0], 100.5)
+        # raw IP captures carry no link-layer header
+        self.write_pcap([frame[14:] for frame in self.frames() if frame[12:14] != b"\x81\x00"], LINKTYPE_RAW)
+        with open_capture(self.path) as capture:
+            self.assertEqual(len(np.concatenate(list(capture.headers()))), 5)
+
+    def test_pcapng(self):
+        frames = self.frames()
+        # the second interface captures raw IP
+        self.write_pcapng([(1, frame[14:]) if index == 2 else (0, frame) for index, frame in enumerate(frames)],
+                          [LINKTYPE_ETHERNET, LINKTYPE_RAW])
+        with open_capture(self.path) as capture:
+            headers = self.check_headers(capture, 5)
+        self.assertAlmostEqual(headers["timestamp"][0], 2.0)
+        # a capture length the block cannot hold is cut to the block, so the truncated
+        # frame is still skipped instead of parsed from the blocks after it
+        caplens = [len(frame) for frame in frames]
+        caplens[6] = 1000
+        self.write_pcapng([(0, frame) for frame in frames], [LINKTYPE_ETHERNET], caplens)
+        with open_capture(self.path) as capture:
+            self.check_headers(capture, 5)
+
+    def test_rule_and_flow_keys(self):
+        self.write_pcap(self.frames())
+        with open_capture(self.path) as capture:
+            flow_ids, flow_types, states_from, states_to = (np.concatenate(column)
+                                                            for column in zip(*capture.batches()))
+        # both directions of the connection are one flow
+        self.assertEqual(len(set(flow_ids[[0, 1, 2, 5]].tolist())), 1)
+        self.assertEqual(len(set(flow_ids.tolist())), 3)
+        self.assertTrue((flow_ids >= 0).all())
+        self.assertEqual(states_from.tolist(), [1, 2, -1, -1, -1, 3])
+        self.assertEqual(states_to.tolist(), [2, 3, -1, -1, -1, 5])
+        self.assertEqual([FLOW_TYPES[t] for t in flow_types[[0, 3]]], ["interesting", "random"])
+
+        driver = FilterDriver(FILTERS["array-fcf"](3000, 3))
+        report = drive_filter(self.path, driver, probes=1000)
+        self.assertEqual((report['Packets'], report['Transitions'], report['Skipped Frames']), (6, 3, 2))
+        self.assertEqual(driver.lookup([flow_ids[0]]), [5])
+        self.assertEqual(report['Wrong State Rate'], 0)
+
+        trace_path = os.path.join(self.directory.name, "capture.trace")
+        self.assertEqual(capture_to_trace(self.path, trace_path), 6)
+        np.testing.assert_array_equal(open_trace(trace_path).flow_ids, flow_ids)
+
+    def test_rejects_other_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 64)
+        with self.assertRaises(ValueError):
+            open_capture(self.path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive a filter with the flows of a pcap/pcapng capture")
+    parser.add_argument("capture")
+    parser.add_argument("--filter", default="array-fcf", choices=sorted(FILTERS))
+    parser.add_argument("--cells", type=int, default=262144)
+    parser.add_argument("--hashes", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=65536)
+    parser.add_argument("--trace", default=None, help="write the capture out as a packet trace instead")
+    args = parser.parse_args()
+
+    if args.trace:
+        print(f"{capture_to_trace(args.capture, args.trace, batch_size=args.batch_size)} packets written")
+    else:
+        driver = FilterDriver(FILTERS[args.filter](args.cells, args.hashes))
+        for name, value in drive_filter(args.capture, driver, batch_size=args.batch_size).items():
+            print(f"{name}: {value}")
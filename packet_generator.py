@@ -1,4 +1,7 @@
 import random
+import unittest
+
+import numpy as np
 
 def generate_packets(num_packets, flow_type):
     # contains a list of triggers 
@@ -44,12 +47,147 @@ it is already random so we don't need to randomly choose a flow
 def generate_flows():
     # There are n ≈ 60, 000 active flows in the system.
     num_flows = 60000 
-    flows = []
-    for i in range(num_flows):
+    # returns the flow_id, flow type, and packets associated with the flow type 
+    return list(iter_flows(0, num_flows))
+
+def iter_flows(first_flow_id=0, num_flows=None):
+    # generate_flows() one flow at a time, from first_flow_id on; num_flows=None never
+    # stops, for simulations that run until their estimates are precise enough
+    i = first_flow_id
+    while num_flows is None or i < first_flow_id + num_flows:
         flow_type = random.choices(['interesting', 'noise', 'random'], weights=(30, 30, 40), k=1)[0]
         # Each flow is made up of m≈100±40 packets.
         num_packets = random.randint(60, 140) 
         packets = generate_packets(num_packets, flow_type)
-        flows.append((i, flow_type, packets))
-    # returns the flow_id, flow type, and packets associated with the flow type 
-    return flows
+        yield (i, flow_type, packets)
+        i += 1
+
+
+FLOW_TYPES = ('interesting', 'noise', 'random')
+# number of packets carrying a transition in a flow of each type, as in generate_packets
+NUM_TRANSITIONS = np.array([10, 20, 0])
+# every state a generated flow can be in: interesting flows step from 1 up to 11,
+# noise flows move between 1 and 10
+STATES = tuple(range(1, int(NUM_TRANSITIONS[0]) + 2))
+
+
+def draw_flow_lengths(rng, flow_length, num_flows):
+    # flow_length is an inclusive (low, high) range like random.randint's, or a
+    # callable (rng, num_flows) -> lengths for any other distribution
+    if callable(flow_length):
+        return np.asarray(flow_length(rng, num_flows), dtype=np.int64)
+    low, high = flow_length
+    return rng.integers(low, high + 1, num_flows)
+
+
+def generate_packet_columns(rng, first_flow_id, num_flows, flow_length, type_weights):
+    # All packets of num_flows flows as columns, with the same per-type transition rules
+    # as generate_packets. Packets of different flows are interleaved at random while
+    # every flow keeps its own packets in order.
+    weights = np.asarray(type_weights, dtype=np.float64)
+    types = rng.choice(len(FLOW_TYPES), size=num_flows, p=weights / weights.sum()).astype(np.int8)
+    lengths = draw_flow_lengths(rng, flow_length, num_flows)
+    starts = np.cumsum(lengths) - lengths
+    total = int(lengths.sum())
+    flow = np.repeat(np.arange(num_flows), lengths)
+
+    # each flow's transitions sit at the positions holding its n smallest random keys,
+    # i.e. a uniform sample of n positions like random.sample
+    order = np.lexsort((rng.random(total), flow))
+    rank = np.empty(total, dtype=np.int64)
+    rank[order] = np.arange(total) - starts[flow[order]]
+    is_transition = rank < NUM_TRANSITIONS[types][flow]
+
+    states_from = np.full(total, -1, dtype=np.int8)
+    states_to = np.full(total, -1, dtype=np.int8)
+    # interesting flows step 1 -> 2 -> 3 ... in position order
+    seen = np.cumsum(is_transition)
+    step = seen - (seen[starts] - is_transition[starts])[flow]
+    interesting = is_transition & (types[flow] == 0)
+    states_from[interesting] = step[interesting]
+    states_to[interesting] = step[interesting] + 1
+    # noise flows jump between random states, except the complete 9 -> 10 transition
+    noise = is_transition & (types[flow] == 1)
+    noise_from = rng.integers(1, 10, total)
+    noise_to = rng.integers(2, 11, total)
+    noise &= (noise_from != 9) | (noise_to != 10)
+    states_from[noise] = noise_from[noise]
+    states_to[noise] = noise_to[noise]
+
+    # random arrival times, sorted within each flow so its packets stay in order
+    times = rng.random(total)
+    times = times[np.lexsort((times, flow))]
+    emit = np.argsort(times, kind="stable")
+    return (
+        (first_flow_id + flow[emit]).astype(np.int64),
+        types[flow[emit]],
+        states_from[emit],
+        states_to[emit],
+    )
+
+
+def stream_packets(seed, num_flows=60000, active_flows=1024, batch_size=65536,
+                   flow_length=(60, 140), type_weights=(30, 30, 40)):
+    """
+    Streaming, seeded counterpart of generate_flows. Yields batches of interleaved
+    packets as (flow_ids, flow_types, states_from, states_to) arrays, flow_types
+    indexing FLOW_TYPES and -1 marking packets without a transition. Flows are made
+    active_flows at a time, so memory stays flat however long the trace is;
+    num_flows=None streams forever.
+    """
+    rng = np.random.default_rng(seed)
+    next_flow_id = 0
+    while num_flows is None or next_flow_id < num_flows:
+        count = active_flows if num_flows is None else min(active_flows, num_flows - next_flow_id)
+        columns = generate_packet_columns(rng, next_flow_id, count, flow_length, type_weights)
+        next_flow_id += count
+        for start in range(0, len(columns[0]), batch_size):
+            yield tuple(column[start:start + batch_size] for column in columns)
+
+
+class TestStreamPackets(unittest.TestCase):
+
+    def collect(self, **kwargs):
+        batches = list(stream_packets(**kwargs))
+        return batches, [np.concatenate(column) for column in zip(*batches)]
+
+    def test_seeded(self):
+        _, first = self.collect(seed=7, num_flows=300, active_flows=100)
+        _, second = self.collect(seed=7, num_flows=300, active_flows=100)
+        _, other = self.collect(seed=8, num_flows=300, active_flows=100)
+        for a, b in zip(first, second):
+            np.testing.assert_array_equal(a, b)
+        self.assertFalse(np.array_equal(first[0], other[0]))
+
+    def test_flows(self):
+        batches, (flow_ids, types, states_from, states_to) = self.collect(
+            seed=0, num_flows=500, active_flows=128, batch_size=1000
+        )
+        self.assertTrue(all(len(batch[0]) <= 1000 for batch in batches))
+        self.assertEqual(set(flow_ids.tolist()), set(range(500)))
+        for flow_id in range(500):
+            packets = flow_ids == flow_id
+            self.assertTrue(60 <= packets.sum() <= 140)
+            flow_type = FLOW_TYPES[types[packets][0]]
+            transitions = states_from[packets] != -1
+            if flow_type == 'interesting':
+                self.assertEqual(states_from[packets][transitions].tolist(), list(range(1, 11)))
+                self.assertEqual(states_to[packets][transitions].tolist(), list(range(2, 12)))
+            elif flow_type == 'noise':
+                self.assertLessEqual(transitions.sum(), 20)
+                self.assertFalse(((states_from[packets] == 9) & (states_to[packets] == 10)).any())
+            else:
+                self.assertFalse(transitions.any())
+        # flows of one chunk are interleaved rather than emitted one after another
+        self.assertGreater((np.diff(flow_ids[:1000]) != 0).sum(), 500)
+
+    def test_configurable(self):
+        _, (flow_ids, types, _, _) = self.collect(
+            seed=1, num_flows=200, flow_length=lambda rng, n: np.full(n, 25), type_weights=(0, 0, 1)
+        )
+        self.assertEqual(len(flow_ids), 200 * 25)
+        self.assertTrue((types == FLOW_TYPES.index('random')).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,389 @@
+"""
+Packet ingestion service: packet records and lookup queries arrive over a Unix stream
+socket, packets are coalesced into micro-batches and applied to a filter through a
+FilterDriver, and lookups are answered once every packet queued before them has been
+applied. Every message is a 5 byte header, an opcode and a little-endian uint32 count:
+
+    P   count packet records (PACKET_DTYPE, the columns of a packet trace)
+    L   count int64 flow ids, answered with a uint32 length and a JSON list of states
+    S   no payload, answered with a uint32 length and the JSON counters
+
+A batch is applied once it holds max_batch packets or its oldest packet has waited
+max_delay seconds. At most max_pending messages wait in the queue; past that the
+service stops reading from its clients until the batcher catches up, so a fast sender
+is slowed down by its socket buffer filling up instead of the queue growing. If the
+filter raises, the batcher stops: pending lookups fail with the error, every client is
+disconnected and close() (or serve()) raises it.
+"""
+import argparse
+import asyncio
+import json
+import os
+import struct
+import tempfile
+import time
+import unittest
+from collections import deque
+
+import numpy as np
+
+from filter_driver import FILTERS, FilterDriver
+from packet_generator import stream_packets
+from packet_trace import open_trace
+
+HEADER = struct.Struct("<cI")
+LENGTH = struct.Struct("<I")
+PACKET_DTYPE = np.dtype([
+    ("flow_id", "<i8"),
+    ("flow_type", "i1"),
+    ("state_from", "i1"),
+    ("state_to", "i1"),
+])
+# per-batch figures the latency percentiles are taken over
+LATENCY_WINDOW = 1024
+
+
+def packet_records(flow_ids, flow_types, states_from, states_to):
+    records = np.empty(len(flow_ids), dtype=PACKET_DTYPE)
+    records["flow_id"] = flow_ids
+    records["flow_type"] = flow_types
+    records["state_from"] = states_from
+    records["state_to"] = states_to
+    return records
+
+
+class PacketService:
+
+    def __init__(self, driver, max_batch=8192, max_delay=0.002, max_pending=64):
+        self.driver = driver
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.server = None
+        self.batcher = None
+        # writers of the connected clients, and what stopped the batcher if it failed
+        self.clients = set()
+        self.failure = None
+        self.started = time.perf_counter()
+        self.batches = 0
+        self.packets = 0
+        self.transitions = 0
+        self.lookups = 0
+        self.apply_seconds = 0.0
+        self.max_queue_depth = 0
+        # (packets, seconds from the oldest packet's arrival to applied) of recent batches
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    async def start(self, path):
+        self.server = await asyncio.start_unix_server(self.handle_client, path)
+        self.batcher = asyncio.create_task(self.run_batches())
+        return self.server
+
+    async def close(self):
+        # raises what stopped the batcher, if it failed
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+
+    async def enqueue(self, item):
+        if self.failure is None:
+            await self.queue.put(item)
+        if self.failure is not None:
+            raise ConnectionAbortedError("the batcher has stopped") from self.failure
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    async def handle_client(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                opcode, count = HEADER.unpack(await reader.readexactly(HEADER.size))
+                if opcode == b"P":
+                    payload = await reader.readexactly(count * PACKET_DTYPE.itemsize)
+                    await self.enqueue((time.perf_counter(), np.frombuffer(payload, dtype=PACKET_DTYPE)))
+                elif opcode == b"L":
+                    flow_ids = np.frombuffer(await reader.readexactly(count * 8), dtype="<i8")
+                    answer = asyncio.get_running_loop().create_future()
+                    await self.enqueue((flow_ids, answer))
+                    self.reply(writer, await answer)
+                    await writer.drain()
+                elif opcode == b"S":
+                    self.reply(writer, self.stats())
+                    await writer.drain()
+                else:
+                    raise ValueError(f"unknown opcode {opcode!r}")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as error:
+            # a lookup failed along with the batcher, which reports the error itself
+            if error is not self.failure:
+                raise
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    def reply(self, writer, value):
+        body = json.dumps(value).encode()
+        writer.write(LENGTH.pack(len(body)) + body)
+
+    async def run_batches(self):
+        item = None
+        try:
+            while True:
+                item = await self.queue.get()
+                batch = []
+                while not isinstance(item[1], asyncio.Future):
+                    batch.append(item)
+                    item = None
+                    remaining = batch[0][0] + self.max_delay - time.perf_counter()
+                    if sum(len(records) for _, records in batch) >= self.max_batch or remaining <= 0:
+                        break
+                    try:
+                        async with asyncio.timeout(remaining):
+                            item = await self.queue.get()
+                    except TimeoutError:
+                        break
+                if batch:
+                    self.apply(batch)
+                if item is not None:
+                    # a lookup sees every packet queued before it
+                    flow_ids, answer = item
+                    self.lookups += len(flow_ids)
+                    if not answer.cancelled():
+                        answer.set_result(self.driver.lookup(flow_ids))
+        except Exception as error:
+            self.fail(error, item)
+            raise
+
+    def fail(self, error, item):
+        # Nothing queued will be applied any more: fail the lookups still waiting for an
+        # answer, the one in hand included, and disconnect every client
+        self.failure = error
+        pending = [item] if item is not None else []
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for _, answer in pending:
+            if isinstance(answer, asyncio.Future) and not answer.done():
+                answer.set_exception(error)
+        for writer in self.clients:
+            writer.close()
+
+    def apply(self, batch):
+        records = np.concatenate([records for _, records in batch])
+        start = time.perf_counter()
+        self.transitions += self.driver.apply(records["flow_id"], records["state_from"], records["state_to"])
+        done = time.perf_counter()
+        self.apply_seconds += done - start
+        self.batches += 1
+        self.packets += len(records)
+        self.recent.append((len(records), done - batch[0][0]))
+
+    def stats(self):
+        sizes = [size for size, _ in self.recent]
+        latencies = [latency * 1e3 for _, latency in self.recent]
+        percentiles = np.percentile(latencies, [50, 99]).tolist() if latencies else [None, None]
+        return {
+            "batches": self.batches,
+            "packets": self.packets,
+            "transitions": self.transitions,
+            "lookups": self.lookups,
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "mean_batch_packets": float(np.mean(sizes)) if sizes else None,
+            "latency_ms_p50": percentiles[0],
+            "latency_ms_p99": percentiles[1],
+            "latency_ms_max": max(latencies) if latencies else None,
+            "apply_packets_per_sec": self.packets / self.apply_seconds if self.apply_seconds else None,
+            "ingest_packets_per_sec": self.packets / (time.perf_counter() - self.started),
+        }
+
+
+class ServiceClient:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, path):
+        return cls(*await asyncio.open_unix_connection(path))
+
+    async def send_packets(self, records):
+        self.writer.write(HEADER.pack(b"P", len(records)) + records.tobytes())
+        # waits while the service is not reading, i.e. applies the backpressure
+        await self.writer.drain()
+
+    async def request(self, opcode, payload=b"", count=0):
+        self.writer.write(HEADER.pack(opcode, count) + payload)
+        await self.writer.drain()
+        length, = LENGTH.unpack(await self.reader.readexactly(LENGTH.size))
+        return json.loads(await self.reader.readexactly(length))
+
+    async def lookup(self, flow_ids):
+        flow_ids = np.asarray(flow_ids, dtype="<i8")
+        return await self.request(b"L", flow_ids.tobytes(), len(flow_ids))
+
+    async def stats(self):
+        return await self.request(b"S")
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def replay(path, batches, message_packets=1024):
+    # Stand-in for a live tap: sends (flow_ids, flow_types, states_from, states_to)
+    # batches, e.g. from stream_packets or a packet trace, message_packets at a time.
+    # Returns the number of packets sent.
+    client = await ServiceClient.connect(path)
+    sent = 0
+    try:
+        for batch in batches:
+            records = packet_records(*batch)
+            for start in range(0, len(records), message_packets):
+                await client.send_packets(records[start:start + message_packets])
+            sent += len(records)
+    finally:
+        await client.close()
+    return sent
+
+
+async def serve(path, driver, **service_args):
+    service = PacketService(driver, **service_args)
+    server = await service.start(path)
+    async with server:
+        # serves until the batcher fails, then raises its error
+        await service.batcher
+
+
+class TestPacketService(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.scratch.name, "service.sock")
+
+    def tearDown(self):
+        self.scratch.cleanup()
+
+    def run_service(self, scenario, driver, **service_args):
+        async def main():
+            service = PacketService(driver, **service_args)
+            await service.start(self.path)
+            try:
+                return await scenario(service)
+            finally:
+                await service.close()
+        return asyncio.run(main())
+
+    def test_replay_matches_direct_driver(self):
+        batches = list(stream_packets(seed=5, num_flows=300, active_flows=100, batch_size=5000))
+        flows = list(range(320))
+
+        async def scenario(service):
+            sent = await replay(self.path, batches, message_packets=700)
+            client = await ServiceClient.connect(self.path)
+            answers = await client.lookup(flows)
+            stats = await client.stats()
+            await client.close()
+            return sent, answers, stats
+
+        make_filter = FILTERS["array-fcf"]
+        sent, answers, stats = self.run_service(scenario, FilterDriver(make_filter(3000, 3)), max_batch=2000)
+        direct = FilterDriver(make_filter(3000, 3))
+        for flow_ids, _, states_from, states_to in batches:
+            direct.apply(flow_ids, states_from, states_to)
+        self.assertEqual(answers, direct.lookup(flows))
+        self.assertEqual(stats["packets"], sent)
+        self.assertEqual(stats["lookups"], len(flows))
+        self.assertGreater(stats["batches"], 1)
+        self.assertLessEqual(stats["mean_batch_packets"], 2000 + 700)
+
+    def test_backpressure_and_latency_bound(self):
+        class SlowDriver(FilterDriver):
+            def apply(self, *columns):
+                time.sleep(0.01)
+                return super().apply(*columns)
+
+        records = packet_records(*next(stream_packets(seed=1, num_flows=20, active_flows=20)))
+
+        async def scenario(service):
+            client = await ServiceClient.connect(self.path)
+            for start in range(0, len(records), 10):
+                await client.send_packets(records[start:start + 10])
+            # the lookup waits for every packet sent before it
+            await client.lookup([])
+            flushed = await client.stats()
+            # a lone packet goes out within max_delay, without a lookup or a full batch
+            await client.send_packets(records[:1])
+            await asyncio.sleep(0.1)
+            stats = await client.stats()
+            await client.close()
+            return flushed, stats
+
+        flushed, stats = self.run_service(scenario, SlowDriver(FILTERS["packed-dbf"](3000, 3)),
+                                          max_batch=50, max_delay=0.005, max_pending=4)
+        self.assertEqual(flushed["packets"], len(records))
+        # the queue filled up, so the service stopped reading
+        self.assertEqual(flushed["max_queue_depth"], 4)
+        self.assertEqual(stats["packets"], len(records) + 1)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_filter_failure(self):
+        class FailingDriver(FilterDriver):
+            def apply(self, *columns):
+                raise RuntimeError("filter failed")
+
+        records = packet_records(*next(stream_packets(seed=1, num_flows=20, active_flows=20)))
+
+        async def scenario(service):
+            waiting = await ServiceClient.connect(self.path)
+            await waiting.send_packets(records[:10])
+            # the lookup that would have seen the packets is failed, not left hanging
+            with self.assertRaises(asyncio.IncompleteReadError):
+                await asyncio.wait_for(waiting.lookup([1]), 5)
+            self.assertIsInstance(service.failure, RuntimeError)
+            self.assertEqual(service.clients, set())
+            # and a client that comes later is turned away
+            late = await ServiceClient.connect(self.path)
+            with self.assertRaises(asyncio.IncompleteReadError):
+                await asyncio.wait_for(late.lookup([1]), 5)
+            for client in (waiting, late):
+                await client.close()
+
+        with self.assertRaisesRegex(RuntimeError, "filter failed"):
+            self.run_service(scenario, FailingDriver(FILTERS["packed-dbf"](3000, 3)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a filter over a Unix socket, or replay packets into one")
+    commands = parser.add_subparsers(dest="command", required=True)
+    server_args = commands.add_parser("serve")
+    server_args.add_argument("--socket", required=True)
+    server_args.add_argument("--filter", default="array-fcf", choices=sorted(FILTERS))
+    server_args.add_argument("--cells", type=int, default=262144)
+    server_args.add_argument("--hashes", type=int, default=3)
+    server_args.add_argument("--max-batch", type=int, default=8192)
+    server_args.add_argument("--max-delay", type=float, default=0.002, help="seconds")
+    server_args.add_argument("--max-pending", type=int, default=64, help="queued messages before reading stops")
+    replay_args = commands.add_parser("replay")
+    replay_args.add_argument("--socket", required=True)
+    replay_args.add_argument("--trace", default=None, help="packet trace to replay instead of generated packets")
+    replay_args.add_argument("--seed", type=int, default=0)
+    replay_args.add_argument("--flows", type=int, default=60000)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        driver = FilterDriver(FILTERS[args.filter](args.cells, args.hashes))
+        asyncio.run(serve(args.socket, driver, max_batch=args.max_batch, max_delay=args.max_delay,
+                          max_pending=args.max_pending))
+    else:
+        async def replay_and_report():
+            batches = open_trace(args.trace).batches() if args.trace else stream_packets(args.seed, args.flows)
+            await replay(args.socket, batches)
+            client = await ServiceClient.connect(args.socket)
+            print(json.dumps(await client.stats(), indent=2))
+            await client.close()
+        asyncio.run(replay_and_report())
@@ -0,0 +1,276 @@
+"""
+Columnar on-disk packet traces, so every experiment can replay the exact same workload
+without regenerating it. A trace file is a 64 byte header followed by the columns of
+all packets back to back:
+
+    flow_id     int64
+    flow_type   int8   (index into FLOW_TYPES)
+    state_from  int8   (-1 when the packet carries no transition)
+    state_to    int8
+
+The columns are opened with numpy.memmap, so replaying a trace reads straight from the
+page cache and several processes can share it. Counting the flows of a trace being
+written and regrouping a trace into flows go through sorted runs of at most run_rows
+rows, spilled to a temporary file and merged, so neither holds a whole trace or every
+flow id in memory.
+"""
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from packet_generator import FLOW_TYPES, stream_packets
+
+
+MAGIC = b"PKTTRACE"
+VERSION = 1
+HEADER = struct.Struct("<8sIQQ")
+HEADER_SIZE = 64
+COLUMNS = (
+    ("flow_ids", np.int64),
+    ("flow_types", np.int8),
+    ("states_from", np.int8),
+    ("states_to", np.int8),
+)
+# rows sorted in memory at a time, and held from all runs together while merging them
+RUN_ROWS = 1 << 20
+FLOW_DTYPE = np.dtype([("flow_id", "<i8")])
+PACKET_DTYPE = np.dtype([("flow_id", "<i8"), ("position", "<i8")])
+
+
+def spill_run(spool, run, extents):
+    if len(run):
+        extents.append((spool.tell(), len(run), run.dtype))
+        spool.write(run.tobytes())
+
+
+def map_runs(spool, extents):
+    spool.flush()
+    return [np.memmap(spool, dtype=dtype, mode="r", offset=offset, shape=(length,))
+            for offset, length, dtype in extents]
+
+
+def merge_runs(runs, run_rows=RUN_ROWS):
+    # Runs sorted by flow_id merged into a stream of chunks sorted by flow_id, rows of
+    # the same flow in run order, where every chunk holds all rows of the flow ids in it.
+    # At most run_rows rows are read from all runs together, more only while one flow
+    # fills a run's share.
+    block = max(1, run_rows // max(1, len(runs)))
+    loaded = [np.asarray(run[:0]) for run in runs]
+    cursors = [0] * len(runs)
+
+    def load(i, rows):
+        chunk = np.asarray(runs[i][cursors[i]:cursors[i] + rows])
+        loaded[i] = np.concatenate((loaded[i], chunk))
+        cursors[i] += len(chunk)
+
+    while True:
+        for i in range(len(runs)):
+            if len(loaded[i]) < block:
+                load(i, block - len(loaded[i]))
+        unfinished = [i for i in range(len(runs)) if cursors[i] < len(runs[i])]
+        if not unfinished:
+            rest = np.concatenate(loaded) if loaded else np.empty(0, dtype=FLOW_DTYPE)
+            if len(rest):
+                yield rest[np.argsort(rest["flow_id"], kind="stable")]
+            return
+        # every row of a flow below the smallest flow id read last from an unfinished
+        # run has been read
+        bound = min(loaded[i]["flow_id"][-1] for i in unfinished)
+        cuts = [int(np.searchsorted(rows["flow_id"], bound)) for rows in loaded]
+        if not any(cuts):
+            for i in unfinished:
+                if loaded[i]["flow_id"][-1] == bound:
+                    load(i, block)
+            continue
+        chunk = np.concatenate([rows[:cut] for rows, cut in zip(loaded, cuts)])
+        loaded = [rows[cut:] for rows, cut in zip(loaded, cuts)]
+        yield chunk[np.argsort(chunk["flow_id"], kind="stable")]
+
+
+def write_trace(path, batches, run_rows=RUN_ROWS):
+    # batches: iterable of (flow_ids, flow_types, states_from, states_to) arrays, e.g.
+    # from stream_packets. Columns are spooled to temporary files next to path and
+    # stitched together once the packet count is known. The flows are counted from
+    # runs of distinct flow ids, each of up to run_rows batch-distinct ids. Returns the
+    # packet count.
+    directory = os.path.dirname(os.path.abspath(path))
+    spools = [tempfile.TemporaryFile(dir=directory) for _ in COLUMNS]
+    flow_spool = tempfile.TemporaryFile(dir=directory)
+    try:
+        num_packets = 0
+        pending, pending_rows, extents = [], 0, []
+        for batch in batches:
+            for spool, column, (_, dtype) in zip(spools, batch, COLUMNS):
+                spool.write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+            num_packets += len(batch[0])
+            pending.append(np.unique(np.asarray(batch[0], dtype="<i8")))
+            pending_rows += len(pending[-1])
+            if pending_rows >= run_rows:
+                spill_run(flow_spool, np.unique(np.concatenate(pending)).view(FLOW_DTYPE), extents)
+                pending, pending_rows = [], 0
+        if pending:
+            spill_run(flow_spool, np.unique(np.concatenate(pending)).view(FLOW_DTYPE), extents)
+        num_flows = sum(len(np.unique(chunk["flow_id"]))
+                        for chunk in merge_runs(map_runs(flow_spool, extents), run_rows))
+        with open(path, "wb") as out:
+            out.write(HEADER.pack(MAGIC, VERSION, num_packets, num_flows).ljust(HEADER_SIZE, b"\0"))
+            for spool in spools:
+                spool.seek(0)
+                shutil.copyfileobj(spool, out)
+    finally:
+        for spool in spools + [flow_spool]:
+            spool.close()
+    return num_packets
+
+
+def write_flows(path, flows):
+    # Trace of a generate_flows() style list, flows one after another
+    def batches():
+        for flow_id, flow_type, packets in flows:
+            states_from, states_to = zip(*packets) if packets else ((), ())
+            yield (
+                np.full(len(packets), flow_id),
+                np.full(len(packets), FLOW_TYPES.index(flow_type)),
+                np.array(states_from),
+                np.array(states_to),
+            )
+    return write_trace(path, batches())
+
+
+def generate_trace(path, seed, **stream_args):
+    # Write a stream_packets workload once, to be replayed with open_trace
+    return write_trace(path, stream_packets(seed, **stream_args))
+
+
+class PacketTrace:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, num_packets, num_flows = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} packet trace")
+        self.num_packets = num_packets
+        self.num_flows = num_flows
+        offset = HEADER_SIZE
+        for name, dtype in COLUMNS:
+            if num_packets:
+                column = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(num_packets,))
+            else:
+                column = np.empty(0, dtype=dtype)
+            setattr(self, name, column)
+            offset += num_packets * np.dtype(dtype).itemsize
+
+    def __len__(self):
+        return self.num_packets
+
+    def batches(self, batch_size=65536):
+        # zero-copy slices of the memory-mapped columns
+        for start in range(0, self.num_packets, batch_size):
+            stop = start + batch_size
+            yield (self.flow_ids[start:stop], self.flow_types[start:stop],
+                   self.states_from[start:stop], self.states_to[start:stop])
+
+    def sorted_run(self, start, run_rows):
+        # (flow_id, position) of run_rows packets from start, sorted by flow and position,
+        # so merging the runs of a trace in order keeps every flow's packets in order
+        flow_ids = np.asarray(self.flow_ids[start:start + run_rows])
+        order = np.argsort(flow_ids, kind="stable")
+        run = np.empty(len(flow_ids), dtype=PACKET_DTYPE)
+        run["flow_id"] = flow_ids[order]
+        run["position"] = start + order
+        return run
+
+    def flows(self, run_rows=RUN_ROWS):
+        # The trace in generate_flows() shape, (flow_id, flow_type, [(from, to), ...]) per
+        # flow in flow id order, which is the order generate_flows and stream_packets
+        # number their flows in, built one flow at a time
+        if self.num_packets == 0:
+            return
+        with tempfile.TemporaryFile() as spool:
+            extents = []
+            for start in range(0, self.num_packets, run_rows):
+                spill_run(spool, self.sorted_run(start, run_rows), extents)
+            for chunk in merge_runs(map_runs(spool, extents), run_rows):
+                positions = chunk["position"]
+                flow_ids = chunk["flow_id"]
+                flow_types = self.flow_types[positions]
+                states_from = self.states_from[positions].tolist()
+                states_to = self.states_to[positions].tolist()
+                starts = np.flatnonzero(np.r_[True, flow_ids[1:] != flow_ids[:-1]])
+                stops = np.r_[starts[1:], len(chunk)]
+                for start, stop in zip(starts.tolist(), stops.tolist()):
+                    yield (
+                        int(flow_ids[start]),
+                        FLOW_TYPES[flow_types[start]],
+                        list(zip(states_from[start:stop], states_to[start:stop])),
+                    )
+
+
+def open_trace(path):
+    return path if isinstance(path, PacketTrace) else PacketTrace(path)
+
+
+class TestPacketTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "trace.bin")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        batches = list(stream_packets(3, num_flows=200, active_flows=64, batch_size=5000))
+        self.assertEqual(generate_trace(self.path, 3, num_flows=200, active_flows=64), sum(len(b[0]) for b in batches))
+        trace = open_trace(self.path)
+        self.assertEqual(trace.num_flows, 200)
+        self.assertIsInstance(trace.flow_ids, np.memmap)
+        for column, expected in zip((trace.flow_ids, trace.flow_types, trace.states_from, trace.states_to),
+                                    zip(*batches)):
+            np.testing.assert_array_equal(column, np.concatenate(expected))
+        replayed = [np.concatenate(column) for column in zip(*trace.batches(777))]
+        np.testing.assert_array_equal(replayed[0], trace.flow_ids)
+
+    def test_flows(self):
+        random_state = np.random.default_rng(0)
+        flows = [(i, FLOW_TYPES[i % 3], [(int(a), int(b)) for a, b in random_state.integers(-1, 11, (5 + i, 2))])
+                 for i in range(20)]
+        write_flows(self.path, flows)
+        self.assertEqual(list(open_trace(self.path).flows()), flows)
+        # interleaved traces are regrouped per flow, in flow id order
+        generate_trace(self.path, 0, num_flows=50, active_flows=50)
+        trace = open_trace(self.path)
+        grouped = list(trace.flows())
+        self.assertEqual(len(grouped), 50)
+        self.assertEqual(sum(len(packets) for _, _, packets in grouped), trace.num_packets)
+        self.assertEqual([flow_id for flow_id, _, _ in grouped], sorted(set(trace.flow_ids.tolist())))
+        flow_id, flow_type, packets = grouped[7]
+        rows = np.flatnonzero(trace.flow_ids == flow_id)
+        self.assertEqual(flow_type, FLOW_TYPES[trace.flow_types[rows[0]]])
+        self.assertEqual(packets, list(zip(trace.states_from[rows].tolist(), trace.states_to[rows].tolist())))
+        # runs far smaller than the trace, and than some of its flows, merge to the same
+        self.assertEqual(list(trace.flows(run_rows=37)), grouped)
+
+    def test_bounded_runs(self):
+        rng = np.random.default_rng(2)
+        batches = [(ids, np.zeros(len(ids)), np.full(len(ids), -1), np.full(len(ids), -1))
+                   for ids in (rng.integers(-500, 500, n) for n in (300, 1, 700, 250))]
+        distinct = len(np.unique(np.concatenate([ids for ids, *_ in batches])))
+        for run_rows in (RUN_ROWS, 64, 5, 1):
+            write_trace(self.path, batches, run_rows=run_rows)
+            self.assertEqual(open_trace(self.path).num_flows, distinct)
+
+    def test_rejects_other_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * HEADER_SIZE)
+        with self.assertRaises(ValueError):
+            open_trace(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
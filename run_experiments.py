@@ -1,21 +1,81 @@
+import argparse
+import itertools
+import os
+import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import _ResultMixinStr
+
+import numpy as np
+
 from state_machine import StateMachine
-from packet_generator import generate_flows
-from direct_bloom_filter import DirectBloomFilter
+from packet_generator import generate_flows, iter_flows, stream_packets
+from filter_metrics import enable_metrics
+from packet_trace import open_trace, write_flows
+from running_estimate import StoppingRule
+from direct_bloom_filter import PackedDirectBloomFilter
 from fingerprint_compressed_filter import FCF
 from stateful_bloom_filter import StatefulBloomFilter
 
-def simulate_fcf_filter(config):
-    flows = generate_flows()
+# Flows to simulate: replayed from a packet trace file when one is given, so different
+# configurations see the exact same workload, otherwise freshly generated
+def load_flows(trace):
+    if trace is None:
+        flows = generate_flows()
+        return lambda: flows, len(flows)
+    trace = open_trace(trace)
+    return trace.flows, trace.num_flows
+
+# What the filter really takes next to the hand-entered Memory Size, measured once the
+# workload has run through it
+def memory_columns(bloom_filter):
+    report = bloom_filter.memory_report()
+    columns = {
+        'Theoretical Bits': report['theoretical_bits'],
+        'Actual Bytes': report['actual_bytes'],
+        'Bits per Active Flow': report['bits_per_active_flow'],
+    }
+    if bloom_filter.index_cache is not None:
+        columns['Cache Hit Rate'] = bloom_filter.index_cache.hit_rate()
+    return columns
+
+# Flows between two exports of a filter's metrics, when a metrics log is given
+METRICS_INTERVAL = 5000
+
+# Rates a simulation under a StoppingRule estimates, from per-flow observations. The
+# share of interesting flows whose last lookup missed state 10 gets a column of its own:
+# 'False Negative' keeps counting the misses of the last flow only, with or without a rule.
+RATES = ('False Positive', 'Missed Final State', "Don't Know")
+
+# The flows a simulation runs through: all of them, or under a stopping rule as many as
+# it takes, followed by freshly generated ones should the trace run out first
+def simulated_flows(flows, num_flows, stopping):
+    if stopping is None:
+        return flows()
+    return itertools.chain(flows(), iter_flows(num_flows))
+
+# With a StoppingRule (see running_estimate) a configuration runs until its rates are
+# precise enough rather than through every flow. Each flow then contributes its false
+# positive and don't know lookups and, for an interesting flow, whether its last lookup
+# missed state 10, and the rates come with the half-widths of their intervals.
+def simulate_fcf_filter(config, trace=None, cache_size=None, metrics_log=None, stopping=None):
+    flows, num_flows = load_flows(trace)
     results = []
 
     for memory_size, table_size, hash_functions, cells_per_bucket, fingerprint_size in config:
-        bloom_filter = FCF(hash_fns=hash_functions, table_size=table_size, cells_per_bucket=cells_per_bucket, fingerprint_size=fingerprint_size)
+        bloom_filter = FCF(hash_fns=hash_functions, table_size=table_size, cells_per_bucket=cells_per_bucket, fingerprint_size=fingerprint_size, cache_size=cache_size)
+        metrics = enable_metrics(bloom_filter) if metrics_log else None
+        estimates = stopping.start(RATES) if stopping else None
         false_positives = 0
         false_negatives = 0
         dont_knows = 0
+        flows_run = 0
 
-        for index, (flow_id, flow_type, packets) in enumerate(flows):
+        for index, (flow_id, flow_type, packets) in enumerate(simulated_flows(flows, num_flows, stopping)):
+            if metrics and index % METRICS_INTERVAL == 0:
+                metrics.export(metrics_log, memory_size=memory_size, flows=index)
+            flow_start = (false_positives, dont_knows)
+            flows_run = index + 1
             state_machine = StateMachine()
 
             for (state_from, state_to) in packets:
@@ -31,33 +91,54 @@ def simulate_fcf_filter(config):
 
                 if (flow_type != 'interesting' and response == 10):
                     false_positives += 1
-                if (flow_type == 'interesting' and index == len(flows) - 1):
+                if (flow_type == 'interesting' and index == num_flows - 1):
                     if (response != 10):
                         false_negatives += 1
 
+            if estimates:
+                estimates.add(**{
+                    'False Positive': false_positives - flow_start[0],
+                    'Missed Final State': flow_type == 'interesting' and bool(packets) and response != 10,
+                    "Don't Know": dont_knows - flow_start[1],
+                })
+                if estimates.done():
+                    break
+
         results.append({
             'Memory Size': memory_size,
             'Table Size': table_size,
             'Hash Functions': hash_functions,
             'Cells per Bucket': cells_per_bucket,
-            'False Positive': false_positives / 60000,
-            'False Negative': false_negatives / 60000,
-            "Don't Know": dont_knows / 60000
+            'False Positive': false_positives / max(flows_run, 1),
+            'False Negative': false_negatives / max(flows_run, 1),
+            "Don't Know": dont_knows / max(flows_run, 1),
+            **(estimates.columns() if estimates else {}),
+            **memory_columns(bloom_filter)
         })
+        if metrics:
+            metrics.export(metrics_log, memory_size=memory_size, flows=flows_run)
     print(results)
     return results
 
-def simulate_dbf_sbf_filter(filter_class, config, filter_name):
-    flows = generate_flows()
+def simulate_dbf_sbf_filter(filter_class, config, filter_name, trace=None, cache_size=None, metrics_log=None,
+                            stopping=None):
+    flows, num_flows = load_flows(trace)
     results = []
 
     for memory_size, num_cells, hash_count in config:
-        bloom_filter = filter_class(num_cells=num_cells, hash_count=hash_count)
+        bloom_filter = filter_class(num_cells=num_cells, hash_count=hash_count, cache_size=cache_size)
+        metrics = enable_metrics(bloom_filter) if metrics_log else None
+        estimates = stopping.start(RATES) if stopping else None
         false_positives = 0
         false_negatives = 0
         dont_knows = 0
+        flows_run = 0
 
-        for index, (flow_id, flow_type, packets) in enumerate(flows):
+        for index, (flow_id, flow_type, packets) in enumerate(simulated_flows(flows, num_flows, stopping)):
+            if metrics and index % METRICS_INTERVAL == 0:
+                metrics.export(metrics_log, memory_size=memory_size, flows=index)
+            flow_start = (false_positives, dont_knows)
+            flows_run = index + 1
             state_machine = StateMachine()
 
             for (state_from, state_to) in packets:
@@ -76,29 +157,188 @@ def simulate_dbf_sbf_filter(filter_class, config, filter_name):
 
                 if (flow_type != 'interesting' and response == 10):
                     false_positives += 1
-                if (flow_type == 'interesting' and index == len(flows) - 1):
+                if (flow_type == 'interesting' and index == num_flows - 1):
                     if (response != 10):
                         false_negatives += 1
 
+            if estimates:
+                estimates.add(**{
+                    'False Positive': false_positives - flow_start[0],
+                    'Missed Final State': flow_type == 'interesting' and bool(packets) and response != 10,
+                    "Don't Know": dont_knows - flow_start[1],
+                })
+                if estimates.done():
+                    break
+
         results.append({
             'Memory Size': memory_size,
             'Hash Functions': hash_count,
             'Num Cells': num_cells,
-            'False Positive': false_positives / 60000,
-            'False Negative': false_negatives / 60000,
-            "Don't Know": dont_knows / 60000
+            'False Positive': false_positives / max(flows_run, 1),
+            'False Negative': false_negatives / max(flows_run, 1),
+            "Don't Know": dont_knows / max(flows_run, 1),
+            **(estimates.columns() if estimates else {}),
+            **memory_columns(bloom_filter)
         })
+        if metrics:
+            metrics.export(metrics_log, memory_size=memory_size, flows=flows_run)
     print(results)
     return results
-# simulate_dbf_sbf_filter(DirectBloomFilter,  [(786432, 256000, 3)], 'Direct Bloom Filter')
-# simulate_dbf_sbf_filter(DirectBloomFilter,  [(1572864, 512000, 4)], 'Direct Bloom Filter')
-# simulate_dbf_sbf_filter(DirectBloomFilter,  [(3145728, 1000000, 5)], 'Direct Bloom Filter')
 
-simulate_dbf_sbf_filter(StatefulBloomFilter,  [(524288, 128000, 3)], 'Stateful Bloom Filter')
-simulate_dbf_sbf_filter(StatefulBloomFilter,  [(1048576, 256000, 4)], 'Stateful Bloom Filter')
-simulate_dbf_sbf_filter(StatefulBloomFilter,  [(2097152, 512000, 5)], 'Stateful Bloom Filter')
+FILTERS = {
+    'Stateful Bloom Filter': StatefulBloomFilter,
+    'Fingerprint Compressed Filter': FCF,
+}
+
+# (memory size, num cells, hash count)
+SBF_CONFIGS = [(524288, 128000, 3), (1048576, 256000, 4), (2097152, 512000, 5)]
+# (memory size, table size, hash functions, cells per bucket, fingerprint size)
+FCF_CONFIGS = [(516096, 6000, 3, 6, 10), (1081344, 8000, 4, 6, 10), (2162688, 16000, 4, 6, 18)]
+
+# One configuration of one filter over the shared trace. Seeded from the job's position
+# so a run gives the same results whichever worker picks the job up.
+def run_job(job):
+    index, filter_name, config, trace, seed, cache_size, metrics_log, stopping = job
+    random.seed(seed + index)
+    np.random.seed(seed + index)
+    if FILTERS[filter_name] is FCF:
+        results = simulate_fcf_filter([config], trace=trace, cache_size=cache_size, metrics_log=metrics_log,
+                                      stopping=stopping)
+    else:
+        results = simulate_dbf_sbf_filter(FILTERS[filter_name], [config], filter_name, trace=trace, cache_size=cache_size,
+                                          metrics_log=metrics_log, stopping=stopping)
+    return dict(results[0], Filter=filter_name)
+
+# Fans (filter name, config) jobs out over a process pool. Every worker memory-maps the
+# same read-only trace file; without one, a trace is generated once from seed first.
+# With metrics_log every job appends its filter's metrics to that file as JSON lines, with
+# stopping every job runs under that StoppingRule.
+def run_configurations(jobs, trace=None, processes=None, seed=0, cache_size=None, metrics_log=None,
+                       stopping=None):
+    with tempfile.TemporaryDirectory() as scratch:
+        if trace is None:
+            random.seed(seed)
+            trace = os.path.join(scratch, "flows.trace")
+            write_flows(trace, generate_flows())
+        work = [(index, name, config, trace, seed, cache_size, metrics_log, stopping)
+                for index, (name, config) in enumerate(jobs)]
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            return list(pool.map(run_job, work))
+
+# (counter bits, cell bits) of the DBF cell layouts to compare
+CELL_WIDTHS = [(1, 4), (2, 4), (3, 4), (2, 8), (4, 8), (7, 8)]
+
+# Accuracy against bytes of the DBF cell layouts in CELL_WIDTHS under one memory budget:
+# wider cells saturate less but leave fewer cells, so more flows share each one. Every
+# layout replays the same interleaved packets, a flow's current state being inserted on
+# its first transition and replaced on the next ones. At a flow's last packet its current
+# state is looked up (missing: a false negative) next to a state it never had (found: a
+# false positive), and the flow is deleted.
+def simulate_counter_widths(memory_bits, widths=CELL_WIDTHS, hash_count=3, seed=0, num_flows=20000,
+                            active_flows=4096, phase_duration=10**9):
+    columns = [np.concatenate(column) for column in zip(*stream_packets(seed, num_flows, active_flows))]
+    flow_ids, _, states_from, states_to = (column.tolist() for column in columns)
+    # position of each flow's last packet
+    _, last_from_end = np.unique(columns[0][::-1], return_index=True)
+    last = np.zeros(len(flow_ids), dtype=bool)
+    last[len(flow_ids) - 1 - last_from_end] = True
+    last = last.tolist()
+    results = []
+
+    for counter_bits, cell_bits in widths:
+        num_cells = memory_bits // cell_bits
+        bloom_filter = PackedDirectBloomFilter(num_cells=num_cells, hash_count=hash_count, phase_duration=phase_duration,
+                                               counter_bits=counter_bits, cell_bits=cell_bits)
+        states = {}
+        false_positives = 0
+        false_negatives = 0
+        saturated = 0
+        checked = 0
+
+        for flow_id, state_from, state_to, is_last in zip(flow_ids, states_from, states_to, last):
+            if state_from != -1:
+                if flow_id in states:
+                    bloom_filter.modify_entry(flow_id, states[flow_id], state_to)
+                else:
+                    bloom_filter.insert_entry(flow_id, state_to)
+                states[flow_id] = state_to
+            if not is_last:
+                continue
+            # states are 1 to 10, 0 is never inserted
+            if bloom_filter.lookup_entry(flow_id, 0) is not None:
+                false_positives += 1
+            if flow_id in states:
+                checked += 1
+                cells = np.asarray(bloom_filter.item_indices(flow_id, states[flow_id]))
+                saturated += int((bloom_filter.cell_counters(cells) == bloom_filter.counter_max).sum())
+                if bloom_filter.lookup_entry(flow_id, states[flow_id]) is None:
+                    false_negatives += 1
+                bloom_filter.delete_entry(flow_id, states.pop(flow_id))
+
+        results.append({
+            'Filter': 'Direct Bloom Filter',
+            'Memory Size': memory_bits,
+            'Counter Bits': counter_bits,
+            'Cell Bits': cell_bits,
+            'Num Cells': num_cells,
+            'False Positive': false_positives / num_flows,
+            'False Negative': false_negatives / num_flows,
+            # share of a finished flow's cells that had saturated
+            'Saturated Cells': saturated / (hash_count * checked) if checked else 0.0,
+            **memory_columns(bloom_filter)
+        })
+    return results
+
+def format_results(results):
+    columns = list(dict.fromkeys(key for result in results for key in result))
+    columns.remove('Filter')
+    columns.insert(0, 'Filter')
+    rows = [[str(result.get(column, '')) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    lines = ["  ".join(column.ljust(width) for column, width in zip(columns, widths))]
+    lines += ["  ".join(value.ljust(width) for value, width in zip(row, widths)) for row in rows]
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the filter accuracy experiments")
+    parser.add_argument("--trace", default="flows.trace",
+                        help="packet trace to replay, generated once if it does not exist")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cache-size", type=int, default=None,
+                        help="cache the hash indices of this many recent flows in every filter")
+    parser.add_argument("--metrics-log", default=None,
+                        help="append the filters' hot-path metrics to this JSON lines file while they run")
+    parser.add_argument("--precision", type=float, default=None,
+                        help="stop a configuration once every rate is known to this relative precision")
+    parser.add_argument("--absolute-precision", type=float, default=1e-3,
+                        help="or to within this much, for rates close to 0")
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--min-flows", type=int, default=5000)
+    parser.add_argument("--max-flows", type=int, default=100000,
+                        help="stop there even if not precise, generating flows past the trace if needed")
+    parser.add_argument("--filters", nargs="+", default=["sbf", "fcf"], choices=["sbf", "fcf"])
+    parser.add_argument("--cell-widths", type=int, default=None, metavar="MEMORY_BITS",
+                        help="only compare the DBF counter and cell widths under this memory budget")
+    args = parser.parse_args()
+
+    if args.cell_widths is not None:
+        print(format_results(simulate_counter_widths(args.cell_widths, seed=args.seed)))
+        raise SystemExit
 
-simulate_fcf_filter([(516096, 6000, 3, 6, 10)])
-simulate_fcf_filter([(1081344, 8000, 4, 6, 10)])
-simulate_fcf_filter([(2162688, 16000, 4, 6, 18)])
+    # Generate the workload once and replay it for every configuration
+    if not os.path.exists(args.trace):
+        random.seed(args.seed)
+        write_flows(args.trace, generate_flows())
 
+    jobs = []
+    if "sbf" in args.filters:
+        jobs += [('Stateful Bloom Filter', config) for config in SBF_CONFIGS]
+    if "fcf" in args.filters:
+        jobs += [('Fingerprint Compressed Filter', config) for config in FCF_CONFIGS]
+    stopping = None
+    if args.precision is not None:
+        stopping = StoppingRule(args.precision, args.absolute_precision, args.confidence, args.min_flows,
+                                args.max_flows)
+    print(format_results(run_configurations(jobs, args.trace, args.processes, args.seed, args.cache_size,
+                                            args.metrics_log, stopping)))
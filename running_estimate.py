@@ -0,0 +1,209 @@
+"""
+Running means with confidence intervals, so a simulation can stop once its error rates
+are known precisely enough instead of after a fixed number of flows. Every flow adds
+one observation per rate, e.g. its number of false positive lookups, and a rate is the
+mean of those observations, which is what dividing the totals by the flow count gives.
+The interval is the normal approximation, mean +- z * s / sqrt(n), except while every
+observation so far is the same: a rate that has stayed 0 gets the rule-of-three bound
+-ln(1 - confidence) / n, since a zero sample variance says nothing about rare events.
+
+Flows are not independent draws, though: the filters fill up as a run goes on, so the
+rates drift upwards for a long while. A StoppingRule therefore takes s from the means of
+consecutive batches of flows rather than from single flows, and only stops once the
+first and second half of the batches agree to within the precision as well.
+"""
+import math
+import random
+import unittest
+from statistics import NormalDist
+
+
+class RunningEstimate:
+    # Mean and variance of a stream of observations, by Welford's update
+
+    def __init__(self, confidence=0.95):
+        self.confidence = confidence
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else math.inf
+
+    def half_width(self):
+        if self.count < 2:
+            return math.inf
+        if self.m2 == 0:
+            return -math.log(1 - self.confidence) / self.count
+        return self.z * math.sqrt(self.variance() / self.count)
+
+    def interval(self):
+        half_width = self.half_width()
+        return self.mean - half_width, self.mean + half_width
+
+
+class StoppingRule:
+    # When a simulation has run long enough: once every estimate's interval is within
+    # relative of its mean or within absolute, whichever is wider, and so is the gap
+    # between the means of the first and second half of the run, after at least
+    # min_flows and at most max_flows flows (None: no limit). The filters fill up as a
+    # run goes on, so min_flows should cover the warm-up. Intervals are checked every
+    # check_every flows, which is also the length of the batches they are computed from.
+
+    def __init__(self, relative=0.05, absolute=1e-3, confidence=0.95, min_flows=5000, max_flows=100000,
+                 check_every=500):
+        self.relative = relative
+        self.absolute = absolute
+        self.confidence = confidence
+        self.min_flows = min_flows
+        self.max_flows = max_flows
+        self.check_every = check_every
+
+    def start(self, names):
+        return EstimateSet(self, names)
+
+
+# Batches a half-width needs before it means anything, so each half has a few of them
+MIN_BATCHES = 4
+
+
+class EstimateSet:
+    # One run under a StoppingRule: a RunningEstimate per name, fed one flow at a time,
+    # and the means of every check_every flows for the batch-means interval
+
+    def __init__(self, rule, names):
+        self.rule = rule
+        self.estimates = {name: RunningEstimate(rule.confidence) for name in names}
+        self.batches = {name: [] for name in names}
+        self.batch_sums = dict.fromkeys(names, 0.0)
+        self.flows = 0
+
+    def add(self, **observations):
+        for name, value in observations.items():
+            self.estimates[name].add(value)
+            self.batch_sums[name] += value
+        self.flows += 1
+        if self.flows % self.rule.check_every == 0:
+            for name, total in self.batch_sums.items():
+                self.batches[name].append(total / self.rule.check_every)
+                self.batch_sums[name] = 0.0
+
+    def half_width(self, name):
+        # z * s / sqrt(batches) over the batch means, which stays honest when nearby
+        # flows are correlated, and the rule of three while the rate has stayed 0
+        estimate, batches = self.estimates[name], self.batches[name]
+        if len(batches) < MIN_BATCHES:
+            return math.inf
+        if estimate.m2 == 0:
+            return estimate.half_width()
+        batch_means = RunningEstimate(estimate.confidence)
+        for mean in batches:
+            batch_means.add(mean)
+        return batch_means.half_width()
+
+    def drift(self, name):
+        # How far the mean of the second half of the batches is from the first half's
+        batches = self.batches[name]
+        if len(batches) < MIN_BATCHES:
+            return math.inf
+        half = len(batches) // 2
+        return abs(sum(batches[half:]) / (len(batches) - half) - sum(batches[:half]) / half)
+
+    def precise(self):
+        rule = self.rule
+        for name, estimate in self.estimates.items():
+            tolerance = max(rule.relative * abs(estimate.mean), rule.absolute)
+            if self.half_width(name) > tolerance or self.drift(name) > tolerance:
+                return False
+        return True
+
+    def done(self):
+        rule = self.rule
+        if rule.max_flows is not None and self.flows >= rule.max_flows:
+            return True
+        if self.flows < rule.min_flows or self.flows % rule.check_every:
+            return False
+        return self.precise()
+
+    def columns(self):
+        # result columns: every rate, its interval half-width and the flows it took
+        columns = {}
+        for name, estimate in self.estimates.items():
+            columns[name] = estimate.mean
+            columns[f"{name} ±"] = self.half_width(name)
+        columns['Flows'] = self.flows
+        columns['Converged'] = self.precise()
+        return columns
+
+
+class TestRunningEstimate(unittest.TestCase):
+
+    def test_welford(self):
+        values = [3, 1, 4, 1, 5, 9, 2, 6]
+        estimate = RunningEstimate()
+        for value in values:
+            estimate.add(value)
+        mean = sum(values) / len(values)
+        self.assertAlmostEqual(estimate.mean, mean)
+        self.assertAlmostEqual(estimate.variance(), sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+        low, high = estimate.interval()
+        self.assertAlmostEqual(high - mean, 1.959964 * math.sqrt(estimate.variance() / len(values)), places=5)
+        self.assertAlmostEqual(mean - low, high - mean)
+
+    def test_zero_rate(self):
+        estimate = RunningEstimate()
+        self.assertEqual(estimate.half_width(), math.inf)
+        for _ in range(1000):
+            estimate.add(0)
+        # the rule of three
+        self.assertAlmostEqual(estimate.half_width(), 3 / 1000, places=4)
+
+    def test_stopping(self):
+        rule = StoppingRule(relative=0.1, absolute=0.01, min_flows=100, check_every=10)
+        run = rule.start(["rate", "never"])
+        rng = random.Random(0)
+        flows = 0
+        while not run.done():
+            run.add(rate=rng.random() < 0.5, never=0)
+            flows += 1
+        # a 0/1 rate of 0.5 is known to +-10% after (1.96 / 0.1) ** 2 flows, the rate
+        # that stays 0 to within absolute after 3 / 0.01 flows
+        self.assertGreaterEqual(flows, 385)
+        self.assertEqual(flows % 10, 0)
+        self.assertTrue(run.columns()['Converged'])
+        self.assertLessEqual(run.columns()['rate ±'], 0.05)
+
+        capped = StoppingRule(relative=0.001, min_flows=10, max_flows=50).start(["rate"])
+        for flow in range(50):
+            self.assertFalse(capped.done())
+            capped.add(rate=flow % 3)
+        self.assertTrue(capped.done())
+        self.assertFalse(capped.columns()['Converged'])
+
+    def test_drift(self):
+        # a rate that steps up from 0.1 to 0.2 after 1000 flows, as when a filter fills
+        # up: the interval is tight early on, but the two halves of the run disagree
+        # until the step is a small part of it
+        rule = StoppingRule(relative=0.05, absolute=1e-3, min_flows=500, max_flows=None, check_every=50)
+        run = rule.start(["rate"])
+        flows = 0
+        while not run.done():
+            run.add(rate=(flows % 2) * 0.2 + (0 if flows < 1000 else 0.1))
+            flows += 1
+            if flows == 5000:
+                self.assertLess(run.half_width("rate"), 0.05 * run.estimates["rate"].mean)
+                self.assertFalse(run.precise())
+        # the halves differ by 200 / flows, within 5% of the rate from about 20500 flows on
+        self.assertGreaterEqual(flows, 20000)
+        self.assertLessEqual(run.drift("rate"), 0.05 * run.columns()['rate'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,232 @@
+import multiprocessing
+import queue
+import unittest
+
+import numpy as np
+
+from bloom_filter import seeded_hash_matrix
+from fingerprint_compressed_filter import ArrayFCF
+from memory_usage import build_memory_report
+from stateful_bloom_filter import StatefulBloomFilter
+
+# Seed of the routing hash. Kept apart from the seeds the filters index cells with,
+# so the flows a shard owns are spread evenly over its cells.
+ROUTING_SEED = 0x5EED
+
+# Seconds between checks that the shard workers are still alive while waiting on them
+RESPONSE_POLL = 1.0
+
+
+def shard_of(flow_ids, num_shards):
+    # Owning shard of every flow id
+    hashes = seeded_hash_matrix(flow_ids, [ROUTING_SEED])[:, 0]
+    return (hashes % np.uint64(num_shards)).astype(np.intp)
+
+
+def serve_shard(filter_class, filter_args, requests, responses):
+    # Worker loop: owns one filter and applies (method, rows) batches to it in order.
+    # The first response says whether the filter could be built.
+    try:
+        filter = filter_class(**filter_args)
+    except Exception as error:
+        responses.put(error)
+        return
+    responses.put(None)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        method, rows = request
+        try:
+            apply = getattr(filter, method)
+            responses.put([apply(*row) for row in rows])
+        except Exception as error:
+            responses.put(error)
+
+
+class ShardedFilter:
+    # Partitions flows onto num_shards independent copies of filter_class, each owned
+    # by its own worker process. size_arg names the constructor argument holding the
+    # table size (num_cells, table_size, ...), which every shard gets 1/num_shards of so
+    # total memory stays the same. A shard only sees the operations of its own flows,
+    # so time_arg (phase_duration, deletion_window, ...) is divided the same way to keep
+    # the aging in step with the overall operation count.
+
+    def __init__(self, filter_class, num_shards, size_arg="num_cells", time_arg=None, **filter_args):
+        self.num_shards = num_shards
+        shard_args = dict(filter_args)
+        shard_args[size_arg] = filter_args[size_arg] // num_shards
+        # FCF tables are split into hash_fns subtables, so a shard needs a multiple of them
+        if filter_args[size_arg] % num_shards or shard_args[size_arg] % filter_args.get("hash_fns", 1):
+            raise ValueError(
+                f"{size_arg}={filter_args[size_arg]} does not split into {num_shards} equal shards"
+                + (f" of whole hash_fns={filter_args['hash_fns']} subtables" if "hash_fns" in filter_args else "")
+            )
+        if time_arg is not None:
+            shard_args[time_arg] = max(1, filter_args[time_arg] // num_shards)
+        self.shard_args = shard_args
+        # A queue pair per shard: a worker that dies while holding a queue's lock then
+        # only breaks its own queues, not every other shard's responses
+        self.requests = [multiprocessing.Queue() for _ in range(num_shards)]
+        self.responses = [multiprocessing.Queue() for _ in range(num_shards)]
+        self.workers = [
+            multiprocessing.Process(
+                target=serve_shard,
+                args=(filter_class, shard_args, self.requests[shard], self.responses[shard]),
+                daemon=True,
+            )
+            for shard in range(num_shards)
+        ]
+        for worker in self.workers:
+            worker.start()
+        errors = [error for error in map(self.receive, range(num_shards)) if error is not None]
+        if errors:
+            self.close()
+            raise errors[0]
+
+    def receive(self, shard):
+        # Next response of a shard. Once its worker has died the response will never
+        # come, so that is returned as an error instead of waiting forever.
+        while True:
+            try:
+                return self.responses[shard].get(timeout=RESPONSE_POLL)
+            except queue.Empty:
+                worker = self.workers[shard]
+                if not worker.is_alive():
+                    return RuntimeError(f"shard {shard} worker exited with code {worker.exitcode}")
+
+    def apply(self, method, rows):
+        # Calls filter.method(*row) for every row, whose first element is the flow id, on
+        # the shard owning that flow. Each shard gets its rows as one batch, in order, and
+        # the results come back in the order of rows.
+        rows = list(rows)
+        if not rows:
+            return []
+        shards = shard_of([row[0] for row in rows], self.num_shards)
+        positions = [np.flatnonzero(shards == shard) for shard in range(self.num_shards)]
+        pending = [shard for shard, position in enumerate(positions) if len(position)]
+        for shard in pending:
+            self.requests[shard].put((method, [rows[i] for i in positions[shard]]))
+        results = [None] * len(rows)
+        error = None
+        for shard in pending:
+            shard_results = self.receive(shard)
+            if isinstance(shard_results, Exception):
+                error = shard_results
+                continue
+            for i, result in zip(positions[shard].tolist(), shard_results):
+                results[i] = result
+        if error is not None:
+            raise error
+        return results
+
+    def broadcast(self, method, *args):
+        # filter.method(*args) on every shard, results in shard order
+        for requests in self.requests:
+            requests.put((method, [args]))
+        results = [None] * self.num_shards
+        error = None
+        for shard in range(self.num_shards):
+            shard_results = self.receive(shard)
+            if isinstance(shard_results, Exception):
+                error = shard_results
+                continue
+            results[shard] = shard_results[0]
+        if error is not None:
+            raise error
+        return results
+
+    def memory_report(self):
+        reports = self.broadcast("memory_report")
+        return build_memory_report(
+            *(sum(report[key] for report in reports) for key in ("theoretical_bits", "actual_bytes", "active_flows"))
+        )
+
+    def insert_entry(self, flow_id, *args):
+        return self.apply("insert_entry", [(flow_id, *args)])[0]
+
+    def modify_entry(self, flow_id, *args):
+        return self.apply("modify_entry", [(flow_id, *args)])[0]
+
+    def lookup_entry(self, flow_id, *args):
+        return self.apply("lookup_entry", [(flow_id, *args)])[0]
+
+    def delete_entry(self, flow_id, *args):
+        return self.apply("delete_entry", [(flow_id, *args)])[0]
+
+    def close(self):
+        for requests in self.requests:
+            requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TestShardedFilter(unittest.TestCase):
+
+    def test_matches_routed_filters(self):
+        flows = list(range(300))
+        with ShardedFilter(StatefulBloomFilter, 3, hash_count=3, num_cells=3000) as sharded:
+            self.assertEqual(sharded.shard_args["num_cells"], 1000)
+            sharded.apply("insert_entry", [(flow, flow % 7) for flow in flows])
+            sharded.apply("modify_entry", [(flow, 100 + flow % 5) for flow in flows[::3]])
+            sharded.delete_entry(flows[1])
+            results = sharded.apply("lookup_entry", [(flow,) for flow in flows])
+            self.assertEqual(sharded.lookup_entry(flows[0]), results[0])
+            report = sharded.memory_report()
+
+        # the same operations against one local filter per shard
+        shards = shard_of(flows, 3)
+        local = [StatefulBloomFilter(hash_count=3, num_cells=1000) for _ in range(3)]
+        for flow in flows:
+            local[shards[flow]].insert_entry(flow, flow % 7)
+        for flow in flows[::3]:
+            local[shards[flow]].modify_entry(flow, 100 + flow % 5)
+        local[shards[flows[1]]].delete_entry(flows[1])
+        self.assertEqual(results, [local[shards[flow]].lookup_entry(flow) for flow in flows])
+        self.assertEqual(report["active_flows"], sum(f.memory_report()["active_flows"] for f in local))
+        self.assertEqual(report["theoretical_bits"], sum(f.memory_report()["theoretical_bits"] for f in local))
+
+    def test_time_arg_and_errors(self):
+        with ShardedFilter(ArrayFCF, 2, size_arg="table_size", time_arg="deletion_window",
+                           hash_fns=3, table_size=600, cells_per_bucket=4, fingerprint_size=12,
+                           deletion_window=1000) as sharded:
+            self.assertEqual(sharded.shard_args["table_size"], 300)
+            self.assertEqual(sharded.shard_args["deletion_window"], 500)
+            self.assertTrue(all(sharded.apply("insert_entry", [(flow, "open") for flow in range(50)])))
+            self.assertEqual(sharded.apply("lookup_entry", [(flow,) for flow in range(50)]), ["open"] * 50)
+            with self.assertRaises(AttributeError):
+                sharded.apply("no_such_method", [(1,)])
+            # workers keep serving after a failed batch
+            self.assertEqual(sharded.lookup_entry(3), "open")
+
+    def test_failed_workers(self):
+        # 8000 / 3 shards is not a whole number of 4 subtables
+        with self.assertRaises(ValueError):
+            ShardedFilter(ArrayFCF, 3, size_arg="table_size", hash_fns=4, table_size=8000, cells_per_bucket=6,
+                          fingerprint_size=10)
+        # a filter a worker cannot build fails the constructor instead of the first call
+        with self.assertRaises(TypeError):
+            ShardedFilter(StatefulBloomFilter, 2, hash_count=3, num_cells=1000, no_such_arg=1)
+        # a dead worker fails the calls waiting on it instead of hanging them
+        with ShardedFilter(StatefulBloomFilter, 2, hash_count=3, num_cells=1000) as sharded:
+            sharded.workers[1].terminate()
+            sharded.workers[1].join()
+            with self.assertRaises(RuntimeError):
+                sharded.broadcast("memory_report")
+
+    def test_routing_is_stable(self):
+        flows = [f"10.0.0.{i}:{i * 7}" for i in range(1000)]
+        shards = shard_of(flows, 4)
+        np.testing.assert_array_equal(shards, shard_of(flows, 4))
+        # a balanced split, roughly 250 flows each
+        self.assertTrue((np.bincount(shards, minlength=4) > 150).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
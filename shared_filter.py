@@ -0,0 +1,258 @@
+"""
+Array-backed filters placed in multiprocessing shared memory: one process owns the
+filter and applies every update, any number of other processes attach to the same
+table and look flows up in it without a copy.
+
+A segment is a 64 byte header of int64 slots followed by the filter's arrays, laid out
+as in a snapshot (see filter_snapshot). Slot 0 is a sequence counter the writer makes
+odd for the duration of every update, the next slots mirror the counters that reader
+lookups depend on (the current generation of a lazily expiring ArrayFCF, ...). A reader
+retries a lookup that overlapped an update, seqlock style. This relies on stores
+becoming visible to other processes in program order, as they do on x86-64.
+
+The writer unlinks the segment when it closes. Readers are meant to run in processes
+the writer's process started with multiprocessing, which share its resource tracker;
+one of an unrelated process would unlink the segment when that process exits (before
+Python 3.13, where readers attach untracked).
+"""
+import multiprocessing
+import os
+import sys
+import unittest
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from direct_bloom_filter import PackedDirectBloomFilter
+from filter_snapshot import array_layout
+from fingerprint_compressed_filter import ArrayFCF
+from stateful_bloom_filter import ArrayStatefulBloomFilter
+
+HEADER_SLOTS = 8
+HEADER_SIZE = HEADER_SLOTS * 8
+
+SHAREABLE = (ArrayStatefulBloomFilter, PackedDirectBloomFilter, ArrayFCF)
+
+# Counters a read-only lookup of each filter needs, published to the header
+READER_COUNTERS = {ArrayFCF: ("generation", "stash_count")}
+
+
+def map_arrays(buffer, layout, writeable=True):
+    arrays = {}
+    for entry in layout:
+        array = np.ndarray(tuple(entry["shape"]), dtype=entry["dtype"], buffer=buffer,
+                           offset=HEADER_SIZE + entry["offset"])
+        array.flags.writeable = writeable
+        arrays[entry["name"]] = array
+    return arrays
+
+
+class SharedFilter:
+    # Writer side: moves the arrays of filter into a new shared memory segment, where
+    # the filter keeps working on them. The codebook is frozen, since readers decode
+    # with their own copy of it, so every state has to be known up front (the states
+    # argument of the filter). Updates go through apply() or the insert/modify/lookup/
+    # delete shortcuts; descriptor is what attach() needs in a reader.
+
+    def __init__(self, filter):
+        if not isinstance(filter, SHAREABLE):
+            raise TypeError(f"{type(filter).__name__} cannot be shared, use one of "
+                            f"{', '.join(cls.__name__ for cls in SHAREABLE)}")
+        if hasattr(filter, "codebook"):
+            filter.codebook.freeze()
+        arrays = filter.snapshot_arrays()
+        layout, size = array_layout(arrays)
+        self.memory = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + max(size, 1))
+        self.header = np.ndarray(HEADER_SLOTS, dtype=np.int64, buffer=self.memory.buf)
+        self.header[:] = 0
+        views = map_arrays(self.memory.buf, layout)
+        for name, array in arrays.items():
+            views[name][...] = array
+        filter.restore(filter.snapshot_state(), views)
+        self.filter = filter
+        self.counters = READER_COUNTERS.get(type(filter), ())
+        self.descriptor = {
+            "name": self.memory.name,
+            "filter_class": type(filter),
+            "config": filter.snapshot_config(),
+            "state": filter.snapshot_state(),
+            "layout": layout,
+            "counters": self.counters,
+        }
+        self.publish()
+
+    def publish(self):
+        for slot, name in enumerate(self.counters, start=1):
+            self.header[slot] = int(getattr(self.filter, name))
+
+    def apply(self, method, *args):
+        self.header[0] += 1
+        try:
+            return getattr(self.filter, method)(*args)
+        finally:
+            self.publish()
+            self.header[0] += 1
+
+    def insert_entry(self, *args):
+        return self.apply("insert_entry", *args)
+
+    def modify_entry(self, *args):
+        return self.apply("modify_entry", *args)
+
+    def lookup_entry(self, *args):
+        return self.apply("lookup_entry", *args)
+
+    def delete_entry(self, *args):
+        return self.apply("delete_entry", *args)
+
+    # Moves the arrays back into this process, so the filter stays usable, and removes
+    # the segment. Readers have to be closed first.
+    def close(self):
+        arrays = {name: np.array(array) for name, array in self.filter.snapshot_arrays().items()}
+        self.filter.restore(self.filter.snapshot_state(), arrays)
+        self.header = None
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FilterReader:
+    # Reader side: a read-only filter of the descriptor's class over the shared arrays.
+    # Its lookups change nothing, so any number of readers can run them side by side.
+
+    def __init__(self, descriptor, cache_size=None):
+        # the segment belongs to the writer, whose close() unlinks it
+        untracked = {"track": False} if sys.version_info >= (3, 13) else {}
+        self.memory = shared_memory.SharedMemory(name=descriptor["name"], **untracked)
+        self.header = np.ndarray(HEADER_SLOTS, dtype=np.int64, buffer=self.memory.buf)
+        self.header.flags.writeable = False
+        filter = descriptor["filter_class"](**descriptor["config"], cache_size=cache_size)
+        filter.restore(descriptor["state"], map_arrays(self.memory.buf, descriptor["layout"], writeable=False))
+        filter.read_only = True
+        self.filter = filter
+        self.counters = descriptor["counters"]
+        self.retries = 0
+
+    def read(self, method, *args):
+        # filter.method(*args) against a table no update changed in the meantime
+        while True:
+            sequence = int(self.header[0])
+            if sequence & 1:
+                continue
+            for slot, name in enumerate(self.counters, start=1):
+                setattr(self.filter, name, int(self.header[slot]))
+            try:
+                result = getattr(self.filter, method)(*args)
+            except Exception:
+                # a read torn by an update can fail in ways a consistent one cannot
+                if int(self.header[0]) == sequence:
+                    raise
+                result = None
+            if int(self.header[0]) == sequence:
+                return result
+            self.retries += 1
+
+    def lookup_entry(self, *args):
+        return self.read("lookup_entry", *args)
+
+    def lookup_many(self, *args):
+        return self.read("lookup_many", *args)
+
+    def close(self):
+        self.filter = None
+        self.header = None
+        self.memory.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def attach(descriptor, cache_size=None):
+    return FilterReader(descriptor, cache_size=cache_size)
+
+
+def read_in_process(descriptor, flows, results):
+    # Child process of the tests: lookups through a reader of its own
+    with attach(descriptor) as reader:
+        results.put((os.getpid(), reader.lookup_many(flows)))
+
+
+class TestSharedFilter(unittest.TestCase):
+
+    def filters(self):
+        return [
+            (ArrayStatefulBloomFilter(hash_count=3, num_cells=500, states=range(1, 8)), ()),
+            (PackedDirectBloomFilter(num_cells=500, hash_count=3, phase_duration=150, cell_bits=4), (1,)),
+            (ArrayFCF(hash_fns=3, table_size=150, cells_per_bucket=4, fingerprint_size=12, deletion_window=150,
+                      states=range(1, 8), lazy_expiry=True, max_kicks=8, stash_size=4), ()),
+        ]
+
+    def test_readers_see_writer_updates(self):
+        for filter, lookup_args in self.filters():
+            with SharedFilter(filter) as writer:
+                with attach(writer.descriptor) as reader:
+                    for flow in range(120):
+                        writer.insert_entry(flow, *(lookup_args or (flow % 7 + 1,)))
+                        if flow % 5 == 0:
+                            writer.delete_entry(flow // 2, *lookup_args)
+                        table = bytes(writer.memory.buf)
+                        # a reader answers as a read-only writer would, without writing
+                        for probe in (flow, flow // 2, flow + 1000):
+                            filter.read_only = True
+                            expected = filter.lookup_entry(probe, *lookup_args)
+                            filter.read_only = False
+                            self.assertEqual(reader.lookup_entry(probe, *lookup_args), expected)
+                        self.assertEqual(bytes(writer.memory.buf), table)
+                    with self.assertRaises(ValueError):
+                        next(iter(reader.filter.snapshot_arrays().values()))[...] = 0
+            # the writer keeps its table after closing
+            for array in filter.snapshot_arrays().values():
+                self.assertTrue(array.flags.owndata)
+
+    def test_frozen_codebook(self):
+        filter = ArrayStatefulBloomFilter(hash_count=3, num_cells=100, states=["open"])
+        with SharedFilter(filter) as writer:
+            writer.insert_entry(1, "open")
+            with self.assertRaises(ValueError):
+                writer.insert_entry(2, "closed")
+        with self.assertRaises(TypeError):
+            SharedFilter(object())
+
+    def test_reader_processes(self):
+        # spawned readers hash str flow ids with a hash() seed of their own
+        for method, flow_ids in (("fork", range(4000)), ("spawn", [f"flow-{i}" for i in range(4000)])):
+            context = multiprocessing.get_context(method)
+            filter = ArrayFCF(hash_fns=3, table_size=3000, cells_per_bucket=4, fingerprint_size=16, states=range(10))
+            with SharedFilter(filter) as writer:
+                for i in range(0, 4000, 3):
+                    writer.insert_entry(flow_ids[i], i % 10)
+                probes = list(flow_ids)
+                filter.read_only = True
+                expected = filter.lookup_many(probes)
+                filter.read_only = False
+                self.assertGreaterEqual(sum(answer is not None for answer in expected), len(range(0, 4000, 3)))
+                results = context.Queue()
+                readers = [context.Process(target=read_in_process, args=(writer.descriptor, probes, results))
+                           for _ in range(3)]
+                for reader in readers:
+                    reader.start()
+                answers = [results.get() for _ in readers]
+                for reader in readers:
+                    reader.join()
+                self.assertEqual(len({pid for pid, _ in answers}), 3)
+                for _, answer in answers:
+                    self.assertEqual(answer, expected)
+                # the segment outlives the readers
+                writer.insert_entry(flow_ids[1], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
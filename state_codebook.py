@@ -0,0 +1,83 @@
+import unittest
+
+import numpy as np
+
+# Reserved codes in the uint8 state arrays of the array-backed filters
+EMPTY = 0
+DK = 255
+
+
+class StateCodebook:
+    # Maps the (hashable) states the filters are given onto the small ints kept
+    # in typed cell arrays. Code 0 is an empty cell and 255 is DK, which leaves
+    # 254 codes for real states.
+
+    def __init__(self, states=()):
+        self.codes = {}
+        self.states = [None]
+        self.frozen = False
+        for state in states:
+            self.encode(state)
+
+    def __len__(self):
+        return len(self.states) - 1
+
+    def encode(self, state):
+        code = self.codes.get(state)
+        if code is None:
+            if self.frozen:
+                raise ValueError(f"state {state!r} is not in the frozen codebook")
+            code = len(self.states)
+            if code >= DK:
+                raise ValueError(f"cannot encode more than {DK - 1} distinct states")
+            self.codes[state] = code
+            self.states.append(state)
+        return code
+
+    # No new states after this, e.g. once other processes decode the same codes with
+    # their own copy of the codebook
+    def freeze(self):
+        self.frozen = True
+
+    def encode_many(self, states):
+        return np.fromiter((self.encode(state) for state in states), dtype=np.uint8)
+
+    def decode(self, code, dont_know="IDK"):
+        if code == DK:
+            return dont_know
+        return self.states[code]
+
+    def decode_many(self, codes, dont_know="IDK"):
+        table = np.empty(DK + 1, dtype=object)
+        table[: len(self.states)] = self.states
+        table[DK] = dont_know
+        return table[codes].tolist()
+
+
+class TestStateCodebook(unittest.TestCase):
+    def test_round_trip(self):
+        codebook = StateCodebook([1, 2])
+        self.assertEqual(codebook.encode(1), 1)
+        self.assertEqual(codebook.encode("ten"), 3)
+        self.assertEqual(len(codebook), 3)
+        codes = codebook.encode_many([2, "ten", 1])
+        self.assertEqual(codes.dtype, np.uint8)
+        self.assertEqual(codebook.decode_many(np.append(codes, [EMPTY, DK])), [2, "ten", 1, None, "IDK"])
+        self.assertEqual(codebook.decode(DK), "IDK")
+        self.assertIsNone(codebook.decode(EMPTY))
+
+    def test_capacity(self):
+        codebook = StateCodebook(range(DK - 1))
+        with self.assertRaises(ValueError):
+            codebook.encode("one too many")
+
+    def test_freeze(self):
+        codebook = StateCodebook(["open"])
+        codebook.freeze()
+        self.assertEqual(codebook.encode("open"), 1)
+        with self.assertRaises(ValueError):
+            codebook.encode("closed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,16 @@
+import os
+import tempfile
 import unittest
 from typing import Optional, Union
 
+import numpy as np
+
 from bloom_filter import BloomFilter, State
+from filter_snapshot import Snapshottable, check_states
+from memory_usage import STATE_BITS, build_memory_report, deep_sizeof
+from state_codebook import DK, EMPTY, StateCodebook
+
+MAX_REFCOUNT = np.iinfo(np.uint16).max
 
 
 class DontKnow:
@@ -23,7 +32,7 @@ class StatefulBloomFilterCell:
     def set(self, state):
         if self.state is None:
             self.state = state
-        elif self.state != DontKnow() and self.state != state:
+        elif not isinstance(self.state, DontKnow) and self.state != state:
             self.state = DontKnow()
         # self.tate must already be equal to state
         return
@@ -34,27 +43,27 @@ class StatefulBloomFilterCell:
             self.state = None
 
 
-class StatefulBloomFilter(BloomFilter):
+class StatefulBloomFilter(BloomFilter, Snapshottable):
 
-    def __init__(self, hash_count=4, num_cells=10) -> None:
-        super().__init__(hash_count, num_cells=num_cells)
+    def __init__(self, hash_count=4, num_cells=10, cache_size=None) -> None:
+        super().__init__(hash_count, num_cells=num_cells, cache_size=cache_size)
         self.store = [StatefulBloomFilterCell() for _ in range(self.num_buckets)]
 
     def insert_entry(self, flow, state):
         # • Insertion. Hash the flow. If the cell counter is 0, write the new value and set the count to 1. If the cell value is DK, increment the count. If the cell value equals the flow value, increment the count. If the cell value does not equal the flow value, increment the count but change the cell to DK.
-        for hash_val in self.compute_hash_vals(str(flow)):
+        for hash_val in self.flow_indices(flow):
             self.store[hash_val].add(state=state)
 
     def modify_entry(self, flow, state):
         # • Modify. Hash the flow. If the cell value is DK, leave it. If the current count is 1, change the cell value. If current count is exceeds 1, change the cell value to DK.
-        for hash_val in self.compute_hash_vals(flow):
+        for hash_val in self.flow_indices(flow):
             self.store[hash_val].set(state=state)
 
     def lookup_entry(self, flow):
         # • Lookup. Check all cells associated with a flow. If all cell values are DK, return DK. If all cell values have value i or DK (and at least one cell has value i), return i. If there is more than one value in the cells, the item is not in the set.
         ret = None
-        for hash_val in self.compute_hash_vals(str(flow)):
-            state = self.store[hash_val]
+        for hash_val in self.flow_indices(flow):
+            state = self.store[hash_val].state
 
             if state is None:
                 return None
@@ -70,9 +79,195 @@ class StatefulBloomFilter(BloomFilter):
 
     def delete_entry(self, flow):
         # • Deletion. Hash the flow. If the count is 1, reset cell to 0. If the count it at least 1, decrement count, leaving the value or DK as is.
-        for hash_val in self.compute_hash_vals(flow):
+        for hash_val in self.flow_indices(flow):
             self.store[hash_val].decrement()
 
+    def memory_report(self):
+        # One state per cell in theory, a cell object per cell in practice. Every flow
+        # holds a reference in num_hash_func cells.
+        active_flows = sum(cell.refCount for cell in self.store) // self.num_hash_func
+        return build_memory_report(self.num_buckets * STATE_BITS, deep_sizeof(self), active_flows)
+
+    # Snapshots hold the cells as the state codes and refcounts of an
+    # ArrayStatefulBloomFilter. Restoring has to rebuild the cell objects from them,
+    # so unlike the array filter it reads the whole table.
+
+    def snapshot_config(self):
+        return {"hash_count": self.num_hash_func, "num_cells": self.num_buckets}
+
+    def snapshot_codebook(self):
+        codebook = StateCodebook()
+        for cell in self.store:
+            if cell.state is not None and not isinstance(cell.state, DontKnow):
+                codebook.encode(cell.state)
+        return codebook
+
+    def snapshot_state(self):
+        return {"seeds": self.seeds, "states": check_states(self.snapshot_codebook().states[1:])}
+
+    def snapshot_arrays(self):
+        codebook = self.snapshot_codebook()
+        codes = [EMPTY if cell.state is None else DK if isinstance(cell.state, DontKnow) else codebook.codes[cell.state]
+                 for cell in self.store]
+        return {
+            "state": np.array(codes, dtype=np.uint8),
+            "refcount": np.array([cell.refCount for cell in self.store], dtype=np.int64),
+        }
+
+    def restore(self, state, arrays):
+        self.seeds = state["seeds"]
+        states = [None] + state["states"]
+        for cell, code, refcount in zip(self.store, arrays["state"].tolist(), arrays["refcount"].tolist()):
+            cell.state = DontKnow() if code == DK else states[code]
+            cell.refCount = refcount
+
+
+class ArrayStatefulBloomFilter(BloomFilter, Snapshottable):
+    # Same insert/modify/lookup/delete rules as StatefulBloomFilter, but the cells
+    # are two parallel typed arrays instead of one Python object per cell:
+    # a uint8 state code (see state_codebook, 0 = empty, 255 = DK) and a
+    # saturating uint16 refcount, 3 bytes per cell.
+
+    def __init__(self, hash_count=4, num_cells=10, double_hashing=False, states=(), cache_size=None) -> None:
+        super().__init__(hash_count, num_cells=num_cells, double_hashing=double_hashing, cache_size=cache_size)
+        self.codebook = StateCodebook(states)
+        self.state = np.zeros(self.num_buckets, dtype=np.uint8)
+        self.refcount = np.zeros(self.num_buckets, dtype=np.uint16)
+
+    def _set(self, hash_val, code):
+        current = self.state[hash_val]
+        if current == EMPTY:
+            self.state[hash_val] = code
+        elif current != DK and current != code:
+            self.state[hash_val] = DK
+
+    def insert_entry(self, flow, state):
+        code = self.codebook.encode(state)
+        for hash_val in self.flow_indices(flow):
+            if self.refcount[hash_val] < MAX_REFCOUNT:
+                self.refcount[hash_val] += 1
+            self._set(hash_val, code)
+
+    def modify_entry(self, flow, state):
+        code = self.codebook.encode(state)
+        for hash_val in self.flow_indices(flow):
+            self._set(hash_val, code)
+
+    def lookup_entry(self, flow):
+        ret = DK
+        for hash_val in self.flow_indices(flow):
+            code = self.state[hash_val]
+            if code == EMPTY:
+                return None
+            if ret == DK:
+                ret = code
+            elif code != DK and code != ret:
+                return None
+        return self.codebook.decode(ret)
+
+    def delete_entry(self, flow):
+        for hash_val in self.flow_indices(flow):
+            if self.refcount[hash_val] <= 1:
+                self.refcount[hash_val] = 0
+                self.state[hash_val] = EMPTY
+            else:
+                self.refcount[hash_val] -= 1
+
+    # Batch operations. Each takes a sequence of flows (and states), hashes them in
+    # one compute_hash_matrix call and applies the whole (n, k) index matrix with
+    # NumPy. The cell rules are order independent within a batch, so the result is
+    # the same as applying the entries one at a time.
+
+    def insert_many(self, flows, states):
+        self.insert_indices(self.compute_hash_matrix(flows), self.codebook.encode_many(states))
+
+    def modify_many(self, flows, states):
+        self.modify_indices(self.compute_hash_matrix(flows), self.codebook.encode_many(states))
+
+    def lookup_many(self, flows):
+        return self.codebook.decode_many(self.lookup_indices(self.compute_hash_matrix(flows)))
+
+    def delete_many(self, flows):
+        self.delete_indices(self.compute_hash_matrix(flows))
+
+    def _group_cells(self, indices, codes=None):
+        # Collapse an (n, k) index matrix into its distinct cells, how often each was
+        # hit and, when codes are given, the smallest and largest code written to it
+        cells = indices.ravel()
+        order = np.argsort(cells, kind="stable")
+        cells = cells[order]
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        counts = np.diff(np.r_[starts, len(cells)])
+        if codes is None:
+            return cells[starts], counts, None, None
+        writes = np.repeat(codes, indices.shape[1])[order]
+        return (
+            cells[starts],
+            counts,
+            np.minimum.reduceat(writes, starts),
+            np.maximum.reduceat(writes, starts),
+        )
+
+    def _merge_states(self, cells, lo, hi):
+        # An empty cell takes the written code if every write agreed, any cell that
+        # sees a code other than its own becomes DK
+        agreed = np.where(lo == hi, lo, DK).astype(np.uint8)
+        current = self.state[cells]
+        self.state[cells] = np.where(
+            current == EMPTY, agreed, np.where(current == agreed, current, DK)
+        )
+
+    def insert_indices(self, indices, codes):
+        if indices.size == 0:
+            return
+        cells, counts, lo, hi = self._group_cells(indices, codes)
+        self.refcount[cells] = np.minimum(self.refcount[cells] + counts, MAX_REFCOUNT)
+        self._merge_states(cells, lo, hi)
+
+    def modify_indices(self, indices, codes):
+        if indices.size == 0:
+            return
+        cells, _, lo, hi = self._group_cells(indices, codes)
+        self._merge_states(cells, lo, hi)
+
+    def delete_indices(self, indices):
+        if indices.size == 0:
+            return
+        cells, counts, _, _ = self._group_cells(indices)
+        remaining = np.maximum(self.refcount[cells].astype(np.int64) - counts, 0)
+        self.refcount[cells] = remaining
+        self.state[cells[remaining == 0]] = EMPTY
+
+    def lookup_indices(self, indices):
+        # Returns one state code per row: EMPTY (not in the set), DK or the state
+        codes = self.state[indices]
+        known = codes != DK
+        hi = np.where(known, codes, EMPTY).max(axis=1)
+        lo = np.where(known, codes, DK).min(axis=1)
+        ret = np.where(known.any(axis=1), np.where(lo == hi, hi, EMPTY), DK).astype(np.uint8)
+        ret[(codes == EMPTY).any(axis=1)] = EMPTY
+        return ret
+
+    def memory_report(self):
+        active_flows = int(self.refcount.sum()) // self.num_hash_func
+        return build_memory_report(self.num_buckets * STATE_BITS, deep_sizeof(self), active_flows)
+
+    # A loaded filter works directly on the memory-mapped state and refcount arrays
+
+    def snapshot_config(self):
+        return {
+            "hash_count": self.num_hash_func,
+            "num_cells": self.num_buckets,
+            "double_hashing": self.double_hashing,
+            "states": check_states(self.codebook.states[1:]),
+        }
+
+    def snapshot_state(self):
+        return {"seeds": self.seeds}
+
+    def snapshot_arrays(self):
+        return {"state": self.state, "refcount": self.refcount}
+
 
 class TestStatefulBloomFilter(unittest.TestCase):
     def test_stateful_bloom_filter_cell(self):
@@ -100,6 +295,125 @@ class TestStatefulBloomFilter(unittest.TestCase):
         self.assertEqual(cell.refCount, 0)
         self.assertIsNone(cell.state)
 
+    def test_lookup_rules(self):
+        for filter in (StatefulBloomFilter(hash_count=3, num_cells=100),
+                       ArrayStatefulBloomFilter(hash_count=3, num_cells=100)):
+            self.assertIsNone(filter.lookup_entry(1))
+            filter.insert_entry(1, "one")
+            self.assertEqual(filter.lookup_entry(1), "one")
+            filter.modify_entry(1, "two")
+            self.assertEqual(filter.lookup_entry(1), "IDK")
+            filter.delete_entry(1)
+            self.assertIsNone(filter.lookup_entry(1))
+
+
+class TestArrayStatefulBloomFilter(unittest.TestCase):
+    def test_memory_report(self):
+        objects = StatefulBloomFilter(hash_count=3, num_cells=3000)
+        arrays = ArrayStatefulBloomFilter(hash_count=3, num_cells=3000)
+        for filter in (objects, arrays):
+            for flow in range(200):
+                filter.insert_entry(flow, flow % 4)
+            filter.delete_entry(0)
+        reports = [filter.memory_report() for filter in (objects, arrays)]
+        for report in reports:
+            self.assertEqual(report["theoretical_bits"], 3000 * 8)
+            self.assertEqual(report["active_flows"], 199)
+        # a cell object per cell against 3 bytes per cell
+        self.assertGreater(reports[0]["actual_bytes"], 10 * reports[1]["actual_bytes"])
+        self.assertGreaterEqual(reports[1]["actual_bytes"], 3000 * 3)
+
+    def test_index_cache(self):
+        flows, states = self.random_ops(1)
+        for filter_class in (StatefulBloomFilter, ArrayStatefulBloomFilter):
+            cached = filter_class(hash_count=3, num_cells=400, cache_size=64)
+            plain = filter_class(hash_count=3, num_cells=400)
+            for i, (flow, state) in enumerate(zip(flows, states)):
+                for filter in (cached, plain):
+                    if i % 2:
+                        filter.insert_entry(flow, state)
+                    else:
+                        filter.modify_entry(flow, state)
+                self.assertEqual(cached.lookup_entry(flow), plain.lookup_entry(flow))
+            stats = cached.index_cache.stats()
+            self.assertEqual(stats["hits"] + stats["misses"], 2 * len(flows))
+            self.assertEqual(stats["size"], 64)
+
+    def random_ops(self, seed, count=3000):
+        rng = np.random.default_rng(seed)
+        flows = rng.integers(0, 500, count).tolist()
+        states = rng.integers(1, 11, count).tolist()
+        return flows, states
+
+    def test_matches_object_filter(self):
+        objects = StatefulBloomFilter(hash_count=3, num_cells=400)
+        arrays = ArrayStatefulBloomFilter(hash_count=3, num_cells=400)
+        flows, states = self.random_ops(0)
+        # only delete flows that are in the filter, the object cells let refCount go
+        # negative otherwise while the uint16 counts stop at 0
+        live = []
+        for i, (flow, state) in enumerate(zip(flows, states)):
+            if i % 5 == 3 and live:
+                flow = live.pop(flow % len(live))
+            for filter in (objects, arrays):
+                if i % 5 == 3:
+                    filter.delete_entry(flow)
+                elif i % 5 == 4:
+                    filter.modify_entry(flow, state)
+                else:
+                    filter.insert_entry(flow, state)
+            if i % 5 < 3:
+                live.append(flow)
+            self.assertEqual(objects.lookup_entry(flow), arrays.lookup_entry(flow))
+        for cell, state, refcount in zip(objects.store, arrays.state, arrays.refcount):
+            self.assertEqual(cell.refCount, refcount)
+            if isinstance(cell.state, DontKnow):
+                self.assertEqual(state, DK)
+            else:
+                self.assertEqual(cell.state, arrays.codebook.decode(state))
+
+    def test_batch_matches_scalar(self):
+        for double_hashing in (False, True):
+            scalar = ArrayStatefulBloomFilter(hash_count=4, num_cells=300, double_hashing=double_hashing)
+            batch = ArrayStatefulBloomFilter(hash_count=4, num_cells=300, double_hashing=double_hashing)
+            flows, states = self.random_ops(1)
+            for flow, state in zip(flows[:1000], states[:1000]):
+                scalar.insert_entry(flow, state)
+            for flow, state in zip(flows[1000:2000], states[1000:2000]):
+                scalar.modify_entry(flow, state)
+            for flow in flows[2000:2500]:
+                scalar.delete_entry(flow)
+            batch.insert_many(flows[:1000], states[:1000])
+            batch.modify_many(flows[1000:2000], states[1000:2000])
+            batch.delete_many(flows[2000:2500])
+            np.testing.assert_array_equal(scalar.refcount, batch.refcount)
+            np.testing.assert_array_equal(scalar.state, batch.state)
+            self.assertEqual(batch.lookup_many(flows), [scalar.lookup_entry(flow) for flow in flows])
+
+    def test_snapshot(self):
+        flows, states = self.random_ops(2, count=600)
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, "sbf.snapshot")
+            for filter_class in (StatefulBloomFilter, ArrayStatefulBloomFilter):
+                filter = filter_class(hash_count=3, num_cells=200)
+                for flow, state in zip(flows[:400], states[:400]):
+                    filter.insert_entry(flow, state)
+                filter.save(path)
+                loaded = filter_class.load(path, cache_size=10)
+                self.assertEqual([loaded.lookup_entry(flow) for flow in flows],
+                                 [filter.lookup_entry(flow) for flow in flows])
+                # the restored filter carries on like the original
+                for flow, state in zip(flows[400:], states[400:]):
+                    for f in (filter, loaded):
+                        f.insert_entry(flow, state)
+                        f.delete_entry(flows[0])
+                self.assertEqual([loaded.lookup_entry(flow) for flow in flows],
+                                 [filter.lookup_entry(flow) for flow in flows])
+                self.assertEqual(loaded.memory_report()["active_flows"], filter.memory_report()["active_flows"])
+            self.assertIsInstance(loaded.state, np.memmap)
+            with self.assertRaises(ValueError):
+                StatefulBloomFilter.load(path)
+
 
 if __name__ == "__main__":
     unittest.main()